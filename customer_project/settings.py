@@ -203,11 +203,63 @@ if ENVIRONMENT == "production" or POSTGRES_LOCALLY == True: # checks where postg
 
 else:
     MEDIA_ROOT = os.path.join(BASE_DIR, 'media')  # Directory where uploaded files are stored - absolute filesystem path - in storage
+    # offline stand-in for cloudinary: local files that can be made slow / fail (customers.storage)
+    STORAGES = { "default": { "BACKEND": "customers.storage.LocalCloudinaryStorage", },
+                "staticfiles": { "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage", },
+                }
     # star image as default icon image in development: 
     DEFAULT_STAR_IMAGE_URL = '/static/images/star.svg'
 
 
 
+# Finished mailing label pdfs are cached on local disk (keyed by mailing list version) & evicted by age / total size
+LABEL_CACHE_ROOT = BASE_DIR / 'label_cache'
+LABEL_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # seconds since a cached pdf was last printed
+LABEL_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# Pages of a customer's notes & documents (profile "load more") are cached in django's cache, keyed by the customer's
+# profile_version - a new version is used as soon as a note or document changes, the old pages expire after this
+PROFILE_FRAGMENT_CACHE_TIMEOUT = 60 * 60  # seconds
+
+# Very large label runs are rendered by a pool of worker processes
+LABEL_RENDER_WORKERS = os.cpu_count() or 1
+
+# Duplicate customer clusters are scored by a pool of worker processes
+DUPLICATE_CLUSTER_WORKERS = os.cpu_count() or 1
+
+# Dynamic mailing lists: seconds a snapshot of the members is shown before the rule is evaluated again
+# (exports & labels always evaluate it)
+DYNAMIC_MAILING_LIST_MAX_AGE = 5 * 60
+
+# Lines printed in the top left corner of envelopes, e.g. ['Tree Farm', '123 Main St', 'Canton, OH 44718']
+LABEL_RETURN_ADDRESS = []
+
+# Files uploaded during the multi-step customer sign-up wait on local disk until the last step saves the customer
+SIGNUP_STAGING_ROOT = BASE_DIR / 'signup_staging'
+SIGNUP_STAGING_MAX_AGE = 24 * 60 * 60  # seconds before the uploads of an abandoned sign-up are deleted
+
+# Uploaded documents are spooled to local disk & pushed to the storage backend by a background job (with retries)
+DOCUMENT_SPOOL_ROOT = BASE_DIR / 'document_spool'
+DOCUMENT_UPLOAD_ATTEMPTS = 4
+DOCUMENT_UPLOAD_RETRY_DELAY = 2  # seconds before the 2nd attempt - doubled before each next one
+DOCUMENT_UPLOAD_STUCK_AFTER = 15 * 60  # seconds after which a 'processing' upload is pushed again (store_spooled_documents)
+LOCAL_STORAGE_LATENCY = 0  # seconds every save to the offline storage stand-in takes
+
+# Document downloads can be handed to the front-end server instead of streamed by a python worker:
+# '' (streamed by django), 'x-accel-redirect' (nginx: an internal location serving DOCUMENT_DOWNLOAD_ACCEL_PREFIX
+# from the document storage) or 'x-sendfile' (apache / lighttpd - only for files on local disk)
+DOCUMENT_DOWNLOAD_OFFLOAD = env('DOCUMENT_DOWNLOAD_OFFLOAD', default='')
+DOCUMENT_DOWNLOAD_ACCEL_PREFIX = '/protected-media/'
+
+# Customer import files (csv / excel) & the reports of their rows that could not be imported
+CUSTOMER_IMPORT_ROOT = BASE_DIR / 'customer_imports'
+
+# Background jobs (large label runs, etc.) run on a thread pool in each web worker
+BACKGROUND_TASK_WORKERS = 2
+BACKGROUND_TASKS_SYNCHRONOUS = False  # True runs background jobs immediately, in the request (useful for debugging)
+
+
+
 # ---- ADD the following to integrate with Django allauth ------
 ACCOUNT_USERNAME_REQUIRED = False
 
@@ -0,0 +1,97 @@
+import re
+
+from django.db.models import Min
+
+# USPS street suffix abbreviations (Publication 28, appendix C1) - the common ones
+USPS_STREET_SUFFIXES = {
+    "ALLEY": "ALY", "AVENUE": "AVE", "AV": "AVE", "AVEN": "AVE", "BOULEVARD": "BLVD", "BRANCH": "BR", "BRIDGE": "BRG",
+    "CENTER": "CTR", "CIRCLE": "CIR", "CIRCL": "CIR", "COURT": "CT", "COVE": "CV", "CREEK": "CRK", "CRESCENT": "CRES",
+    "CROSSING": "XING", "DRIVE": "DR", "DRIV": "DR", "ESTATES": "ESTS", "EXPRESSWAY": "EXPY", "EXTENSION": "EXT",
+    "FREEWAY": "FWY", "GARDENS": "GDNS", "GROVE": "GRV", "HEIGHTS": "HTS", "HIGHWAY": "HWY", "HIGHWY": "HWY",
+    "HILL": "HL", "HOLLOW": "HOLW", "JUNCTION": "JCT", "LAKE": "LK", "LANE": "LN", "MEADOWS": "MDWS", "MILL": "ML",
+    "MOUNTAIN": "MTN", "PARKWAY": "PKWY", "PKY": "PKWY", "PLACE": "PL", "PLAZA": "PLZ", "POINT": "PT", "RIDGE": "RDG",
+    "ROAD": "RD", "ROUTE": "RTE", "SQUARE": "SQ", "STATION": "STA", "STREET": "ST", "STR": "ST", "TERRACE": "TER",
+    "TRAIL": "TRL", "TRAILS": "TRL", "TURNPIKE": "TPKE", "VALLEY": "VLY", "VIEW": "VW", "VILLAGE": "VLG",
+}
+
+# USPS directionals & secondary unit designators
+USPS_DIRECTIONALS = {
+    "NORTH": "N", "SOUTH": "S", "EAST": "E", "WEST": "W",
+    "NORTHEAST": "NE", "NORTHWEST": "NW", "SOUTHEAST": "SE", "SOUTHWEST": "SW",
+}
+USPS_UNIT_DESIGNATORS = {
+    "APARTMENT": "APT", "BUILDING": "BLDG", "DEPARTMENT": "DEPT", "FLOOR": "FL", "ROOM": "RM", "SUITE": "STE",
+}
+
+# words that start the secondary unit part of a street ('4 Main St Apt 2')
+UNIT_WORDS = {*USPS_UNIT_DESIGNATORS, *USPS_UNIT_DESIGNATORS.values(), "UNIT", "LOT", "TRLR", "#"}
+CITY_ABBREVIATIONS = {"SAINT": "ST", "FORT": "FT", "MOUNT": "MT"}
+
+# punctuation dropped from addresses ('#' is kept as a unit designator)
+_PUNCTUATION = re.compile(r"[^\w\s#]")
+_PO_BOX = re.compile(r"\b(?:P\s?O|POST OFFICE)\s+BOX\b")
+
+
+def _words(value):
+    """Uppercases a value, drops punctuation & splits it into words"""
+    return _PUNCTUATION.sub(" ", (value or "").upper()).replace("#", " # ").split()
+
+
+def normalize_street(street):
+    """
+        Returns the normalized street: '123 North Main Street, Apt. 4' -> '123 N MAIN ST APT 4'
+        Abbreviations follow USPS placement, so street names are left alone ('Ridge Road' -> 'RIDGE RD', not 'RDG RD'):
+        the suffix is the last word of the street, directionals come after the house number or at the end.
+    """
+    words = _words(street)
+    normalized = " ".join(words)
+    if _PO_BOX.search(normalized):
+        return _PO_BOX.sub("PO BOX", normalized)
+
+    # split off the secondary unit (the house number can't start one)
+    unit_start = next((i for i, word in enumerate(words) if i and word in UNIT_WORDS), len(words))
+    street_words, unit_words = words[:unit_start], words[unit_start:]
+    if unit_words:
+        unit_words[0] = USPS_UNIT_DESIGNATORS.get(unit_words[0], unit_words[0])
+
+    suffix_index = len(street_words) - 1
+    if len(street_words) > 2:
+        # pre directional (after the house number) & post directional
+        street_words[1] = USPS_DIRECTIONALS.get(street_words[1], street_words[1])
+        if street_words[-1] in USPS_DIRECTIONALS:
+            street_words[-1] = USPS_DIRECTIONALS[street_words[-1]]
+            suffix_index -= 1
+    if suffix_index > 0:
+        street_words[suffix_index] = USPS_STREET_SUFFIXES.get(street_words[suffix_index], street_words[suffix_index])
+
+    return " ".join(street_words + unit_words)
+
+
+def normalize_address_key(street, city, state, zip_code):
+    """
+        Returns the normalized key of an address: the same for every way the same mailing address is typed in.
+
+        - uppercased, punctuation dropped & whitespace collapsed
+        - USPS street suffix, directional & unit abbreviations (STREET -> ST, NORTH -> N, SUITE -> STE) - see normalize_street
+        - 5 digit zip code
+    """
+    zip_code = re.sub(r"\D", "", zip_code or "")[:5]
+    return "|".join([
+        normalize_street(street),
+        " ".join(CITY_ABBREVIATIONS.get(word, word) for word in _words(city)),
+        (state or "").strip().upper(),
+        zip_code,
+    ])
+
+
+def first_address_ids(addresses):
+    """
+        Subquery of the id of the first (oldest) address of every normalized key in an Address queryset.
+        The database collapses the duplicates with a group by on the indexed key (a hash aggregate on postgres).
+    """
+    return addresses.order_by().values('normalized_key').annotate(first_id=Min('id')).values('first_id')
+
+
+def unique_addresses(addresses):
+    """Returns an Address queryset without duplicate addresses - one address per normalized key"""
+    return addresses.filter(id__in=first_address_ids(addresses))
@@ -0,0 +1,75 @@
+import json
+import re
+import zlib
+from difflib import SequenceMatcher
+
+# every SNAPSHOT_INTERVAL-th version in a history is stored whole: rebuilding a version applies fewer diffs than that
+SNAPSHOT_INTERVAL = 10
+
+_TOKENS = re.compile(r"\s+|\S+")  # words & the whitespace between them: joined back they are the text, unchanged
+
+
+def tokens(text):
+    """The words of a text & the whitespace between them - ''.join(tokens(text)) == text"""
+    return _TOKENS.findall(text)
+
+
+def compress_text(text):
+    """zlib compressed utf-8 of a text"""
+    return zlib.compress(text.encode("utf-8"), 9)
+
+
+def decompress_text(data):
+    """The text compressed by compress_text() (bytes or the memoryview some databases return)"""
+    return zlib.decompress(data).decode("utf-8")
+
+
+def text_checksum(text):
+    """crc32 of a text (8 hex digits): checks a diff is applied to the text it was made against"""
+    return f"{zlib.crc32(text.encode('utf-8')):08x}"
+
+
+def encode_delta(newer_text, text):
+    """
+        Reverse diff rebuilding text from the newer version of it, zlib compressed: a json list of the runs of words of
+        the newer text that are kept ([start, end]) & of the text written instead of the others (strings)
+    """
+    newer, older = tokens(newer_text), tokens(text)
+
+    # an edit usually changes a few words in one place: only what lies between the unchanged start & end is diffed
+    prefix = 0
+    while prefix < min(len(newer), len(older)) and newer[prefix] == older[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(newer), len(older)) - prefix and newer[-1 - suffix] == older[-1 - suffix]:
+        suffix += 1
+
+    operations = [[0, prefix]] if prefix else []
+    matcher = SequenceMatcher(None, newer[prefix:len(newer) - suffix], older[prefix:len(older) - suffix])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            operations.append([prefix + i1, prefix + i2])
+        elif j2 > j1:  # replaced or inserted words (deleted ones are simply not copied)
+            operations.append("".join(older[prefix + j1:prefix + j2]))
+    if suffix:
+        operations.append([len(newer) - suffix, len(newer)])
+    return zlib.compress(json.dumps(operations, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def apply_delta(newer_text, delta):
+    """The text encode_delta(newer_text, text) was made from"""
+    newer = tokens(newer_text)
+    return "".join(
+        "".join(newer[operation[0]:operation[1]]) if isinstance(operation, list) else operation
+        for operation in json.loads(zlib.decompress(delta))
+    )
+
+
+def encode_version(position, newer_text, text):
+    """
+        (delta, is_snapshot) storing the version of a text at a position of its history (0: the oldest) - a reverse diff
+        against the newer version, or all of it (compressed) every SNAPSHOT_INTERVAL versions
+    """
+    if (position + 1) % SNAPSHOT_INTERVAL == 0:
+        return compress_text(text), True
+    return encode_delta(newer_text, text), False
@@ -0,0 +1,324 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .models import CustomerDocument, DocumentBlob
+from .previews import queue_document_previews, release_preview
+from .profile import bump_profile_version
+from .tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+
+def spool_storage():
+    """Local storage uploaded documents wait in until a background job has pushed them to the document storage"""
+    return FileSystemStorage(location=settings.DOCUMENT_SPOOL_ROOT)
+
+
+class HashingFile(File):
+    """A file that computes the SHA-256 of the chunks read from it - the hash comes with the copy, in the same pass"""
+
+    def __init__(self, file, name=None):
+        super().__init__(file, name)
+        self.sha256 = hashlib.sha256()
+
+    def chunks(self, chunk_size=None):
+        self.sha256 = hashlib.sha256()
+        for chunk in super().chunks(chunk_size):
+            self.sha256.update(chunk)
+            yield chunk
+
+
+def file_sha256(file):
+    """SHA-256 of a stored file, read in chunks"""
+    sha256 = hashlib.sha256()
+    for chunk in File(file).chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def spool_upload(document, upload):
+    """
+        Writes an uploaded file to the local spool & points the (unsaved) document at it instead of uploading it to the
+        storage backend in the request. The document is 'processing' until store_document has pushed the file.
+
+        - the SHA-256 of the upload is computed while it is copied to the spool (content_hash)
+        - the document keeps the file name it will be shown under (save() still renames it after the customer)
+        - call queue_document_uploads with the document ids once the documents are saved
+    """
+    if document.pk and not document.blob_id:
+        # the file stored for this document alone before blobs is deleted by store_document, once the new one is stored
+        stored = CustomerDocument.objects.filter(pk=document.pk, upload_status='stored').values_list('file', flat=True).first()
+        if stored:
+            document.replaced_file = stored
+    extension = os.path.splitext(upload.name)[1]
+    hashing = HashingFile(upload, upload.name)
+    document.spooled_name = spool_storage().save(f"{uuid.uuid4().hex}{extension}", hashing)
+    document.content_hash = hashing.sha256.hexdigest()
+    document.file = upload.name  # a plain name: nothing is uploaded when the document is saved
+    document.upload_status = 'processing'
+    document.upload_attempts = 0
+    document.upload_error = ""
+
+
+def queue_document_uploads(document_ids):
+    """Pushes spooled documents to storage in the background, once the transaction saving them has committed"""
+    document_ids = list(document_ids)
+
+    def queue():
+        for document_id in document_ids:
+            run_in_background(store_document, document_id)
+
+    transaction.on_commit(queue)
+
+
+def store_document(document_id):
+    """
+        Background job: stores the spooled upload of a document & marks the document stored. Returns True once the
+        document points to its stored file.
+
+        - the file is stored once per content (DocumentBlob): when a blob with the same SHA-256 exists the document
+          just references it & nothing is uploaded
+        - failed uploads are retried up to DOCUMENT_UPLOAD_ATTEMPTS times, waiting DOCUMENT_UPLOAD_RETRY_DELAY seconds
+          before the 2nd attempt (doubled before each next one)
+        - when every attempt failed the document is marked failed & the spooled file is kept, so the
+          store_spooled_documents command can try again
+        - the document is only updated if it still waits for this upload (not deleted, no newer file uploaded since);
+          the blob & preview of a replaced file are released (a file of its own from before blobs is deleted)
+        - the preview of the new file is rendered by another background job
+    """
+    document = CustomerDocument.objects.filter(pk=document_id).exclude(spooled_name="").first()
+    if document is None or document.upload_status == 'stored':
+        return False
+    spooled_name = document.spooled_name
+    pending = CustomerDocument.objects.filter(pk=document.pk, spooled_name=spooled_name)
+    spool = spool_storage()
+
+    def update_pending(**fields):
+        # the upload status is shown on the customer's profile: its cached pages are outdated
+        updated = pending.update(**fields)
+        bump_profile_version([document.customer_id])
+        return updated
+
+    try:
+        if not document.content_hash:
+            # spooled before uploads were hashed
+            with spool.open(spooled_name, "rb") as spooled:
+                document.content_hash = file_sha256(spooled)
+        blob = reference_blob(document.content_hash)
+    except FileNotFoundError:
+        update_pending(upload_status='failed', upload_error="The uploaded file is no longer in the spool.")
+        return False
+
+    attempt = 0
+    while blob is None and attempt < settings.DOCUMENT_UPLOAD_ATTEMPTS:
+        attempt += 1
+        try:
+            blob = upload_blob(spool, spooled_name, document.content_hash)
+        except FileNotFoundError:
+            update_pending(upload_status='failed', upload_error="The uploaded file is no longer in the spool.")
+            return False
+        except Exception as e:
+            logger.warning("Upload of document %s failed (attempt %s): %s", document.pk, attempt, e)
+            update_pending(upload_attempts=F('upload_attempts') + 1, upload_error=str(e))
+            if attempt < settings.DOCUMENT_UPLOAD_ATTEMPTS:
+                time.sleep(settings.DOCUMENT_UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+
+    if blob is None:
+        update_pending(upload_status='failed')
+        return False
+
+    with transaction.atomic():
+        stored = update_pending(
+            file=blob.file.name, blob=blob, content_hash=document.content_hash, upload_status='stored', spooled_name="",
+            upload_attempts=F('upload_attempts') + 1, upload_error="", stored_at=timezone.now(), preview="",
+            replaced_file="",
+        )
+        # deleted or replaced while it was uploading: the reference taken belongs to nothing - otherwise the blob of
+        # the replaced file loses a reference
+        release_blob(blob.pk if not stored else document.blob_id)
+        if stored:
+            release_preview(document.preview.name)
+            queue_document_previews([document.pk])
+            delete_replaced_file(document)
+    if stored:
+        spool.delete(spooled_name)
+    return bool(stored)
+
+
+def reference_blob(content_hash):
+    """Takes a reference to the stored blob with this content, if there is one (None otherwise)"""
+    blob = DocumentBlob.objects.filter(sha256=content_hash).first()
+    # a single UPDATE: the blob may be deleted by its last document in between, then it has to be uploaded again
+    if blob is None or not DocumentBlob.objects.filter(pk=blob.pk).update(reference_count=F('reference_count') + 1):
+        return None
+    return blob
+
+
+def upload_blob(spool, spooled_name, content_hash):
+    """Uploads a spooled file to the document storage as the blob of its content & returns it (with a reference taken)"""
+    blob = DocumentBlob(sha256=content_hash, reference_count=1)
+    with spool.open(spooled_name, "rb") as spooled:
+        extension = os.path.splitext(spooled_name)[1]
+        blob.file.save(f"{content_hash}{extension}", File(spooled), save=False)
+        blob.size = blob.file.size
+    try:
+        with transaction.atomic():
+            blob.save()
+    except IntegrityError:
+        # another job stored the same content at the same time - use theirs
+        blob.file.storage.delete(blob.file.name)
+        return reference_blob(content_hash)
+    return blob
+
+
+def release_blob(blob_id):
+    """
+        Drops a reference to a blob (a document was deleted or its file replaced). The last reference deletes the blob
+        (django-cleanup deletes its stored file once the transaction committed).
+    """
+    if blob_id is None:
+        return
+    DocumentBlob.objects.filter(pk=blob_id).update(reference_count=F('reference_count') - 1)
+    # only matches while nothing referenced the blob again in between
+    DocumentBlob.objects.filter(pk=blob_id, reference_count__lte=0).delete()
+
+
+def delete_replaced_file(document):
+    """Deletes the file of its own a document had before blobs (replaced_file) once the transaction committed"""
+    if document.replaced_file:
+        name, storage = document.replaced_file, document.file.storage
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+def release_document_file(document):
+    """
+        A deleted document no longer uses its stored file: drops its reference to the shared blob. A document stored
+        before blobs has a file of its own, deleted once the transaction committed (django-cleanup ignores documents) -
+        also when it was deleted while the upload replacing that file was processing.
+        Its preview goes too, unless another document with the same content shows it.
+    """
+    release_preview(document.preview.name)
+    delete_replaced_file(document)
+    if document.blob_id:
+        release_blob(document.blob_id)
+    elif document.is_stored and document.file:
+        name, storage = document.file.name, document.file.storage
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+def pending_documents(stuck_after=None, failed=False):
+    """
+        Documents whose spooled upload should be pushed again: 'processing' for more than stuck_after seconds (the
+        process running their job was restarted) &, with failed=True, the documents whose every attempt failed
+    """
+    stuck_after = settings.DOCUMENT_UPLOAD_STUCK_AFTER if stuck_after is None else stuck_after
+    documents = CustomerDocument.objects.exclude(spooled_name="")
+    statuses = ['processing', 'failed'] if failed else ['processing']
+    return documents.filter(upload_status__in=statuses, created_at__lt=timezone.now() - timedelta(seconds=stuck_after))
+
+
+def clear_orphaned_spool_files(max_age=None):
+    """Deletes spooled files no document points to (their transaction was rolled back) older than max_age seconds"""
+    storage = spool_storage()
+    if not os.path.isdir(storage.location):
+        return 0
+    cutoff = time.time() - (settings.SIGNUP_STAGING_MAX_AGE if max_age is None else max_age)
+    names = [name for name in storage.listdir("")[1] if os.path.getmtime(storage.path(name)) < cutoff]
+    in_use = set(CustomerDocument.objects.filter(spooled_name__in=names).values_list('spooled_name', flat=True))
+    for name in names:
+        if name not in in_use:
+            storage.delete(name)
+    return len(names) - len(in_use)
+
+
+def document_zip_members(documents):
+    """
+        Members of a zip archive of documents (for streaming.stream_zip): (name in the archive, chunks of the file).
+
+        - documents are filed in a folder per customer, under the name they are shown with (a name used twice in a
+          folder is numbered)
+        - files are opened one at a time, when the archive gets to them, & read from storage in chunks
+        - documents not stored yet & files missing from storage are left out
+    """
+    used_names = set()
+    for document in documents:
+        if not document.is_stored or not document.file:
+            continue
+        try:
+            file = document.file.storage.open(document.file.name, "rb")
+        except FileNotFoundError:
+            logger.warning("Document %s left out of the zip: %s is not in storage", document.pk, document.file.name)
+            continue
+
+        folder = get_valid_filename(document.customer.display_name) or f"customer-{document.customer_id}"
+        base, extension = os.path.splitext(document.display_name)
+        name, number = f"{folder}/{base}{extension}", 1
+        while name in used_names:
+            number += 1
+            name = f"{folder}/{base} ({number}){extension}"
+        used_names.add(name)
+
+        with file:
+            yield name, file.chunks()
+
+
+# ------------------------- DOWNLOADS: byte ranges of a stored file -------------------------
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(header, size):
+    """
+        The (start, end) bytes (end included) a Range header asks for out of a file of size bytes.
+
+        - None when the whole file should be sent: no header, a malformed one or several ranges (servers may ignore them)
+        - "bytes=500-" is from byte 500 to the end, "bytes=-500" the last 500 bytes
+        - raises ValueError when the range is outside the file (416 Range Not Satisfiable)
+    """
+    match = BYTE_RANGE.match((header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if not start:
+        # a suffix: the last bytes of the file
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError("Empty range")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError("Range starts after the end of the file")
+    return start, size - 1 if not end else min(int(end), size - 1)
+
+
+class FileRange:
+    """File-like object reading only bytes start-end (included) of an open file - what FileResponse streams for a range"""
+    def __init__(self, file, start, end):
+        self.file = file
+        self.remaining = end - start + 1
+        file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
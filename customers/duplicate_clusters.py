@@ -0,0 +1,285 @@
+import csv
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import combinations, groupby, islice
+
+from .matching import LIKELY_DUPLICATE_SCORE, MATCH_LABELS, MATCH_WEIGHTS, match_score
+
+# customers whose key sets are sent to a worker at a time (a chunk of blocks is scored by one pool task)
+DUPLICATE_CHUNK_SIZE = 2000
+
+# blocks (customers sharing a key) with more customers than this are not paired up - a common name's soundex or a
+# shared office address would add millions of pairs that the other keys tell apart anyway
+MAX_BLOCK_SIZE = 50
+
+# (customer id, key) rows fetched from the database at a time while the blocks are streamed
+KEY_ROWS_CHUNK_SIZE = 5000
+
+# customers whose names are read at a time while the report is written
+REPORT_BATCH_SIZE = 2000
+
+# columns of the duplicate cluster report - one line per customer, grouped by cluster
+DUPLICATE_REPORT_COLUMNS = [
+    "Cluster", "Cluster Size", "Customer ID", "First Name", "Last Name", "Customer Type", "Created",
+    "Best Match", "Score", "Matched On",
+]
+
+
+@dataclass
+class ClusterRunStats:
+    """Outcome & throughput of a duplicate clustering run"""
+    customers: int = 0
+    blocks: int = 0
+    skipped_blocks: int = 0
+    pairs: int = 0
+    matches: int = 0
+    clusters: int = 0
+    clustered: int = 0
+    seconds: float = 0.0
+
+    @property
+    def customers_per_minute(self):
+        return self.customers / self.seconds * 60 if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.clusters} clusters of {self.clustered} customers ({self.matches} likely duplicate pairs of "
+            f"{self.pairs} candidate pairs in {self.blocks} blocks, {self.skipped_blocks} oversized blocks skipped) "
+            f"in {self.seconds:.2f}s ({self.customers_per_minute:.0f} customers/min)"
+        )
+
+
+class UnionFind:
+    """
+        Disjoint sets of customer ids, joined pair by pair. Only the ids that were joined to another one are stored, so
+        memory grows with the number of duplicates, not with the number of customers.
+    """
+
+    def __init__(self):
+        self.parents = {}
+        self.sizes = {}
+
+    def find(self, item):
+        """Returns the root of the set of an item (halving the path to it on the way)"""
+        parents = self.parents
+        parents.setdefault(item, item)
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, first, second):
+        """Joins the sets of two items - the smaller set is hung under the root of the larger one"""
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return
+        if self.sizes.get(first, 1) < self.sizes.get(second, 1):
+            first, second = second, first
+        self.parents[second] = first
+        self.sizes[first] = self.sizes.get(first, 1) + self.sizes.pop(second, 1)
+
+    def groups(self):
+        """Returns the sets as lists of items"""
+        groups = defaultdict(list)
+        for item in self.parents:
+            groups[self.find(item)].append(item)
+        return list(groups.values())
+
+
+def _pair_source(first_keys, second_keys, oversized):
+    """
+        The (kind, key) block a pair of customers is scored in & the kinds of keys they share. A pair sharing several
+        keys is in several blocks - it is only scored in the first one (in MATCH_WEIGHTS order, then key order) that
+        isn't oversized, so every pair is scored once without a set of the pairs seen so far.
+    """
+    source = None
+    kinds = []
+    for kind in MATCH_WEIGHTS:
+        shared = first_keys[kind] & second_keys[kind]
+        if not shared:
+            continue
+        kinds.append(kind)
+        if source is None:
+            keys = sorted(shared - oversized[kind])
+            if keys:
+                source = (kind, keys[0])
+    # the same name is also a similar name - only the stronger match is kept
+    if "name" in kinds and "phonetic" in kinds:
+        kinds.remove("phonetic")
+    return source, kinds
+
+
+def score_candidate_blocks(blocks, key_sets, oversized, min_score):
+    """
+        Process pool task: scores every pair of customers in a chunk of blocks. Returns the number of pairs scored &
+        the (customer id, customer id, score, kinds) of the pairs scoring min_score or more.
+
+        - blocks: (kind, key, customer ids) of customers sharing a key
+        - key_sets: {customer id: {kind: set of keys}} of every customer in the blocks
+        - oversized: {kind: set of keys} of the blocks that were skipped
+    """
+    pairs = 0
+    matches = []
+    for kind, key, customer_ids in blocks:
+        for first, second in combinations(customer_ids, 2):
+            source, kinds = _pair_source(key_sets[first], key_sets[second], oversized)
+            if source != (kind, key):
+                continue
+            pairs += 1
+            score = match_score(kinds)
+            if score >= min_score:
+                matches.append((first, second, score, kinds))
+    return pairs, matches
+
+
+def oversized_keys(max_block_size=MAX_BLOCK_SIZE):
+    """{kind: set of keys} shared by more than max_block_size customers - one group by per kind on its indexed column"""
+    # imported here so worker processes can import this module for scoring without setting up django
+    from django.db.models import Count
+    from .duplicates import key_queryset
+
+    oversized = {}
+    for kind in MATCH_WEIGHTS:
+        rows, customer_column, key_column = key_queryset(kind)
+        oversized[kind] = set(
+            rows.order_by().values(key_column)
+            .annotate(customers=Count(customer_column, distinct=True))
+            .filter(customers__gt=max_block_size)
+            .values_list(key_column, flat=True)
+        )
+    return oversized
+
+
+def candidate_blocks(kind, oversized):
+    """
+        Generator that yields (kind, key, customer ids) for every key of a kind shared by 2 or more customers.
+        The (customer id, key) rows are streamed in key order, so only one block is held in memory at a time.
+    """
+    from .duplicates import key_queryset
+
+    rows, customer_column, key_column = key_queryset(kind)
+    rows = rows.order_by(key_column).values_list(key_column, customer_column).iterator(chunk_size=KEY_ROWS_CHUNK_SIZE)
+    for key, block in groupby(rows, key=lambda row: row[0]):
+        if not key or key in oversized[kind]:
+            continue
+        customer_ids = sorted({customer_id for _, customer_id in block})
+        if len(customer_ids) > 1:
+            yield kind, key, customer_ids
+
+
+def customer_key_sets(customer_ids):
+    """{customer id: {kind: set of keys}} of customers - one query per kind of key"""
+    from .duplicates import key_queryset
+
+    key_sets = {customer_id: {kind: set() for kind in MATCH_WEIGHTS} for customer_id in customer_ids}
+    for kind in MATCH_WEIGHTS:
+        rows, customer_column, key_column = key_queryset(kind)
+        for customer_id, key in rows.filter(**{f"{customer_column}__in": customer_ids}).values_list(customer_column, key_column):
+            if key:
+                key_sets[customer_id][kind].add(key)
+    return key_sets
+
+
+def block_chunks(oversized, stats, chunk_size=DUPLICATE_CHUNK_SIZE):
+    """
+        Generator that yields (blocks, key sets) of the blocks of every kind of key, split into chunks of about
+        chunk_size customers. Counts the blocks (& the oversized ones that were left out) in stats.
+    """
+    stats.skipped_blocks = sum(len(keys) for keys in oversized.values())
+    blocks = []
+    customer_ids = set()
+    for kind in MATCH_WEIGHTS:
+        for block in candidate_blocks(kind, oversized):
+            stats.blocks += 1
+            blocks.append(block)
+            customer_ids.update(block[2])
+            if len(customer_ids) >= chunk_size:
+                yield blocks, customer_key_sets(customer_ids)
+                blocks = []
+                customer_ids = set()
+    if blocks:
+        yield blocks, customer_key_sets(customer_ids)
+
+
+def find_duplicate_clusters(
+    min_score=LIKELY_DUPLICATE_SCORE, workers=1, chunk_size=DUPLICATE_CHUNK_SIZE, max_block_size=MAX_BLOCK_SIZE,
+):
+    """
+        Groups the customers that are likely duplicates of each other into clusters. Returns (clusters, best links,
+        ClusterRunStats): the clusters are lists of customer ids (largest first), the best links are
+        {customer id: (score, customer id, kinds)} - the strongest match of every clustered customer.
+
+        - candidate pairs come from the blocking keys: only customers sharing a key are compared, never every customer
+          with every other one
+        - the pairs are scored by a pool of worker processes (workers=1 scores them in this process) - at most 2 chunks
+          per worker are waiting at a time, so memory is bounded however many customers there are
+        - the pairs scoring min_score or more are joined with union-find: A ~ B & B ~ C put A, B & C in one cluster
+    """
+    from .models import Customer
+
+    started = time.perf_counter()
+    stats = ClusterRunStats(customers=Customer.objects.count())
+    oversized = oversized_keys(max_block_size)
+    clusters = UnionFind()
+    links = {}
+
+    def add_matches(result):
+        pairs, matches = result
+        stats.pairs += pairs
+        stats.matches += len(matches)
+        for first, second, score, kinds in matches:
+            clusters.union(first, second)
+            for customer_id, other_id in ((first, second), (second, first)):
+                if customer_id not in links or links[customer_id][0] < score:
+                    links[customer_id] = (score, other_id, kinds)
+
+    chunks = block_chunks(oversized, stats, chunk_size)
+    if workers <= 1:
+        for blocks, key_sets in chunks:
+            add_matches(score_candidate_blocks(blocks, key_sets, oversized, min_score))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pending = []
+            for blocks, key_sets in chunks:
+                pending.append(pool.submit(score_candidate_blocks, blocks, key_sets, oversized, min_score))
+                # add the scored chunks as they come in - keeps the number of chunks held in memory bounded
+                while len(pending) >= workers * 2:
+                    add_matches(pending.pop(0).result())
+            for future in pending:
+                add_matches(future.result())
+
+    groups = sorted((sorted(group) for group in clusters.groups()), key=lambda group: (-len(group), group[0]))
+    stats.clusters = len(groups)
+    stats.clustered = sum(len(group) for group in groups)
+    stats.seconds = time.perf_counter() - started
+    return groups, links, stats
+
+
+def write_duplicate_report(clusters, links, output):
+    """
+        Writes the duplicate clusters to the file-like object output as a csv report to review: one line per customer
+        with their strongest match. The customers are read in batches, in the order of the report.
+    """
+    from .models import Customer
+
+    writer = csv.writer(output)
+    writer.writerow(DUPLICATE_REPORT_COLUMNS)
+    rows = ((number, len(cluster), customer_id) for number, cluster in enumerate(clusters, start=1) for customer_id in cluster)
+    while True:
+        batch = list(islice(rows, REPORT_BATCH_SIZE))
+        if not batch:
+            return
+        customers = Customer.objects.only('first_name', 'last_name', 'customer_type', 'created_at').in_bulk([row[2] for row in batch])
+        for number, size, customer_id in batch:
+            customer = customers.get(customer_id)
+            if customer is None:
+                continue
+            score, other_id, kinds = links[customer_id]
+            writer.writerow([
+                number, size, customer_id, customer.first_name, customer.last_name, customer.customer_type,
+                customer.created_at.date().isoformat(),
+                other_id, f"{score:.2f}", ", ".join(MATCH_LABELS[kind] for kind in kinds),
+            ])
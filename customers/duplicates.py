@@ -0,0 +1,137 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from django.db.models.functions import Lower
+
+from .addresses import normalize_address_key
+from .matching import (
+    LIKELY_DUPLICATE_SCORE,
+    MATCH_LABELS,
+    MATCH_WEIGHTS,
+    POSSIBLE_DUPLICATE_SCORE,
+    email_key,
+    match_score,
+    name_key,
+    phone_key,
+    phonetic_key,
+)
+from .models import Customer
+
+
+@dataclass
+class MatchKeys:
+    """The blocking keys of a (new) customer - the name keys & the keys of their phones, emails & addresses"""
+    name: str = ""
+    phonetic: str = ""
+    phones: set = field(default_factory=set)
+    emails: set = field(default_factory=set)
+    addresses: set = field(default_factory=set)
+
+    def key_sets(self):
+        """{kind: set of keys} - empty keys never match"""
+        return {
+            "name": {self.name} - {""},
+            "phonetic": {self.phonetic} - {""},
+            "phone": self.phones - {""},
+            "email": self.emails - {""},
+            "address": self.addresses - {""},
+        }
+
+
+@dataclass
+class DuplicateCandidate:
+    """An existing customer matching a new one: the score & the keys that matched"""
+    customer: Customer
+    score: float
+    reasons: list
+
+    @property
+    def reason_labels(self):
+        return ", ".join(MATCH_LABELS[reason] for reason in self.reasons)
+
+
+def match_keys(first_name, last_name="", phones=(), emails=(), addresses=()):
+    """
+        Returns the MatchKeys of a customer that isn't saved (yet).
+
+        - phones & emails: the numbers / addresses as typed in
+        - addresses: (street, city, state, zip code) tuples
+    """
+    normalized_name = name_key(first_name, last_name)
+    return MatchKeys(
+        name=normalized_name,
+        phonetic=phonetic_key(normalized_name),
+        phones={phone_key(phone) for phone in phones},
+        emails={email_key(email) for email in emails},
+        addresses={normalize_address_key(*address) for address in addresses},
+    )
+
+
+def key_queryset(kind):
+    """
+        Returns the rows holding the keys of a kind & the names of their customer id & key columns. The key columns are
+        indexed: the customer's name keys, Phone.phone_number, lowercased Email.email_address & Address.normalized_key.
+    """
+    if kind == "name":
+        return Customer.objects.all(), 'id', 'name_key'
+    if kind == "phonetic":
+        return Customer.objects.all(), 'id', 'phonetic_key'
+    if kind == "phone":
+        return Customer.phones.through.objects.all(), 'customer_id', 'phone__phone_number'
+    if kind == "email":
+        return Customer.emails.through.objects.annotate(email_key=Lower('email__email_address')), 'customer_id', 'email_key'
+    return Customer.addresses.through.objects.all(), 'customer_id', 'address__normalized_key'
+
+
+def _customers_by_key(kind, keys):
+    """{key: set of customer ids} of the existing customers with any of the keys of a kind - one indexed query"""
+    if not keys:
+        return {}
+    rows, customer_column, key_column = key_queryset(kind)
+    rows = rows.filter(**{f"{key_column}__in": keys}).values_list(customer_column, key_column)
+
+    customers_by_key = defaultdict(set)
+    for customer_id, key in rows:
+        customers_by_key[key].add(customer_id)
+    return customers_by_key
+
+
+def find_duplicates_for_many(keys_list, min_score=POSSIBLE_DUPLICATE_SCORE, limit=5):
+    """
+        Finds the existing customers that look like each of many new customers (a batch of an import).
+
+        - one indexed lookup per kind of key for the whole batch - no scan of the customer table, no query per customer
+        - returns a list (in the order of keys_list) of DuplicateCandidate lists, best match first
+    """
+    key_sets = [keys.key_sets() for keys in keys_list]
+    lookups = {
+        kind: _customers_by_key(kind, set().union(*(sets[kind] for sets in key_sets)))
+        for kind in MATCH_WEIGHTS
+    }
+
+    matches = []
+    for sets in key_sets:
+        reasons = defaultdict(list)
+        for kind, keys in sets.items():
+            for key in keys:
+                for customer_id in lookups[kind].get(key, ()):
+                    if kind not in reasons[customer_id]:
+                        reasons[customer_id].append(kind)
+        for kinds in reasons.values():
+            # the same name is also a similar name - only the stronger match is kept
+            if "name" in kinds and "phonetic" in kinds:
+                kinds.remove("phonetic")
+        scores = {customer_id: match_score(kinds) for customer_id, kinds in reasons.items()}
+        best = sorted((customer_id for customer_id, score in scores.items() if score >= min_score), key=lambda customer_id: -scores[customer_id])
+        matches.append([(customer_id, scores[customer_id], reasons[customer_id]) for customer_id in best[:limit]])
+
+    customers = Customer.objects.in_bulk({customer_id for found in matches for customer_id, _, _ in found})
+    return [
+        [DuplicateCandidate(customers[customer_id], score, kinds) for customer_id, score, kinds in found]
+        for found in matches
+    ]
+
+
+def find_duplicates(keys, min_score=POSSIBLE_DUPLICATE_SCORE, limit=5):
+    """Returns the existing customers that look like a new customer (MatchKeys) as DuplicateCandidates, best match first"""
+    return find_duplicates_for_many([keys], min_score=min_score, limit=limit)[0]
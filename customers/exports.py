@@ -0,0 +1,76 @@
+from django.db.models import Prefetch
+
+from .labels import label_name
+from .models import Address, Customer, Email, Phone
+
+# columns of mailing list / customer exports (csv & excel)
+EXPORT_COLUMNS = ["Name", "Customer Type", "Street", "City", "State", "Zip Code", "Preferred Email", "Primary Phone"]
+
+# number of rows pulled from the db per round trip while exporting
+EXPORT_CHUNK_SIZE = 2000
+
+
+def contact_prefetches():
+    """Prefetches of the preferred emails & primary phones of customers (one query each per chunk of customers)"""
+    return [
+        Prefetch('emails', queryset=Email.objects.filter(preferred_email=True).order_by('id'), to_attr='export_emails'),
+        Prefetch('phones', queryset=Phone.objects.filter(is_primary=True).order_by('id'), to_attr='export_phones'),
+    ]
+
+
+def export_row(customer, address=None):
+    """Returns the export row of a customer & their mailing address (blank address columns when there is none)"""
+    email = customer.export_emails[0].email_address if customer.export_emails else ""
+    phone = customer.export_phones[0].phone_number if customer.export_phones else ""
+
+    return (
+        label_name(customer.first_name, customer.last_name, customer.customer_type),
+        customer.get_customer_type_display(),
+        (address.street or "") if address else "",
+        address.city if address else "",
+        address.state if address else "",
+        address.zip_code if address else "",
+        email,
+        phone,
+    )
+
+
+def mailing_list_export_rows(mailing_list, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+        Generator that yields an export row for every labelled address of a mailing list - the same addresses & customer
+        names as the printed labels (the newest customer linked to the address).
+
+        - addresses are streamed in chunks from one query (.iterator), their customers, emails & phones are
+          prefetched per chunk: each chunk is read from the streamed query plus 3 prefetch queries (4 in all), however
+          many addresses the list has
+    """
+    label_customers = Customer.objects.order_by('-created_at').prefetch_related(*contact_prefetches())
+    addresses = (
+        Address.objects.filter(mailing_addresses=mailing_list)
+        .order_by('id')
+        .prefetch_related(Prefetch('customer_addresses', queryset=label_customers, to_attr='export_customers'))
+    )
+
+    for address in addresses.iterator(chunk_size=chunk_size):
+        # addresses without any customer are skipped (as on the labels)
+        if address.export_customers:
+            yield export_row(address.export_customers[0], address)
+
+
+def customer_export_rows(customers, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+        Generator that yields an export row for every customer in a (filtered) customer queryset, with their first
+        mailing address.
+
+        - customers are streamed in chunks from one query (.iterator), their addresses, emails & phones are
+          prefetched per chunk: each chunk is read from the streamed query plus 3 prefetch queries (4 in all), however
+          many customers are exported
+    """
+    mailing_addresses = Address.objects.filter(mailing_address=True).order_by('id')
+    customers = customers.order_by('id').prefetch_related(
+        Prefetch('addresses', queryset=mailing_addresses, to_attr='export_addresses'),
+        *contact_prefetches(),
+    )
+
+    for customer in customers.iterator(chunk_size=chunk_size):
+        yield export_row(customer, customer.export_addresses[0] if customer.export_addresses else None)
@@ -1,10 +1,15 @@
 
 from django.forms import ModelForm
+import re
 
 
 from django import forms
+from django.core.validators import FileExtensionValidator
 from .models import * 
 from .models import CustomerMailingList, CustomerNoteHistory, CustomerDocumentHistory
+from .mailing_lists import LIST_OPERATIONS, combine_mailing_lists, refresh_dynamic_list
+from .merges import merge_customers
+from .previews import release_preview
 from django.urls import reverse
 
 class CreateCustomerForm(ModelForm):  
@@ -113,11 +118,15 @@ class CreateDocumentForm(forms.ModelForm):
                 original_instance.file_detail != instance.file_detail):
                 CustomerDocumentHistory.objects.create(
                     document=instance,
-                    previous_file_name=original_instance.file,
+                    previous_file_name=original_instance.display_name,
                     previous_file_type=original_instance.file_type,
                     previous_file_detail=original_instance.file_detail,
                     edited_by=self.request_user
                 )
+                # the preview is rendered again (from the cached one if the file did not change)
+                instance.preview = ""
+                if original_instance.file != instance.file:
+                    release_preview(original_instance.preview.name)
         if commit:
             instance.save()
         return instance
@@ -134,18 +143,12 @@ class CreateNoteForm(ModelForm):
         self.request_user = kwargs.pop('user', None) # get user from view
         super().__init__(*args, **kwargs)
     
-    # save the history of the note edit if the new version is NOT equal to the old version of the note    
+    # the edit is saved in the note's history if the new version is NOT equal to the old version of the note
     def save(self, commit=True):
         instance = super().save(commit=False)
         
-        if instance.pk:
-            original_instance = CustomerNote.objects.get(pk=instance.pk)
-            if original_instance.note != instance.note:
-                CustomerNoteHistory.objects.create(
-                    customer_note =instance,
-                    previous_note = original_instance.note,
-                    edited_by = self.request_user
-                )
+        # the previous version is recorded in the history when the note is saved (CustomerNote.save)
+        instance.editor = self.request_user
         if commit:
             instance.save()
         return instance
@@ -175,6 +178,161 @@ class CreateCustomerMailingListForm(ModelForm):
 
         }
 
+class CombineMailingListsForm(ModelForm):
+    """
+        Creates a new mailing list from the union, intersection or difference of mailing lists and/or interests.
+        The new list starts with one list or interest (base) that is combined with the others.
+    """
+    operation = forms.ChoiceField(choices=LIST_OPERATIONS.items(), initial="union", widget=forms.RadioSelect)
+    base = forms.ChoiceField(label="Start with")
+    others = forms.MultipleChoiceField(label="Combine with", widget=forms.CheckboxSelectMultiple(attrs={'class': 'checkbox-buttons'}))
+
+    class Meta:
+        model = CustomerMailingList
+        fields = ['name']
+        widgets = {
+            'name': forms.TextInput(attrs={'placeholder': 'Tree Sale Not Fish Sale'}),
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # operands are picked as 'list-<id>' or 'interest-<id>'
+        choices = [
+            ("Mailing Lists", [(f"list-{pk}", name) for pk, name in CustomerMailingList.objects.order_by('name').values_list('pk', 'name')]),
+            ("Interests", [(f"interest-{pk}", name) for pk, name in CustomerInterest.objects.order_by('name').values_list('pk', 'name')]),
+        ]
+        self.fields['base'].choices = choices
+        self.fields['others'].choices = choices
+
+    def clean(self):
+        """Turns the picked choices into the mailing lists & interests to combine (base first)"""
+        cleaned_data = super().clean()
+        base, others = cleaned_data.get('base'), cleaned_data.get('others') or []
+        if not base:
+            return cleaned_data
+        if base in others:
+            raise forms.ValidationError("The list or interest to start with can't also be combined with itself.")
+
+        keys = [base, *others]
+        ids = {"list": [], "interest": []}
+        for key in keys:
+            kind, pk = key.split("-")
+            ids[kind].append(int(pk))
+        found = {
+            **{f"list-{item.pk}": item for item in CustomerMailingList.objects.filter(pk__in=ids["list"])},
+            **{f"interest-{item.pk}": item for item in CustomerInterest.objects.filter(pk__in=ids["interest"])},
+        }
+        cleaned_data['operands'] = [found[key] for key in keys if key in found]
+        return cleaned_data
+
+    def save(self, commit=True):
+        """Creates the combined mailing list (always saved - the members are copied in the database)"""
+        return combine_mailing_lists(self.cleaned_data['name'], self.cleaned_data['operation'], self.cleaned_data['operands'])
+
+class DynamicMailingListForm(ModelForm):
+    """
+        Creates / edits a dynamic mailing list: its members come from a rule (stored as json on the list) instead of
+        being picked - every active customer matching all of the filters filled in, at their matching mailing addresses.
+    """
+    interests = forms.ModelMultipleChoiceField(queryset=CustomerInterest.objects.all(), to_field_name='slug', required=False, widget=forms.CheckboxSelectMultiple(attrs={'class': 'checkbox-buttons'}))
+    customer_types = forms.MultipleChoiceField(choices=Customer.CUSTOMER_CHOICES, required=False, widget=forms.CheckboxSelectMultiple)
+    states = forms.CharField(required=False, help_text="Comma separated state abbreviations: OH, PA")
+    zip_prefixes = forms.CharField(required=False, label="Zip codes", help_text="Comma separated zip codes or their first digits: 447, 44092")
+    created_after = forms.DateField(required=False, label="Customers added from", widget=forms.DateInput(attrs={'type': 'date'}))
+    created_before = forms.DateField(required=False, label="Customers added until", widget=forms.DateInput(attrs={'type': 'date'}))
+
+    class Meta:
+        model = CustomerMailingList
+        fields = ['name']
+        widgets = {
+            'name': forms.TextInput(attrs={'placeholder': 'Ohio Farms'}),
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # fills the filters in with the rule of the list being edited
+        rule = self.instance.rule or {}
+        for key in ['interests', 'customer_types', 'created_after', 'created_before']:
+            self.fields[key].initial = rule.get(key)
+        self.fields['states'].initial = ", ".join(rule.get('states', []))
+        self.fields['zip_prefixes'].initial = ", ".join(rule.get('zip_prefixes', []))
+
+    def clean_states(self):
+        states = [state.strip().upper() for state in self.cleaned_data['states'].split(",") if state.strip()]
+        if any(not re.fullmatch(r"[A-Z]{2}", state) for state in states):
+            raise forms.ValidationError("Enter 2 letter state abbreviations separated by commas.")
+        return states
+
+    def clean_zip_prefixes(self):
+        prefixes = [prefix.strip() for prefix in self.cleaned_data['zip_prefixes'].split(",") if prefix.strip()]
+        if any(not re.fullmatch(r"\d{1,5}", prefix) for prefix in prefixes):
+            raise forms.ValidationError("Enter zip codes (or their first 1 to 4 digits) separated by commas.")
+        return prefixes
+
+    def clean(self):
+        cleaned_data = super().clean()
+        created_after, created_before = cleaned_data.get('created_after'), cleaned_data.get('created_before')
+        if created_after and created_before and created_after > created_before:
+            raise forms.ValidationError("The 'added from' date must be before the 'added until' date.")
+        return cleaned_data
+
+    def save(self, commit=True):
+        """Saves the rule & materializes the members of the list straight away"""
+        data = self.cleaned_data
+        mailing_list = super().save(commit=False)
+        mailing_list.is_dynamic = True
+        mailing_list.rule = {
+            'interests': [interest.slug for interest in data['interests']],
+            'customer_types': data['customer_types'],
+            'states': data['states'],
+            'zip_prefixes': data['zip_prefixes'],
+            'created_after': data['created_after'].isoformat() if data['created_after'] else None,
+            'created_before': data['created_before'].isoformat() if data['created_before'] else None,
+        }
+        mailing_list.save()
+        refresh_dynamic_list(mailing_list)
+        return mailing_list
+
+class CustomerImportForm(forms.Form):
+    """Upload of a csv / excel file of customers to import (customers.imports)"""
+    file = forms.FileField(
+        label="Customer File (.csv or .xlsx)",
+        validators=[FileExtensionValidator(allowed_extensions=['csv', 'xlsx'])],
+        widget=forms.ClearableFileInput(attrs={'accept': '.csv,.xlsx'}),
+    )
+    allow_duplicates = forms.BooleanField(
+        required=False,
+        label="Import likely duplicates of existing customers",
+        widget=forms.CheckboxInput(attrs={'class': 'custom-checkbox'}),
+    )
+
+class CustomerMergeForm(forms.Form):
+    """
+        Picks the duplicate of a customer to merge into them (customers.merges): the duplicate's contacts, notes,
+        documents, relationships & mailing lists move to the customer & the duplicate is deleted.
+    """
+    duplicate = forms.IntegerField(
+        label="Customer ID of the duplicate",
+        min_value=1,
+        widget=forms.NumberInput(attrs={'placeholder': '1234'}),
+    )
+
+    def __init__(self, *args, customer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.customer = customer
+
+    def clean_duplicate(self):
+        duplicate = Customer.objects.filter(pk=self.cleaned_data['duplicate']).first()
+        if duplicate is None:
+            raise forms.ValidationError("There is no customer with this ID.")
+        if duplicate.pk == self.customer.pk:
+            raise forms.ValidationError("A customer can't be merged with itself.")
+        return duplicate
+
+    def save(self, user=None):
+        """Merges the duplicate into the customer & returns the MergeResult"""
+        return merge_customers(self.customer, self.cleaned_data['duplicate'], user=user)
+
 # Form for toggling the is_inactive field
 class ToggleInactiveForm(ModelForm):
     class Meta:
@@ -0,0 +1,496 @@
+import csv
+import os
+import re
+import time
+import zipfile
+from collections import defaultdict
+from dataclasses import dataclass, field
+from xml.etree.ElementTree import iterparse
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .addresses import normalize_address_key
+from .duplicates import LIKELY_DUPLICATE_SCORE, MATCH_LABELS, find_duplicates_for_many, match_keys, match_score
+from .forms import CreateAddressForm, CreateCustomerForm, CreateEmailForm, CreatePhoneForm
+from .mailing_lists import add_to_interest_lists
+from .models import Address, ContactMethod, Customer, CustomerInterest, Email, Phone
+
+# columns of a customer import file (csv or excel) - only first_name & customer_type are required, the address,
+# phone & email are saved when their first column is filled in
+IMPORT_COLUMNS = [
+    "first_name", "last_name", "customer_type", "interests", "contact_methods",
+    "street", "city", "state", "zip_code", "mailing_address",
+    "phone_number", "extension", "phone_type",
+    "email_address", "email_type",
+]
+ADDRESS_COLUMNS = ["street", "city", "state", "zip_code"]
+
+# columns of the report of the rows that were not imported
+IMPORT_REPORT_COLUMNS = ["Row", "Column", "Error"]
+
+# rows validated & saved per transaction (one bulk insert per table per batch)
+IMPORT_BATCH_SIZE = 500
+
+# cell values read as 'no' (interests & contact methods are separated by ; or ,)
+FALSE_VALUES = {"0", "n", "no", "false", "f"}
+_LIST_SEPARATOR = re.compile(r"[;,]")
+
+
+class ImportFileError(Exception):
+    """The import file can't be read (unknown file type, not a spreadsheet, no first_name / customer_type column)"""
+
+
+# ------------------------- READING: csv & xlsx files streamed one row at a time -------------------------
+def header_key(value):
+    """Column name of a header cell: 'First Name' -> 'first_name'"""
+    return re.sub(r"[\s-]+", "_", str(value or "").strip().lower())
+
+
+def read_csv_rows(path):
+    """Generator that yields the rows of a csv file (lists of strings) - the header first"""
+    # utf-8-sig drops the byte order mark Excel puts in front of csv files
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        yield from csv.reader(file)
+
+
+_XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+
+def _column_index(reference):
+    """0-based column of a cell reference: 'A1' -> 0, 'AB12' -> 27"""
+    index = 0
+    for letter in re.match(r"[A-Z]*", reference or "").group():
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def _xlsx_text(element):
+    """Text of a shared / inline string (rich text is split into runs)"""
+    return "".join(node.text or "" for node in element.iter(f"{_XLSX_NS}t"))
+
+
+def _first_sheet(archive):
+    """Path of the first worksheet of a workbook in the archive"""
+    with archive.open("xl/workbook.xml") as workbook:
+        relation_id = next(
+            (element.get(f"{_XLSX_REL_NS}id") for _, element in iterparse(workbook) if element.tag == f"{_XLSX_NS}sheet"), None
+        )
+    if relation_id is None:
+        raise ImportFileError("The workbook has no sheets.")
+
+    with archive.open("xl/_rels/workbook.xml.rels") as relations:
+        for _, element in iterparse(relations):
+            if element.get("Id") == relation_id:
+                target = element.get("Target").lstrip("/")
+                return target if target.startswith("xl/") else f"xl/{target}"
+    raise ImportFileError("The first sheet of the workbook is missing.")
+
+
+def read_xlsx_rows(path):
+    """
+        Generator that yields the rows of the first sheet of an Excel workbook (lists of strings) - the header first.
+
+        - the sheet xml is parsed as it is unzipped & every row is dropped once it is read: memory holds one row
+          (& the workbook's shared strings) whatever the size of the sheet - no spreadsheet library
+        - numbers are read as they are stored ('44718', '3306742811'), empty cells as ''
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        raise ImportFileError("The file is not an Excel (.xlsx) workbook.")
+    if "xl/workbook.xml" not in archive.namelist():
+        archive.close()
+        raise ImportFileError("The file is not an Excel (.xlsx) workbook.")
+
+    with archive:
+        shared_strings = []
+        if "xl/sharedStrings.xml" in archive.namelist():
+            with archive.open("xl/sharedStrings.xml") as strings:
+                for _, element in iterparse(strings):
+                    if element.tag == f"{_XLSX_NS}si":
+                        shared_strings.append(_xlsx_text(element))
+                        element.clear()
+
+        with archive.open(_first_sheet(archive)) as sheet:
+            sheet_data = None
+            for event, element in iterparse(sheet, events=("start", "end")):
+                if event == "start":
+                    if element.tag == f"{_XLSX_NS}sheetData":
+                        sheet_data = element
+                    continue
+                if element.tag != f"{_XLSX_NS}row":
+                    continue
+
+                row = []
+                for cell in element.iter(f"{_XLSX_NS}c"):
+                    index = _column_index(cell.get("r"))
+                    if index < 0:
+                        index = len(row)
+                    row.extend([""] * (index + 1 - len(row)))
+
+                    cell_type, value = cell.get("t"), cell.find(f"{_XLSX_NS}v")
+                    if cell_type == "inlineStr":
+                        row[index] = _xlsx_text(cell)
+                    elif value is None or value.text is None:
+                        continue
+                    elif cell_type == "s":
+                        row[index] = shared_strings[int(value.text)]
+                    else:
+                        text = value.text
+                        # whole numbers saved as floats (44718.0) are read as typed
+                        row[index] = text[:-2] if cell_type is None and text.endswith(".0") else text
+                yield row
+
+                # the row has been read - drop it so the parsed tree never grows
+                if sheet_data is not None:
+                    sheet_data.remove(element)
+
+
+def read_import_rows(path):
+    """
+        Generator that yields every row of a csv / xlsx import file as a {column: value} dict (after the header).
+        Unknown columns are ignored, missing ones are blank.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        rows = read_csv_rows(path)
+    elif extension == ".xlsx":
+        rows = read_xlsx_rows(path)
+    else:
+        raise ImportFileError("Only .csv & .xlsx files can be imported.")
+
+    header = [header_key(value) for value in next(rows, [])]
+    if "first_name" not in header or "customer_type" not in header:
+        raise ImportFileError("The first row must name the columns - first_name & customer_type are required.")
+
+    columns = [(index, column) for index, column in enumerate(header) if column in IMPORT_COLUMNS]
+    for row in rows:
+        values = {column: "" for column in IMPORT_COLUMNS}
+        for index, column in columns:
+            if index < len(row):
+                values[column] = str(row[index]).strip()
+        # blank lines at the end of a sheet are skipped
+        if any(values.values()):
+            yield values
+
+
+# ------------------------- VALIDATION: the sign-up forms, row by row -------------------------
+@dataclass
+class ImportRow:
+    """The unsaved instances of a valid import row"""
+    customer: Customer
+    address: object = None
+    phone: object = None
+    email: object = None
+    interest_ids: list = field(default_factory=list)
+    contact_method_ids: list = field(default_factory=list)
+    row_number: int = 0
+
+    def match_keys(self):
+        """Duplicate detection keys of the row's customer, phone, email & address"""
+        address = self.address
+        return match_keys(
+            self.customer.first_name,
+            self.customer.last_name,
+            phones=[self.phone.phone_number] if self.phone else [],
+            emails=[self.email.email_address] if self.email else [],
+            addresses=[(address.street, address.city, address.state, address.zip_code)] if address else [],
+        )
+
+
+@dataclass
+class ImportStats:
+    """Outcome & throughput of an import"""
+    rows: int = 0
+    imported: int = 0
+    failed: int = 0
+    duplicates: int = 0
+    seconds: float = 0
+
+    @property
+    def rows_per_minute(self):
+        return self.rows * 60 / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.imported} of {self.rows} rows imported ({self.failed} failed, {self.duplicates} duplicates) in {self.seconds:.2f}s "
+            f"({self.rows_per_minute:.0f} rows/min)"
+        )
+
+
+class ImportLookups:
+    """Interests & contact methods by name, loaded once per import (cells name them, rows hold their ids)"""
+    def __init__(self):
+        self.interests = {}
+        for interest_id, name, slug in CustomerInterest.objects.values_list("id", "name", "slug"):
+            self.interests[name.lower()] = interest_id
+            self.interests[slug.lower()] = interest_id
+        self.contact_methods = {
+            name.lower(): method_id for method_id, name in ContactMethod.objects.values_list("id", "method_name")
+        }
+
+    def ids(self, value, names, column, errors):
+        """Ids of the ; separated names of a cell - unknown names are reported"""
+        ids = []
+        for name in filter(None, (part.strip() for part in _LIST_SEPARATOR.split(value))):
+            if name.lower() in names:
+                ids.append(names[name.lower()])
+            else:
+                errors.append((column, f"Unknown {column.replace('_', ' ').rstrip('s')}: {name}"))
+        return list(dict.fromkeys(ids))
+
+
+def _checkbox(value, default=True):
+    """Form value of a yes / no cell (checkboxes are left out of the data when unticked)"""
+    if not value:
+        return "on" if default else None
+    return None if value.lower() in FALSE_VALUES else "on"
+
+
+def _form_instance(FormClass, data, column_prefix, errors):
+    """Validates a row's values with a sign-up form - returns the unsaved instance or None (the errors are reported)"""
+    form = FormClass({key: value for key, value in data.items() if value is not None})
+    if form.is_valid():
+        return form.save(commit=False)
+    for field_name, messages in form.errors.items():
+        column = column_prefix if field_name == "__all__" else field_name
+        errors.extend((column, message) for message in messages)
+    return None
+
+
+def validate_row(values, lookups):
+    """
+        Validates an import row with the sign-up forms (same fields, validators & clean methods as the sign-up).
+        Returns (ImportRow or None, [(column, error), ...]).
+    """
+    errors = []
+    customer = _form_instance(CreateCustomerForm, {
+        "first_name": values["first_name"],
+        "last_name": values["last_name"],
+        "customer_type": values["customer_type"].lower(),
+    }, "customer", errors)
+    row = ImportRow(
+        customer=customer,
+        interest_ids=lookups.ids(values["interests"], lookups.interests, "interests", errors),
+        contact_method_ids=lookups.ids(values["contact_methods"], lookups.contact_methods, "contact_methods", errors),
+    )
+
+    if any(values[column] for column in ADDRESS_COLUMNS):
+        row.address = _form_instance(CreateAddressForm, {
+            "street": values["street"],
+            "city": values["city"],
+            "state": values["state"].upper(),
+            "zip_code": values["zip_code"],
+            "mailing_address": _checkbox(values["mailing_address"]),
+        }, "address", errors)
+
+    if values["phone_number"]:
+        # the phone permissions & primary flag get the model defaults
+        row.phone = _form_instance(CreatePhoneForm, {
+            "phone_number": values["phone_number"],
+            "extension": values["extension"],
+            "phone_type": values["phone_type"].lower(),
+            "can_call": "on", "can_text": "on", "can_leave_voicemail": "on", "is_primary": "on",
+        }, "phone", errors)
+
+    if values["email_address"]:
+        row.email = _form_instance(CreateEmailForm, {
+            "email_address": values["email_address"],
+            "email_type": values["email_type"].lower(),
+            "preferred_email": "on",
+        }, "email", errors)
+
+    return (None if errors else row), errors
+
+
+# ------------------------- SAVING: one bulk insert per table per batch -------------------------
+def split_duplicates(rows):
+    """
+        Splits a batch of valid import rows into (new rows, [(duplicate row, error)]): the rows that are likely
+        duplicates (LIKELY_DUPLICATE_SCORE) of an existing customer - blocking keys, one query per kind of key for the
+        whole batch - or of an earlier row of the batch (earlier batches are saved already)
+    """
+    keys_list = [row.match_keys() for row in rows]
+    matches = find_duplicates_for_many(keys_list, min_score=LIKELY_DUPLICATE_SCORE, limit=1)
+
+    new_rows, duplicates = [], []
+    # (kind, key) -> row numbers of the new rows of the batch with that key
+    batch_keys = defaultdict(list)
+    for row, keys, found in zip(rows, keys_list, matches):
+        if found:
+            match = found[0]
+            duplicates.append((row, f"Likely duplicate of customer #{match.customer.pk} {match.customer} ({match.reason_labels})"))
+            continue
+
+        key_sets = keys.key_sets()
+        reasons = defaultdict(list)
+        for kind, kind_keys in key_sets.items():
+            for key in kind_keys:
+                for row_number in batch_keys[(kind, key)]:
+                    reasons[row_number].append(kind)
+        earlier = next((number for number, kinds in reasons.items() if match_score(kinds) >= LIKELY_DUPLICATE_SCORE), None)
+        if earlier:
+            labels = ", ".join(MATCH_LABELS[kind] for kind in reasons[earlier] if not (kind == "phonetic" and "name" in reasons[earlier]))
+            duplicates.append((row, f"Likely duplicate of row {earlier} ({labels})"))
+            continue
+
+        new_rows.append(row)
+        for kind, kind_keys in key_sets.items():
+            for key in kind_keys:
+                batch_keys[(kind, key)].append(row.row_number)
+    return new_rows, duplicates
+
+
+def save_batch(rows, user):
+    """
+        Saves a batch of valid import rows in one transaction: a bulk insert of the customers, addresses, phones & emails
+        & one of each m2m table's rows (inserted straight into the through tables).
+
+        - bulk inserts skip save() & send no signals: the duplicate detection keys, normalized address key & phone
+          format are set here & the mailing lists are brought up to date once, after the import (add_to_interest_lists)
+        - returns the ids of the new customers
+    """
+    customers = [row.customer for row in rows]
+    for customer in customers:
+        customer.creator = user
+        customer.set_match_keys()
+
+    addresses = [row.address for row in rows if row.address]
+    for address in addresses:
+        address.normalized_key = normalize_address_key(address.street, address.city, address.state, address.zip_code)
+    phones = [row.phone for row in rows if row.phone]
+    for phone in phones:
+        phone.standardize_phone_number()
+    emails = [row.email for row in rows if row.email]
+
+    with transaction.atomic():
+        Customer.objects.bulk_create(customers)
+        for model, instances in ((Address, addresses), (Phone, phones), (Email, emails)):
+            model.objects.bulk_create(instances)
+
+        links = {
+            Customer.addresses.through: [
+                Customer.addresses.through(customer_id=row.customer.pk, address_id=row.address.pk) for row in rows if row.address
+            ],
+            Customer.phones.through: [
+                Customer.phones.through(customer_id=row.customer.pk, phone_id=row.phone.pk) for row in rows if row.phone
+            ],
+            Customer.emails.through: [
+                Customer.emails.through(customer_id=row.customer.pk, email_id=row.email.pk) for row in rows if row.email
+            ],
+            Customer.interests.through: [
+                Customer.interests.through(customer_id=row.customer.pk, customerinterest_id=interest_id)
+                for row in rows for interest_id in row.interest_ids
+            ],
+            Customer.preferred_contact_methods.through: [
+                Customer.preferred_contact_methods.through(customer_id=row.customer.pk, contactmethod_id=method_id)
+                for row in rows for method_id in row.contact_method_ids
+            ],
+        }
+        for through, instances in links.items():
+            through.objects.bulk_create(instances)
+
+    return [customer.pk for customer in customers]
+
+
+def import_customers(path, user=None, report=None, batch_size=IMPORT_BATCH_SIZE, progress=None, skip_duplicates=True):
+    """
+        Imports the customers of a csv / xlsx file (see IMPORT_COLUMNS) & returns the ImportStats of the run.
+
+        - rows are streamed from the file, validated with the sign-up forms & saved batch_size rows at a time (one
+          transaction & one bulk insert per table per batch) - memory holds one batch whatever the size of the file
+        - rows that don't validate are skipped: report (a text file) gets a csv line per error (row number, column, error)
+        - skip_duplicates: rows that are likely duplicates of a customer (or of an earlier row) are skipped & reported too
+        - the new customers are added to the mailing lists of their interests once, at the end
+        - progress(stats) is called after every batch
+    """
+    started = time.monotonic()
+    stats = ImportStats()
+    lookups = ImportLookups()
+    writer = csv.writer(report) if report is not None else None
+    if writer:
+        writer.writerow(IMPORT_REPORT_COLUMNS)
+
+    customer_ids = []
+    batch = []
+
+    def flush():
+        rows = batch
+        if skip_duplicates:
+            rows, duplicates = split_duplicates(batch)
+            stats.duplicates += len(duplicates)
+            if writer:
+                writer.writerows((row.row_number, "duplicate", message) for row, message in duplicates)
+
+        customer_ids.extend(save_batch(rows, user))
+        stats.imported += len(rows)
+        batch.clear()
+        stats.seconds = time.monotonic() - started
+        if progress:
+            progress(stats)
+
+    # the header is row 1, as numbered in a spreadsheet
+    for row_number, values in enumerate(read_import_rows(path), start=2):
+        stats.rows += 1
+        row, errors = validate_row(values, lookups)
+        if row is None:
+            stats.failed += 1
+            if writer:
+                writer.writerows((row_number, column, message) for column, message in errors)
+            continue
+
+        row.row_number = row_number
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    add_to_interest_lists(customer_ids)
+    stats.seconds = time.monotonic() - started
+    return stats
+
+
+# ------------------------- BACKGROUND IMPORTS: started from the import page -------------------------
+def import_root():
+    """Directory the uploaded import files & their error reports are kept in"""
+    return str(settings.CUSTOMER_IMPORT_ROOT)
+
+
+def run_customer_import(import_id):
+    """Background job: imports the file of a CustomerImport, recording the progress after every batch"""
+    from .models import CustomerImport
+
+    customer_import = CustomerImport.objects.get(pk=import_id)
+    customer_import.status = 'running'
+    customer_import.report_name = f"{os.path.splitext(customer_import.staged_name)[0]}_errors.csv"
+    customer_import.save(update_fields=['status', 'report_name'])
+
+    def progress(stats):
+        CustomerImport.objects.filter(pk=import_id).update(
+            rows=stats.rows, imported=stats.imported, failed=stats.failed, duplicates=stats.duplicates, seconds=stats.seconds
+        )
+
+    try:
+        with open(os.path.join(import_root(), customer_import.report_name), "w", newline="") as report:
+            stats = import_customers(
+                os.path.join(import_root(), customer_import.staged_name),
+                user=customer_import.requested_by,
+                report=report,
+                progress=progress,
+                skip_duplicates=not customer_import.allow_duplicates,
+            )
+    except Exception as e:
+        customer_import.status = 'failed'
+        customer_import.error = str(e)
+    else:
+        customer_import.status = 'done'
+        customer_import.rows, customer_import.imported = stats.rows, stats.imported
+        customer_import.failed, customer_import.duplicates = stats.failed, stats.duplicates
+        customer_import.seconds = stats.seconds
+
+    customer_import.finished_at = timezone.now()
+    customer_import.save()
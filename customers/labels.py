@@ -0,0 +1,523 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery
+from django.utils import timezone
+
+from pypdf import PdfWriter
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.units import inch
+from reportlab.pdfgen import canvas
+
+@dataclass(frozen=True)
+class LabelTemplate:
+    """
+        Geometry of a label sheet (or envelope) - all lengths in points.
+
+        - slots (the text origin of every label on a page) are worked out once per template, not once per label
+        - return_address: envelopes print settings.LABEL_RETURN_ADDRESS in the top left corner of every page
+    """
+    name: str
+    page_size: tuple
+    columns: int
+    rows: int
+    label_width: float
+    label_height: float
+    margin_left: float
+    margin_top: float
+    pitch_x: float  # distance from the left edge of a label to the left edge of the next one
+    pitch_y: float  # distance from the top edge of a label to the top edge of the one below
+    font_size: float = 10
+    leading: float = 12
+    padding_x: float = 6
+    font_name: str = "Helvetica"
+    return_address: bool = False
+
+    @property
+    def labels_per_page(self):
+        return self.columns * self.rows
+
+    @cached_property
+    def slots(self):
+        """(x, y) text origin of every label slot on a page, left to right then top to bottom"""
+        page_height = self.page_size[1]
+        # the 3 address lines are centred vertically on the label
+        text_height = self.font_size + 2 * self.leading
+        first_baseline = (self.label_height - text_height) / 2 + self.font_size
+
+        return tuple(
+            (
+                self.margin_left + col * self.pitch_x + self.padding_x,
+                page_height - self.margin_top - row * self.pitch_y - first_baseline,
+            )
+            for row in range(self.rows)
+            for col in range(self.columns)
+        )
+
+
+# Label sheets & envelopes the labels can be printed on (key is part of the cache key of rendered pdfs)
+LABEL_TEMPLATES = {
+    "avery_5160": LabelTemplate(
+        name="Avery 5160 - Address labels (1\" x 2 5/8\", 30 per sheet)",
+        page_size=letter, columns=3, rows=10,
+        label_width=2.625 * inch, label_height=1 * inch,
+        margin_left=0.1875 * inch, margin_top=0.5 * inch,
+        pitch_x=2.75 * inch, pitch_y=1 * inch,
+    ),
+    "avery_5163": LabelTemplate(
+        name="Avery 5163 - Shipping labels (2\" x 4\", 10 per sheet)",
+        page_size=letter, columns=2, rows=5,
+        label_width=4 * inch, label_height=2 * inch,
+        margin_left=0.15625 * inch, margin_top=0.5 * inch,
+        pitch_x=4.1875 * inch, pitch_y=2 * inch,
+        font_size=12, leading=15, padding_x=12,
+    ),
+    "avery_5167": LabelTemplate(
+        name="Avery 5167 - Return address labels (1/2\" x 1 3/4\", 80 per sheet)",
+        page_size=letter, columns=4, rows=20,
+        label_width=1.75 * inch, label_height=0.5 * inch,
+        margin_left=0.3 * inch, margin_top=0.5 * inch,
+        pitch_x=2.05 * inch, pitch_y=0.5 * inch,
+        font_size=6.5, leading=8, padding_x=4,
+    ),
+    "envelope_10": LabelTemplate(
+        name="#10 Envelope (4 1/8\" x 9 1/2\")",
+        page_size=(9.5 * inch, 4.125 * inch), columns=1, rows=1,
+        label_width=4.5 * inch, label_height=1.5 * inch,
+        margin_left=4 * inch, margin_top=1.75 * inch,
+        pitch_x=4.5 * inch, pitch_y=1.5 * inch,
+        font_size=12, leading=15, padding_x=0, return_address=True,
+    ),
+    "envelope_6x9": LabelTemplate(
+        name="6\" x 9\" Catalog envelope",
+        page_size=(9 * inch, 6 * inch), columns=1, rows=1,
+        label_width=4.5 * inch, label_height=2 * inch,
+        margin_left=3.5 * inch, margin_top=2.5 * inch,
+        pitch_x=4.5 * inch, pitch_y=2 * inch,
+        font_size=12, leading=15, padding_x=0, return_address=True,
+    ),
+}
+
+# template used when none is picked
+DEFAULT_LABEL_TEMPLATE = "avery_5160"
+
+# name of the form XObject holding the static part of every page
+PAGE_DECORATION_FORM = "label_page_decoration"
+
+# number of addresses pulled from the db per round trip while rendering labels
+LABEL_CHUNK_SIZE = 2000
+
+# number of label pages each worker process renders at a time (parallel rendering)
+LABEL_PAGES_PER_CHUNK = 50
+
+
+def label_name(first_name, last_name, customer_type):
+    """Returns the name printed on a label - same rules as Customer.mailing_list_name"""
+    if customer_type == "person":
+        return f"{first_name} {last_name or ''}".strip()
+    return f"{first_name}"
+
+
+def mailing_list_label_rows(mailing_list, chunk_size=LABEL_CHUNK_SIZE, dedupe=False):
+    """
+        Generator that yields (customer name, street, city, state, zip code) tuples for every labelled address in a mailing list.
+
+        - One ordered query: the customer shown on the label is joined in with correlated subqueries instead of
+          calling address.customer_addresses.first() per label
+        - Rows are streamed from the db in chunks (.iterator) so memory stays flat for very large lists
+        - Addresses without any customer are skipped (nothing to put on the label)
+        - dedupe: one label per household - only the first address of every normalized address key is labelled
+    """
+    # imported here so worker processes can import this module for rendering without setting up django
+    from .addresses import first_address_ids
+    from .models import Address, Customer
+
+    # same customer that address.customer_addresses.first() returned: newest customer linked to the address
+    label_customer = Customer.objects.filter(addresses=OuterRef('pk')).order_by('-created_at')
+
+    addresses = (
+        Address.objects.filter(mailing_addresses=mailing_list)
+        .annotate(
+            customer_first_name=Subquery(label_customer.values('first_name')[:1]),
+            customer_last_name=Subquery(label_customer.values('last_name')[:1]),
+            customer_type=Subquery(label_customer.values('customer_type')[:1]),
+        )
+        .filter(customer_first_name__isnull=False)
+    )
+    if dedupe:
+        labelled_addresses = Address.objects.filter(mailing_addresses=mailing_list, customer_addresses__isnull=False)
+        addresses = addresses.filter(id__in=first_address_ids(labelled_addresses))
+
+    addresses = (
+        addresses.order_by('id')
+        .values_list('customer_first_name', 'customer_last_name', 'customer_type', 'street', 'city', 'state', 'zip_code')
+    )
+
+    for first_name, last_name, customer_type, street, city, state, zip_code in addresses.iterator(chunk_size=chunk_size):
+        yield (label_name(first_name, last_name, customer_type), street, city, state, zip_code)
+
+
+def mailing_list_dedupe_counts(mailing_list):
+    """
+        Returns (labels, households) of a mailing list in one query: the number of labelled addresses & the number of
+        distinct normalized addresses among them (labels - households duplicates are merged by dedupe).
+    """
+    from .models import Address
+
+    counts = Address.objects.filter(mailing_addresses=mailing_list, customer_addresses__isnull=False).aggregate(
+        labels=Count('id', distinct=True),
+        households=Count('normalized_key', distinct=True),
+    )
+    return counts['labels'], counts['households']
+
+
+def get_label_template(template):
+    """Returns the LabelTemplate registered under the key template (raises ValueError for unknown templates)"""
+    try:
+        return LABEL_TEMPLATES[template]
+    except KeyError:
+        raise ValueError(f"Unknown label template: {template}")
+
+
+def label_return_address(template):
+    """Return address lines printed on every page of a template (only envelopes have one)"""
+    if get_label_template(template).return_address:
+        return tuple(settings.LABEL_RETURN_ADDRESS)
+    return ()
+
+
+def draw_page_decoration(pdf, layout, return_address=()):
+    """
+        Draws the static part of a page (the return address of envelopes) once, as a reusable form XObject.
+        Returns the name of the form to place on every page, or None when the template has no decoration.
+    """
+    if not return_address:
+        return None
+
+    pdf.beginForm(PAGE_DECORATION_FORM)
+    text_object = pdf.beginText()
+    text_object.setFont(layout.font_name, 9, 11)
+    text_object.setTextOrigin(0.35 * inch, layout.page_size[1] - 0.35 * inch - 9)
+    for line in return_address:
+        text_object.textLine(line)
+    pdf.drawText(text_object)
+    pdf.endForm()
+    return PAGE_DECORATION_FORM
+
+
+def render_labels(rows, output, start_position=0, template=DEFAULT_LABEL_TEMPLATE, return_address=()):
+    """
+        Draws label rows onto a pdf written to the file-like object output & returns the number of labels drawn.
+
+        - start_position: 0-based label slot on the first sheet (lets partially used sheets be reused)
+        - template: key of the LABEL_TEMPLATES layout to print on; return_address: lines drawn on every envelope
+        - every page holds a single text object (font set once per page) & places the shared decoration form
+        - pages are compressed as they are finished, the complete file is only written to output on save
+    """
+    layout = get_label_template(template)
+    slots = layout.slots
+    labels_per_page = layout.labels_per_page
+
+    pdf = canvas.Canvas(output, pagesize=layout.page_size, pageCompression=1)
+    decoration = draw_page_decoration(pdf, layout, return_address)
+
+    # Track position counter (label slot, counting from the start of the first sheet)
+    current_position = start_position
+    labels = 0
+    text_object = None
+
+    for name, street, city, state, zip_code in rows:
+        # Calculate position on current page
+        position_on_page = current_position % labels_per_page
+
+        # Start a new page if at beginning of a new page (the first label starts the first page)
+        if text_object is None or position_on_page == 0:
+            if text_object is not None:
+                pdf.drawText(text_object)
+                pdf.showPage()
+            if decoration:
+                pdf.doForm(decoration)
+            text_object = pdf.beginText()
+            text_object.setFont(layout.font_name, layout.font_size, layout.leading)
+
+        text_object.setTextOrigin(*slots[position_on_page])
+        text_object.textLine(name)
+        text_object.textLine(street or "")
+        text_object.textLine(f"{city}, {state} {zip_code}")
+
+        # Move to next label
+        current_position += 1
+        labels += 1
+
+    if text_object is not None:
+        pdf.drawText(text_object)
+
+    # Finalize the PDF
+    pdf.save()
+    return labels
+
+
+# ------------------------- PARALLEL RENDERING: page aligned chunks rendered in a process pool -------------------------
+@dataclass
+class LabelRunStats:
+    """Throughput of a label rendering run"""
+    labels: int
+    pages: int
+    seconds: float
+
+    @property
+    def labels_per_second(self):
+        return self.labels / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.labels} labels on {self.pages} pages in {self.seconds:.2f}s ({self.labels_per_second:.0f} labels/s)"
+
+
+def page_aligned_chunks(rows, start_position=0, pages_per_chunk=LABEL_PAGES_PER_CHUNK, template=DEFAULT_LABEL_TEMPLATE):
+    """
+        Splits label rows into chunks that each fill whole pages & yields (start position, rows) for every chunk.
+        Only the first chunk starts part way into a sheet (start_position), the rest start at the top of a new page.
+    """
+    labels_per_page = get_label_template(template).labels_per_page
+    rows = iter(rows)
+    chunk_size = pages_per_chunk * labels_per_page - start_position
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield start_position, chunk
+        start_position = 0
+        chunk_size = pages_per_chunk * labels_per_page
+
+
+def render_label_chunk(rows, start_position, path, render_options):
+    """Process pool task: renders one chunk of label rows to a partial pdf at path & returns the number of labels"""
+    with open(path, "wb") as output:
+        return render_labels(rows, output, start_position=start_position, **render_options)
+
+
+def render_labels_in_parallel(
+    rows, output, start_position=0, workers=1, pages_per_chunk=LABEL_PAGES_PER_CHUNK,
+    template=DEFAULT_LABEL_TEMPLATE, return_address=(),
+):
+    """
+        Renders label rows to the file-like object output, splitting them into page aligned chunks that are rendered
+        by a pool of worker processes & concatenated (in order) into one pdf. Returns the LabelRunStats of the run.
+
+        - runs that fit in a single chunk (or workers=1) are rendered in this process - no pool start up cost
+        - at most 2 chunks per worker are rendered ahead of the merge, so the pool does not run away from it - the
+          merged pdf itself is held in memory (pypdf keeps every appended page until write()), so memory still
+          grows with the size of the run
+        - workers get the template key & return address (not the layout), the layout is rebuilt once per process
+    """
+    started = time.perf_counter()
+    render_options = {"template": template, "return_address": tuple(return_address)}
+    labels_per_page = get_label_template(template).labels_per_page
+
+    if workers <= 1:
+        labels = render_labels(rows, output, start_position=start_position, **render_options)
+        return LabelRunStats(labels, _page_count(labels, start_position, labels_per_page), time.perf_counter() - started)
+
+    chunks = page_aligned_chunks(rows, start_position, pages_per_chunk, template)
+    first = next(chunks, None)
+    second = next(chunks, None)
+
+    if second is None:
+        labels = render_labels(first[1] if first else [], output, start_position=start_position, **render_options)
+        return LabelRunStats(labels, _page_count(labels, start_position, labels_per_page), time.perf_counter() - started)
+
+    writer = PdfWriter()
+    labels = 0
+    with tempfile.TemporaryDirectory() as temp_dir, ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        pending = []
+        for index, (chunk_start, chunk_rows) in enumerate(_chain_chunks(first, second, chunks)):
+            path = os.path.join(temp_dir, f"chunk-{index}.pdf")
+            pending.append((path, pool.submit(render_label_chunk, chunk_rows, chunk_start, path, render_options)))
+
+            # append finished chunks in order - keeps the number of chunks rendered ahead (& their temp files) bounded
+            while len(pending) >= workers * 2:
+                labels += _append_chunk(writer, *pending.pop(0))
+
+        for path, future in pending:
+            labels += _append_chunk(writer, path, future)
+
+        writer.write(output)
+
+    return LabelRunStats(labels, _page_count(labels, start_position, labels_per_page), time.perf_counter() - started)
+
+
+def _append_chunk(writer, path, future):
+    """Waits for a chunk to be rendered and appends its pages to the pdf writer"""
+    labels = future.result()
+    writer.append(path)
+    os.remove(path)
+    return labels
+
+
+def _chain_chunks(first, second, chunks):
+    """Puts the two chunks read ahead back in front of the remaining chunks"""
+    yield first
+    yield second
+    yield from chunks
+
+
+def _page_count(labels, start_position, labels_per_page):
+    """Number of sheets used by labels starting at start_position"""
+    return -(-(labels + start_position) // labels_per_page) if labels else 0
+
+
+# ------------------------- CACHED LABEL PDFS: keyed by mailing list id, membership version, template & start position -------------------------
+def label_cache_root():
+    """Directory the finished label pdfs are stored in"""
+    return str(settings.LABEL_CACHE_ROOT)
+
+
+def label_cache_path(mailing_list, template=DEFAULT_LABEL_TEMPLATE, start_position=0, dedupe=False):
+    """Returns the file path of a cached label pdf - a new membership version gives a new path (old files are never served)"""
+    layout_key = template
+    # envelopes: a new return address (settings) must not serve envelopes printed with the old one
+    return_address = label_return_address(template)
+    if return_address:
+        checksum = zlib.crc32("\n".join(return_address).encode())
+        layout_key += f"-{checksum:08x}"
+    if dedupe:
+        layout_key += "-dedupe"
+
+    file_name = f"mailing-list-{mailing_list.pk}-v{mailing_list.membership_version}-{layout_key}-start{start_position}.pdf"
+    return os.path.join(label_cache_root(), file_name)
+
+
+def cached_labels_pdf(
+    mailing_list, template=DEFAULT_LABEL_TEMPLATE, start_position=0, workers=1, pages_per_chunk=LABEL_PAGES_PER_CHUNK, dedupe=False,
+):
+    """
+        Returns (path, stats) of the finished label pdf for a mailing list, rendering & storing it first on a cache miss.
+        stats is the LabelRunStats of the render, or None when the pdf was already cached.
+
+        - workers > 1 renders big lists in a process pool (see render_labels_in_parallel)
+        - dedupe prints one label per household (see mailing_list_label_rows)
+        - pdfs are rendered to a temp file in the cache directory & moved into place, so a half written file is never served
+        - older versions of the same mailing list are removed, then the cache is evicted by age & total size
+    """
+    path = label_cache_path(mailing_list, template, start_position, dedupe)
+
+    if os.path.exists(path):
+        # touch the file - eviction by age drops the least recently used pdfs
+        os.utime(path)
+        return path, None
+
+    os.makedirs(label_cache_root(), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=label_cache_root(), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as output:
+            stats = render_labels_in_parallel(
+                mailing_list_label_rows(mailing_list, dedupe=dedupe),
+                output,
+                start_position=start_position,
+                workers=workers,
+                pages_per_chunk=pages_per_chunk,
+                template=template,
+                return_address=label_return_address(template),
+            )
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    remove_stale_label_versions(mailing_list)
+    evict_label_cache(keep=path)
+    return path, stats
+
+
+def remove_stale_label_versions(mailing_list):
+    """Deletes the cached pdfs of older membership versions of a mailing list"""
+    prefix = f"mailing-list-{mailing_list.pk}-v"
+    current = f"{prefix}{mailing_list.membership_version}-"
+    for entry in os.scandir(label_cache_root()):
+        if entry.name.startswith(prefix) and not entry.name.startswith(current):
+            _remove_quietly(entry.path)
+
+
+def evict_label_cache(keep=None, max_age=None, max_bytes=None):
+    """
+        Evicts cached label pdfs: first everything older than max_age (seconds since last use), then the least
+        recently used pdfs until the cache is no larger than max_bytes. The file at path keep is never removed.
+    """
+    max_age = settings.LABEL_CACHE_MAX_AGE if max_age is None else max_age
+    max_bytes = settings.LABEL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+
+    entries = []
+    for entry in os.scandir(label_cache_root()):
+        if not entry.is_file() or entry.path == keep:
+            continue
+        stat = entry.stat()
+        # abandoned temp files (renders that crashed) are dropped after an hour
+        if entry.name.endswith(".part"):
+            if now - stat.st_mtime > 60 * 60:
+                _remove_quietly(entry.path)
+            continue
+        if now - stat.st_mtime > max_age:
+            _remove_quietly(entry.path)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    if keep and os.path.exists(keep):
+        total += os.path.getsize(keep)
+
+    # oldest first until the cache fits
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove_quietly(path)
+        total -= size
+
+
+def _remove_quietly(path):
+    """Removes a cache file - another worker may have removed it already"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# ------------------------- BACKGROUND LABEL JOBS: started from the print labels page -------------------------
+def run_label_render_job(job_id):
+    """Background job: renders (or reuses) the cached label pdf of a LabelRenderJob & records the throughput of the run"""
+    from .models import LabelRenderJob
+
+    job = LabelRenderJob.objects.select_related('mailing_list').get(pk=job_id)
+    job.status = 'running'
+    job.save(update_fields=['status'])
+
+    try:
+        path, stats = cached_labels_pdf(
+            job.mailing_list,
+            template=job.template,
+            start_position=job.start_position,
+            workers=settings.LABEL_RENDER_WORKERS,
+            dedupe=job.dedupe,
+        )
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+    else:
+        job.status = 'done'
+        job.pdf_name = os.path.basename(path)
+        # stats is None when an identical pdf was already cached - nothing was rendered
+        if stats:
+            job.labels, job.pages, job.seconds = stats.labels, stats.pages, stats.seconds
+
+    job.finished_at = timezone.now()
+    job.save()
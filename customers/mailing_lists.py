@@ -0,0 +1,245 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Address, Customer, CustomerMailingList
+
+# set operations that combine mailing lists / interests into a new list
+LIST_OPERATIONS = {
+    "union": "Union (on any of them)",
+    "intersection": "Intersection (on all of them)",
+    "difference": "Difference (on the first, none of the others)",
+}
+
+
+def address_ids_of(operand):
+    """
+        Query of the ids of the addresses of a mailing list or an interest (as member_id), never evaluated on its own.
+
+        - a mailing list: the addresses on its m2m table
+        - an interest: the mailing addresses of its active customers (the addresses an interest list would be built with)
+    """
+    if isinstance(operand, CustomerMailingList):
+        return CustomerMailingList.addresses.through.objects.filter(customermailinglist=operand).values(member_id=F('address_id'))
+    return (
+        Address.objects.filter(customer_addresses__interests=operand, customer_addresses__is_inactive=False, mailing_address=True)
+        .values(member_id=F('id'))
+    )
+
+
+def customer_ids_of(operand):
+    """Query of the ids of the customers of a mailing list or the active customers of an interest (as member_id)"""
+    if isinstance(operand, CustomerMailingList):
+        return CustomerMailingList.customers.through.objects.filter(customermailinglist=operand).values(member_id=F('customer_id'))
+    return Customer.objects.filter(interests=operand, is_inactive=False).values(member_id=F('id'))
+
+
+def combine(queries, operation):
+    """Combines member id queries into one compound query of unique ids: UNION, INTERSECT or EXCEPT (left to right)"""
+    first, *others = [query.order_by() for query in queries]
+    if not others:
+        return first.distinct()
+    return getattr(first, operation)(*others)
+
+
+def _insert_members(field_name, mailing_list, members):
+    """
+        Copies the ids of a member query into a mailing list m2m table with one INSERT ... SELECT - the ids never
+        leave the database
+    """
+    field = CustomerMailingList._meta.get_field(field_name)
+    through = field.remote_field.through
+    list_column = through._meta.get_field(field.m2m_field_name()).column
+    member_column = through._meta.get_field(field.m2m_reverse_field_name()).column
+
+    sql, params = members.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {connection.ops.quote_name(through._meta.db_table)} "
+            f"({connection.ops.quote_name(list_column)}, {connection.ops.quote_name(member_column)}) "
+            f"SELECT %s, members.member_id FROM ({sql}) members",
+            [mailing_list.pk, *params],
+        )
+        return cursor.rowcount
+
+
+def combine_mailing_lists(name, operation, operands):
+    """
+        Creates a new mailing list from the union, intersection or difference of mailing lists and/or interests.
+
+        - operands: CustomerMailingList & CustomerInterest instances, in order (a difference keeps the first operand's
+          members that aren't in any of the others)
+        - the addresses are combined in SQL (UNION / INTERSECT / EXCEPT on the m2m tables) & copied into the new list
+          with one INSERT ... SELECT - so does the combination of the customers, keeping only the customers with an
+          address on the new list
+        - the new list has no interests: it is a snapshot, the interest signals don't rebuild it
+    """
+    if operation not in LIST_OPERATIONS:
+        raise ValueError(f"Unknown mailing list operation: {operation}")
+    if not operands:
+        raise ValueError("At least one mailing list or interest is needed")
+
+    with transaction.atomic():
+        mailing_list = CustomerMailingList.objects.create(name=name)
+
+        address_ids = combine([address_ids_of(operand) for operand in operands], operation)
+        _insert_members("addresses", mailing_list, address_ids)
+
+        # customers of the combination that have an address on the new list
+        customer_ids = combine([customer_ids_of(operand) for operand in operands], operation)
+        listed_customers = (
+            Customer.addresses.through.objects.filter(address__mailing_addresses=mailing_list)
+            .filter(customer_id__in=customer_ids)
+            .values(member_id=F('customer_id'))
+            .distinct()
+        )
+        _insert_members("customers", mailing_list, listed_customers)
+
+    return mailing_list
+
+
+# ------------------------- DYNAMIC LISTS: members from a stored rule, refreshed lazily -------------------------
+# keys of a dynamic list rule (all optional - an empty rule matches every active customer's mailing addresses)
+RULE_KEYS = ["interests", "states", "zip_prefixes", "customer_types", "created_after", "created_before"]
+
+
+def rule_customers(rule):
+    """
+        Customers matching a dynamic list rule: active customers with any of the interests (slugs), of any of the
+        customer types, created between created_after & created_before (ISO dates, inclusive)
+    """
+    customers = Customer.objects.filter(is_inactive=False)
+    if rule.get("interests"):
+        customers = customers.filter(interests__slug__in=rule["interests"])
+    if rule.get("customer_types"):
+        customers = customers.filter(customer_type__in=rule["customer_types"])
+    if rule.get("created_after"):
+        customers = customers.filter(created_at__date__gte=parse_date(rule["created_after"]))
+    if rule.get("created_before"):
+        customers = customers.filter(created_at__date__lte=parse_date(rule["created_before"]))
+    return customers
+
+
+def rule_addresses(rule):
+    """Mailing addresses of the customers matching a dynamic list rule, in any of the states & zip code prefixes"""
+    addresses = Address.objects.filter(mailing_address=True, customer_addresses__in=rule_customers(rule).values('id'))
+    if rule.get("states"):
+        addresses = addresses.filter(state__in=[state.upper() for state in rule["states"]])
+    if rule.get("zip_prefixes"):
+        zip_codes = Q()
+        for prefix in rule["zip_prefixes"]:
+            zip_codes |= Q(zip_code__startswith=prefix)
+        addresses = addresses.filter(zip_codes)
+    return addresses
+
+
+def _sync_members(field_name, mailing_list, members):
+    """
+        Makes a mailing list m2m table hold exactly the ids of a member query: one DELETE of the rows that left &
+        one INSERT ... SELECT of the ids that joined - returns the number of rows changed
+    """
+    field = CustomerMailingList._meta.get_field(field_name)
+    through = field.remote_field.through
+    current = through.objects.filter(**{field.m2m_field_name(): mailing_list})
+    member_column = field.m2m_reverse_name()
+
+    removed, _ = current.exclude(**{f"{member_column}__in": members.values('member_id')}).delete()
+    added = _insert_members(field_name, mailing_list, members.exclude(member_id__in=current.values(member_column)))
+    return removed + added
+
+
+def refresh_dynamic_list(mailing_list, max_age=None):
+    """
+        Materializes the snapshot of a dynamic mailing list from its rule (does nothing for other lists).
+
+        - max_age: seconds a snapshot stays fresh - fresher snapshots are left alone (None always refreshes)
+        - only the members that joined or left are written, in SQL; membership_version is only bumped (invalidating
+          cached label pdfs) when the members changed
+        - returns True if the members changed
+    """
+    if not mailing_list.is_dynamic:
+        return False
+    now = timezone.now()
+    if max_age is not None and mailing_list.refreshed_at and now - mailing_list.refreshed_at < timedelta(seconds=max_age):
+        return False
+
+    rule = mailing_list.rule or {}
+    with transaction.atomic():
+        changed = _sync_members("addresses", mailing_list, rule_addresses(rule).values(member_id=F('id')).distinct())
+
+        # the matching customers of the addresses on the list
+        listed_customers = (
+            Customer.addresses.through.objects.filter(address__mailing_addresses=mailing_list)
+            .filter(customer_id__in=rule_customers(rule).values('id'))
+            .values(member_id=F('customer_id'))
+            .distinct()
+        )
+        changed += _sync_members("customers", mailing_list, listed_customers)
+
+        updates = {"refreshed_at": now}
+        if changed:
+            updates["membership_version"] = F('membership_version') + 1
+        CustomerMailingList.objects.filter(pk=mailing_list.pk).update(**updates)
+
+    mailing_list.refresh_from_db(fields=["refreshed_at", "membership_version"])
+    return bool(changed)
+
+
+def refresh_if_stale(mailing_list):
+    """Refreshes a dynamic mailing list whose snapshot is older than DYNAMIC_MAILING_LIST_MAX_AGE (pages people browse)"""
+    return refresh_dynamic_list(mailing_list, max_age=settings.DYNAMIC_MAILING_LIST_MAX_AGE)
+
+
+# ------------------------- BULK SAVED CUSTOMERS: the work of the interest signals, done once -------------------------
+def add_to_interest_lists(customer_ids, chunk_size=500):
+    """
+        Adds customers saved in bulk (bulk inserts send no signals) to the mailing lists of their interests, with their
+        mailing addresses - what update_customer_mailing_lists does one customer at a time.
+
+        - per chunk of customers & mailing list: one INSERT ... SELECT of the customers & one of the addresses not on the
+          list yet (active customers with a mailing address only)
+        - membership_version is bumped once per list that changed & dynamic lists are marked stale, so their rule is
+          evaluated again (with the new customers) the next time they are used
+        - returns the number of lists that changed
+    """
+    changed_lists = set()
+    customer_ids = list(customer_ids)
+
+    with transaction.atomic():
+        for start in range(0, len(customer_ids), chunk_size):
+            chunk = customer_ids[start:start + chunk_size]
+            mailing_lists = CustomerMailingList.objects.filter(
+                is_dynamic=False, interests__customer_interests__in=chunk
+            ).distinct()
+
+            for mailing_list in mailing_lists:
+                listed = CustomerMailingList.customers.through.objects.filter(customermailinglist=mailing_list)
+                customers = (
+                    Customer.objects.filter(
+                        pk__in=chunk, is_inactive=False, interests__mailing_interests=mailing_list, addresses__mailing_address=True
+                    )
+                    .values(member_id=F('id'))
+                    .distinct()
+                )
+                added = _insert_members("customers", mailing_list, customers.exclude(member_id__in=listed.values('customer_id')))
+
+                listed_addresses = CustomerMailingList.addresses.through.objects.filter(customermailinglist=mailing_list)
+                addresses = (
+                    Address.objects.filter(mailing_address=True, customer_addresses__in=customers.values('member_id'))
+                    .exclude(id__in=listed_addresses.values('address_id'))
+                    .values(member_id=F('id'))
+                    .distinct()
+                )
+                added += _insert_members("addresses", mailing_list, addresses)
+                if added:
+                    changed_lists.add(mailing_list.pk)
+
+        if changed_lists:
+            CustomerMailingList.objects.filter(pk__in=changed_lists).update(membership_version=F('membership_version') + 1)
+        CustomerMailingList.objects.filter(is_dynamic=True).update(refreshed_at=None)
+
+    return len(changed_lists)
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from customers.duplicate_clusters import (
+    DUPLICATE_CHUNK_SIZE,
+    MAX_BLOCK_SIZE,
+    find_duplicate_clusters,
+    write_duplicate_report,
+)
+from customers.matching import LIKELY_DUPLICATE_SCORE
+
+
+class Command(BaseCommand):
+    help = "Groups the customers that are likely duplicates of each other into clusters & writes them to a csv report to review."
+
+    def add_arguments(self, parser):
+        parser.add_argument("report", help="Path of the csv report to write")
+        parser.add_argument("--min-score", type=float, default=LIKELY_DUPLICATE_SCORE, help="Score from which two customers are duplicates (0 - 1)")
+        parser.add_argument("--workers", type=int, default=settings.DUPLICATE_CLUSTER_WORKERS, help="Number of worker processes")
+        parser.add_argument("--chunk-size", type=int, default=DUPLICATE_CHUNK_SIZE, help="Customers scored by a worker at a time")
+        parser.add_argument("--max-block-size", type=int, default=MAX_BLOCK_SIZE, help="Keys shared by more customers than this are not paired up")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Looking for duplicate customers with {options['workers']} worker(s)...")
+        clusters, links, stats = find_duplicate_clusters(
+            min_score=options["min_score"],
+            workers=options["workers"],
+            chunk_size=options["chunk_size"],
+            max_block_size=options["max_block_size"],
+        )
+
+        with open(options["report"], "w", newline="") as report:
+            write_duplicate_report(clusters, links, report)
+
+        self.stdout.write(self.style.SUCCESS(f"Found {stats}"))
+        self.stdout.write(f"The clusters are listed in {options['report']}")
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from app_users.models import CustomUser
+from customers.imports import IMPORT_BATCH_SIZE, IMPORT_COLUMNS, ImportFileError, import_customers
+
+
+class Command(BaseCommand):
+    help = "Imports customers (with their address, phone, email, interests & contact methods) from a csv or excel file & reports the throughput (rows per minute)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help=f"csv / xlsx file - columns: {', '.join(IMPORT_COLUMNS)}")
+        parser.add_argument("--user", help="Email of the user recorded as the creator of the customers")
+        parser.add_argument("--errors", help="Write the rows that could not be imported to this csv file")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Rows saved per transaction")
+        parser.add_argument("--allow-duplicates", action="store_true", help="Import rows that look like existing customers too")
+
+    def handle(self, *args, **options):
+        user = None
+        if options["user"]:
+            try:
+                user = CustomUser.objects.get(email=options["user"])
+            except CustomUser.DoesNotExist:
+                raise CommandError(f"User {options['user']} does not exist.")
+
+        self.stdout.write(f"Importing customers from {options['path']}...")
+        report = open(options["errors"], "w", newline="") if options["errors"] else None
+        try:
+            stats = import_customers(
+                options["path"],
+                user=user,
+                report=report,
+                batch_size=options["batch_size"],
+                skip_duplicates=not options["allow_duplicates"],
+                progress=lambda stats: self.stdout.write(f"  {stats.rows} rows read, {stats.imported} imported"),
+            )
+        except (ImportFileError, OSError) as e:
+            raise CommandError(str(e))
+        finally:
+            if report:
+                report.close()
+
+        self.stdout.write(self.style.SUCCESS(f"Import finished: {stats}"))
+        if (stats.failed or stats.duplicates) and options["errors"]:
+            self.stdout.write(self.style.WARNING(f"The rows that were not imported are listed in {options['errors']}"))
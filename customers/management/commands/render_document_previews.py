@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from customers.models import CustomerDocument
+from customers.previews import render_document_preview
+
+
+class Command(BaseCommand):
+    help = "Renders the first page previews of stored documents that have none (documents stored before previews, failed renders)."
+
+    def handle(self, *args, **options):
+        # documents sharing a stored file get their preview from the first one rendered
+        document_ids = list(
+            CustomerDocument.objects.filter(upload_status='stored', preview="").exclude(file="").values_list('id', flat=True)
+        )
+        self.stdout.write(f"Rendering previews of {len(document_ids)} document(s)...")
+
+        rendered = 0
+        for document_id in document_ids:
+            if CustomerDocument.objects.filter(pk=document_id, preview="").exists():
+                rendered += render_document_preview(document_id)
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered {rendered} preview(s) - the other documents are not pdfs or have nothing to show"))
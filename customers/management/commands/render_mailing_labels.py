@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from customers.models import CustomerMailingList
+from customers.labels import (
+    DEFAULT_LABEL_TEMPLATE,
+    LABEL_PAGES_PER_CHUNK,
+    LABEL_TEMPLATES,
+    cached_labels_pdf,
+    label_return_address,
+    mailing_list_label_rows,
+    render_labels_in_parallel,
+)
+from customers.mailing_lists import refresh_dynamic_list
+
+
+class Command(BaseCommand):
+    help = "Renders the mailing labels of a mailing list using a pool of worker processes & reports the throughput (labels per second)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("mailing_list_id", type=int, help="Id of the mailing list to render labels for")
+        parser.add_argument("--output", help="Write the pdf to this path (default: store it in the label cache)")
+        parser.add_argument("--template", default=DEFAULT_LABEL_TEMPLATE, choices=LABEL_TEMPLATES, help="Label sheet / envelope layout")
+        parser.add_argument("--start-position", type=int, default=1, help="Label number on the first sheet to start printing on")
+        parser.add_argument("--dedupe", action="store_true", help="Print one label per household (merge duplicate addresses)")
+        parser.add_argument("--workers", type=int, default=settings.LABEL_RENDER_WORKERS, help="Number of worker processes")
+        parser.add_argument("--pages-per-chunk", type=int, default=LABEL_PAGES_PER_CHUNK, help="Label pages rendered by a worker at a time")
+
+    def handle(self, *args, **options):
+        try:
+            mailing_list = CustomerMailingList.objects.get(pk=options["mailing_list_id"])
+        except CustomerMailingList.DoesNotExist:
+            raise CommandError(f"Mailing list {options['mailing_list_id']} does not exist.")
+
+        # dynamic lists are printed from a fresh snapshot of their rule
+        refresh_dynamic_list(mailing_list)
+
+        start_position = max(0, options["start_position"] - 1)
+        self.stdout.write(f"Rendering labels for {mailing_list.name} with {options['workers']} worker(s)...")
+
+        if options["output"]:
+            with open(options["output"], "wb") as output:
+                stats = render_labels_in_parallel(
+                    mailing_list_label_rows(mailing_list, dedupe=options["dedupe"]),
+                    output,
+                    start_position=start_position,
+                    workers=options["workers"],
+                    pages_per_chunk=options["pages_per_chunk"],
+                    template=options["template"],
+                    return_address=label_return_address(options["template"]),
+                )
+            path = options["output"]
+        else:
+            path, stats = cached_labels_pdf(
+                mailing_list,
+                template=options["template"],
+                start_position=start_position,
+                workers=options["workers"],
+                pages_per_chunk=options["pages_per_chunk"],
+                dedupe=options["dedupe"],
+            )
+
+        if stats:
+            self.stdout.write(self.style.SUCCESS(f"Rendered {stats} to {path}"))
+        else:
+            self.stdout.write(self.style.WARNING(f"Labels were already rendered: {path}"))
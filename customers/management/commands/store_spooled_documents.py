@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from customers.documents import clear_orphaned_spool_files, pending_documents, store_document
+
+
+class Command(BaseCommand):
+    help = "Pushes spooled document uploads to storage again: uploads whose background job was interrupted (& failed ones with --failed)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--failed", action="store_true", help="Also retry the uploads whose every attempt failed")
+        parser.add_argument("--stuck-after", type=int, default=settings.DOCUMENT_UPLOAD_STUCK_AFTER, help="Seconds after which a processing upload is retried")
+
+    def handle(self, *args, **options):
+        document_ids = list(pending_documents(stuck_after=options["stuck_after"], failed=options["failed"]).values_list('id', flat=True))
+        self.stdout.write(f"Storing {len(document_ids)} spooled document(s)...")
+
+        stored = sum(store_document(document_id) for document_id in document_ids)
+        cleared = clear_orphaned_spool_files()
+
+        self.stdout.write(self.style.SUCCESS(f"Stored {stored} of {len(document_ids)} document(s), cleared {cleared} orphaned spool file(s)"))
+        if stored < len(document_ids):
+            self.stdout.write(self.style.WARNING("Some uploads failed again - run with --failed to retry them."))
@@ -0,0 +1,87 @@
+import re
+import unicodedata
+
+# words that don't tell two customer names apart ('The Smith Farm LLC' & 'Smith Farm' are the same customer)
+NAME_NOISE_WORDS = {"THE", "AND", "LLC", "INC", "CO", "CORP", "COMPANY", "LTD", "LP", "LLP"}
+
+# how much each matching blocking key counts towards a duplicate score (capped at 1) - a phonetic match only counts
+# when the names aren't the same
+MATCH_WEIGHTS = {"name": 0.4, "phonetic": 0.2, "email": 0.5, "phone": 0.4, "address": 0.3}
+MATCH_LABELS = {"name": "same name", "phonetic": "similar name", "email": "same email", "phone": "same phone", "address": "same address"}
+
+# scores from which a customer is shown as a possible duplicate (sign-up: a similar name is worth a look) / skipped as
+# a duplicate (imports)
+POSSIBLE_DUPLICATE_SCORE = 0.2
+LIKELY_DUPLICATE_SCORE = 0.7
+
+
+# soundex codes of consonants (vowels, H, W & Y have none)
+_SOUNDEX_CODES = {
+    **dict.fromkeys("BFPV", "1"), **dict.fromkeys("CGJKQSXZ", "2"), **dict.fromkeys("DT", "3"),
+    "L": "4", **dict.fromkeys("MN", "5"), "R": "6",
+}
+
+
+def _ascii_upper(value):
+    """Uppercases a value & drops accents: 'José' -> 'JOSE'"""
+    value = unicodedata.normalize("NFKD", value or "")
+    return "".join(char for char in value if not unicodedata.combining(char)).upper()
+
+
+def name_key(first_name, last_name=""):
+    """
+        Returns the normalized name of a customer: the same for every way the same name is typed in.
+        'The Smith-Jones Farm, LLC' -> 'SMITH JONES FARM' (uppercased, accents & punctuation dropped, noise words left out)
+    """
+    words = re.sub(r"[^A-Z0-9]+", " ", _ascii_upper(f"{first_name or ''} {last_name or ''}")).split()
+    return " ".join(word for word in words if word not in NAME_NOISE_WORDS)
+
+
+def soundex(word):
+    """American soundex code of a word: 'Robert' & 'Rupert' -> 'R163' (numbers are kept as they are)"""
+    word = re.sub(r"[^A-Z0-9]", "", _ascii_upper(word))
+    if not word or not word[0].isalpha():
+        return word
+
+    code = word[0]
+    previous = _SOUNDEX_CODES.get(word[0])
+    for char in word[1:]:
+        digit = _SOUNDEX_CODES.get(char)
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # H & W don't separate letters with the same code, vowels do
+        if char not in "HW":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+def phonetic_key(normalized_name):
+    """Soundex of every word of a normalized name: 'JON SMYTH' & 'JOHN SMITH' -> 'J500 S530'"""
+    return " ".join(soundex(word) for word in normalized_name.split())
+
+
+def phone_key(phone_number):
+    """
+        Returns a phone number as it is stored (330-674-2811) whatever way it was typed in - a leading US country code
+        is dropped. Numbers that aren't 10 digits return '' (they can't be matched).
+    """
+    digits = re.sub(r"\D", "", phone_number or "")
+    if len(digits) == 11 and digits.startswith("1"):
+        digits = digits[1:]
+    if len(digits) != 10:
+        return ""
+    return f"{digits[:3]}-{digits[3:6]}-{digits[6:]}"
+
+
+def email_key(email_address):
+    """Returns the lowercased email address (email addresses are matched case-insensitively)"""
+    return (email_address or "").strip().lower()
+
+
+def match_score(reasons):
+    """Duplicate score of the kinds of keys two customers share (a similar name adds nothing to the same name)"""
+    if "name" in reasons:
+        reasons = [reason for reason in reasons if reason != "phonetic"]
+    return min(1.0, sum(MATCH_WEIGHTS[reason] for reason in reasons))
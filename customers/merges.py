@@ -0,0 +1,165 @@
+from dataclasses import dataclass
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Min, Q
+from django.db.models.functions import Lower
+
+from .mailing_lists import add_to_interest_lists
+from .models import Address, Customer, CustomerDocument, CustomerMailingList, CustomerNote, CustomerRelationship, Email, Phone
+from .profile import bump_profile_version
+
+
+class MergeError(Exception):
+    """Two customers can't be merged (the same customer twice)"""
+
+
+@dataclass
+class MergeResult:
+    """What a merge moved to the kept customer - rows the kept customer already had are not counted"""
+    addresses: int = 0
+    phones: int = 0
+    emails: int = 0
+    interests: int = 0
+    contact_methods: int = 0
+    notes: int = 0
+    documents: int = 0
+    relationships: int = 0
+    mailing_lists: int = 0
+
+    def __str__(self):
+        return ", ".join(f"{count} {label.replace('_', ' ')}" for label, count in vars(self).items() if count) or "nothing to move"
+
+
+def _move_through_rows(through, owner_field, member_field, old_id, new_id, skip_members=()):
+    """
+        Moves the rows of an m2m table from one owner to another: one INSERT ... SELECT of the members the new owner
+        isn't linked to yet (nor in skip_members) & one DELETE of the old owner's rows - the ids never leave the
+        database. Returns the number of rows inserted.
+    """
+    owner_column = through._meta.get_field(owner_field).column
+    member_attname = through._meta.get_field(member_field).attname
+    member_column = through._meta.get_field(member_field).column
+
+    linked = through.objects.filter(**{owner_field: new_id}).values(member_attname)
+    members = (
+        through.objects.filter(**{owner_field: old_id})
+        .exclude(**{f"{member_attname}__in": linked})
+        .exclude(**{f"{member_attname}__in": list(skip_members)})
+        .values(member_id=F(member_attname))
+    )
+    sql, params = members.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {connection.ops.quote_name(through._meta.db_table)} "
+            f"({connection.ops.quote_name(owner_column)}, {connection.ops.quote_name(member_column)}) "
+            f"SELECT %s, members.member_id FROM ({sql}) members",
+            [new_id, *params],
+        )
+        inserted = cursor.rowcount
+
+    through.objects.filter(**{owner_field: old_id}).delete()
+    return inserted
+
+
+def _customer_through(field_name):
+    """The m2m table of a Customer field & the names of its customer & member fields"""
+    field = Customer._meta.get_field(field_name)
+    return field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+
+
+def _duplicate_contacts(model, field_name, key, kept, merged):
+    """
+        {contact id: contact id} of the merged customer's contacts that the kept customer already has (the same
+        normalized address, phone number or lowercased email) - two queries on the customers' own contacts
+    """
+    contacts = model.objects.annotate(match_key=key)
+    kept_keys = dict(contacts.filter(**{field_name: kept}).values_list('match_key', 'id'))
+    return {
+        contact_id: kept_keys[match_key]
+        for contact_id, match_key in contacts.filter(**{field_name: merged}).values_list('id', 'match_key')
+        if match_key and match_key in kept_keys
+    }
+
+
+# contacts that are deduplicated by their key when two customers are merged: (Customer field, model, related name, key)
+MERGED_CONTACTS = [
+    ("addresses", Address, "customer_addresses", F('normalized_key')),
+    ("phones", Phone, "customer_phones", F('phone_number')),
+    ("emails", Email, "customer_emails", Lower('email_address')),
+]
+
+
+def merge_customers(kept, merged, user=None):
+    """
+        Merges a duplicate customer (merged) into the customer that is kept & deletes the duplicate. Everything moves
+        with bulk statements in one transaction, not with per-object saves (no m2m / save signal per row):
+
+        - addresses, phones, emails, interests & contact methods: one INSERT ... SELECT per m2m table of the links the
+          kept customer doesn't have - contacts the kept customer already has (same normalized address, phone number
+          or email) are left out & deleted if no other customer uses them (their mailing list rows move to the kept copy)
+        - notes & documents: one UPDATE each
+        - relationships: re-pointed with one UPDATE per side, then the relationships of the customer with itself & the
+          repeated ones (same customers & type) are deleted
+        - mailing lists: the duplicate's memberships move to the kept customer, the lists of the kept customer's
+          interests are completed (add_to_interest_lists) & the versions of the lists they are on are bumped once
+        - a note on the kept customer records the merge
+
+        Returns a MergeResult of what was moved.
+    """
+    if kept.pk == merged.pk:
+        raise MergeError("A customer can't be merged with itself.")
+
+    result = MergeResult()
+    with transaction.atomic():
+        # contacts: links the kept customer doesn't have yet, minus the contacts it already has a copy of
+        for field_name, model, related_name, key in MERGED_CONTACTS:
+            duplicates = _duplicate_contacts(model, related_name, key, kept, merged)
+            through, owner_field, member_field = _customer_through(field_name)
+            moved = _move_through_rows(through, owner_field, member_field, merged.pk, kept.pk, skip_members=duplicates)
+            setattr(result, field_name, moved)
+
+            # the left out copies that nobody else uses are deleted - on a mailing list, the kept copy takes their place
+            unused = list(
+                model.objects.filter(id__in=list(duplicates)).annotate(customers=Count(related_name)).filter(customers=0).values_list('id', flat=True)
+            )
+            if model is Address:
+                list_rows = CustomerMailingList.addresses.through
+                for address_id in unused:
+                    _move_through_rows(list_rows, 'address', 'customermailinglist', address_id, duplicates[address_id])
+            model.objects.filter(id__in=unused).delete()
+
+        for field_name, result_field in (("interests", "interests"), ("preferred_contact_methods", "contact_methods")):
+            through, owner_field, member_field = _customer_through(field_name)
+            setattr(result, result_field, _move_through_rows(through, owner_field, member_field, merged.pk, kept.pk))
+
+        result.notes = CustomerNote.objects.filter(customer=merged).update(customer=kept)
+        result.documents = CustomerDocument.objects.filter(customer=merged).update(customer=kept)
+        if result.notes or result.documents:
+            bump_profile_version([kept.pk])
+
+        # relationships: re-point both sides, then drop the ones with itself & the repeated ones (the oldest is kept)
+        result.relationships = (
+            CustomerRelationship.objects.filter(from_customer=merged).update(from_customer=kept)
+            + CustomerRelationship.objects.filter(to_customer=merged).update(to_customer=kept)
+        )
+        relationships = CustomerRelationship.objects.filter(Q(from_customer=kept) | Q(to_customer=kept))
+        relationships.filter(from_customer=F('to_customer')).delete()
+        first_ids = relationships.order_by().values('from_customer', 'to_customer', 'relationship_type').annotate(first_id=Min('id')).values('first_id')
+        relationships.exclude(id__in=first_ids).delete()
+
+        result.mailing_lists = _move_through_rows(CustomerMailingList.customers.through, 'customer', 'customermailinglist', merged.pk, kept.pk)
+
+        Customer.objects.filter(pk=merged.pk).delete()
+        CustomerNote.objects.create(
+            customer=kept,
+            author=user,
+            note=f"Merged customer #{merged.pk} ({merged}) into this customer: {result}.",
+        )
+
+        # the kept customer's (new) interests & addresses join the interest lists, then the lists they are on are bumped
+        add_to_interest_lists([kept.pk])
+        CustomerMailingList.objects.filter(
+            pk__in=CustomerMailingList.objects.filter(Q(customers=kept) | Q(addresses__customer_addresses=kept)).values('pk')
+        ).update(membership_version=F('membership_version') + 1)
+
+    return result
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0029_rename_documentedithistory_customerdocumenthistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customermailinglist',
+            name='membership_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
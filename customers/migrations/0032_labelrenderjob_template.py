@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 16:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0031_labelrenderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='labelrenderjob',
+            name='template',
+            field=models.CharField(default='avery_5160', help_text='Label sheet / envelope layout (customers.labels.LABEL_TEMPLATES)', max_length=30),
+        ),
+    ]
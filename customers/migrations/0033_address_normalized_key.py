@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-19 16:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0032_labelrenderjob_template'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='normalized_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=400),
+        ),
+        migrations.AddField(
+            model_name='labelrenderjob',
+            name='dedupe',
+            field=models.BooleanField(default=False, help_text='One label per household (duplicate addresses are merged)'),
+        ),
+    ]
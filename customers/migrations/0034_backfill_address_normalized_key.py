@@ -0,0 +1,29 @@
+# Generated by Django 5.1.3 on 2026-10-19 16:29
+
+from django.db import migrations
+
+from customers.addresses import normalize_address_key
+
+
+def backfill_normalized_keys(apps, schema_editor):
+    """Stores the normalized key of every existing address (in batches, so memory stays flat)"""
+    Address = apps.get_model('customers', 'Address')
+    batch = []
+    for address in Address.objects.only('street', 'city', 'state', 'zip_code').iterator(chunk_size=2000):
+        address.normalized_key = normalize_address_key(address.street, address.city, address.state, address.zip_code)
+        batch.append(address)
+        if len(batch) >= 2000:
+            Address.objects.bulk_update(batch, ['normalized_key'])
+            batch = []
+    Address.objects.bulk_update(batch, ['normalized_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0033_address_normalized_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_normalized_keys, migrations.RunPython.noop),
+    ]
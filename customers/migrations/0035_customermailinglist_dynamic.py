@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-19 16:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0034_backfill_address_normalized_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customermailinglist',
+            name='is_dynamic',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='customermailinglist',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='customermailinglist',
+            name='rule',
+            field=models.JSONField(blank=True, default=dict, help_text='interests, states, zip_prefixes, customer_types, created_after, created_before'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:21
+
+import django.core.validators
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0036_customerimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='name_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=160),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='phonetic_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=160),
+        ),
+        migrations.AlterField(
+            model_name='phone',
+            name='phone_number',
+            field=models.CharField(db_index=True, max_length=15, validators=[django.core.validators.RegexValidator(message='Phone number must be in the format 3306742811 or 330-674-2811.', regex='^\\d{10}$|^\\d{3}-\\d{3}-\\d{4}$')]),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(django.db.models.functions.text.Lower('email_address'), name='email_address_lower_idx'),
+        ),
+    ]
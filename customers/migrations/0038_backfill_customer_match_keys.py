@@ -0,0 +1,30 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:21
+
+from django.db import migrations
+
+from customers.matching import name_key, phonetic_key
+
+
+def backfill_match_keys(apps, schema_editor):
+    """Stores the duplicate detection keys of every existing customer (in batches, so memory stays flat)"""
+    Customer = apps.get_model('customers', 'Customer')
+    batch = []
+    for customer in Customer.objects.only('first_name', 'last_name').iterator(chunk_size=2000):
+        customer.name_key = name_key(customer.first_name, customer.last_name)
+        customer.phonetic_key = phonetic_key(customer.name_key)
+        batch.append(customer)
+        if len(batch) >= 2000:
+            Customer.objects.bulk_update(batch, ['name_key', 'phonetic_key'])
+            batch = []
+    Customer.objects.bulk_update(batch, ['name_key', 'phonetic_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0037_duplicate_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_match_keys, migrations.RunPython.noop),
+    ]
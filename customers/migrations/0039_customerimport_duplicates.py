@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0038_backfill_customer_match_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerimport',
+            name='allow_duplicates',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='customerimport',
+            name='duplicates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.3 on 2026-10-19 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0039_customerimport_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerdocument',
+            name='spooled_name',
+            field=models.CharField(blank=True, editable=False, help_text='Name of the upload in the local spool until it is stored', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='customerdocument',
+            name='upload_attempts',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='customerdocument',
+            name='upload_error',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='customerdocument',
+            name='upload_status',
+            field=models.CharField(choices=[('processing', 'Processing'), ('stored', 'Stored'), ('failed', 'Upload failed')], default='stored', editable=False, max_length=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0041_document_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerdocument',
+            name='stored_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the current file was stored', null=True),
+        ),
+    ]
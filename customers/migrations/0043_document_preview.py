@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0042_document_stored_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerdocument',
+            name='preview',
+            field=models.ImageField(blank=True, editable=False, upload_to='document_previews/'),
+        ),
+    ]
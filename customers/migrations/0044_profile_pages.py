@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0043_document_preview'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='profile_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='customerdocument',
+            index=models.Index(fields=['customer', '-created_at', '-id'], name='document_customer_newest'),
+        ),
+        migrations.AddIndex(
+            model_name='customernote',
+            index=models.Index(fields=['customer', '-created_at', '-id'], name='note_customer_newest'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0044_profile_pages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customernotehistory',
+            name='delta',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='customernotehistory',
+            name='is_snapshot',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='customernotehistory',
+            name='previous_note',
+            field=models.TextField(blank=True),
+        ),
+    ]
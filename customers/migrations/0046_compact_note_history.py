@@ -0,0 +1,113 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:40
+
+import json
+import re
+import zlib
+from difflib import SequenceMatcher
+
+from django.db import migrations
+
+# the diff format of the note history when this migration was written (customers.deltas) - copied, so the migration
+# keeps working whatever becomes of that module
+SNAPSHOT_INTERVAL = 10
+
+_TOKENS = re.compile(r"\s+|\S+")
+
+
+def compress_text(text):
+    return zlib.compress(text.encode("utf-8"), 9)
+
+
+def decompress_text(data):
+    return zlib.decompress(data).decode("utf-8")
+
+
+def encode_delta(newer_text, text):
+    newer, older = _TOKENS.findall(newer_text), _TOKENS.findall(text)
+
+    prefix = 0
+    while prefix < min(len(newer), len(older)) and newer[prefix] == older[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(newer), len(older)) - prefix and newer[-1 - suffix] == older[-1 - suffix]:
+        suffix += 1
+
+    operations = [[0, prefix]] if prefix else []
+    matcher = SequenceMatcher(None, newer[prefix:len(newer) - suffix], older[prefix:len(older) - suffix])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            operations.append([prefix + i1, prefix + i2])
+        elif j2 > j1:
+            operations.append("".join(older[prefix + j1:prefix + j2]))
+    if suffix:
+        operations.append([len(newer) - suffix, len(newer)])
+    return zlib.compress(json.dumps(operations, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def apply_delta(newer_text, delta):
+    newer = _TOKENS.findall(newer_text)
+    return "".join(
+        "".join(newer[operation[0]:operation[1]]) if isinstance(operation, list) else operation
+        for operation in json.loads(zlib.decompress(delta))
+    )
+
+
+def encode_version(position, newer_text, text):
+    if (position + 1) % SNAPSHOT_INTERVAL == 0:
+        return compress_text(text), True
+    return encode_delta(newer_text, text), False
+
+
+def compact_note_history(apps, schema_editor):
+    """
+        Stores the existing note history as reverse diffs (& snapshots), note by note - the history of deleted notes
+        can't be diffed against them, it is compressed whole
+    """
+    CustomerNote = apps.get_model('customers', 'CustomerNote')
+    CustomerNoteHistory = apps.get_model('customers', 'CustomerNoteHistory')
+    full_text = CustomerNoteHistory.objects.filter(delta__isnull=True)
+
+    for entry in full_text.filter(customer_note=None).iterator(chunk_size=2000):
+        entry.delta, entry.is_snapshot, entry.previous_note = compress_text(entry.previous_note), True, ""
+        entry.save(update_fields=['delta', 'is_snapshot', 'previous_note'])
+
+    note_ids = full_text.exclude(customer_note=None).values_list('customer_note_id', flat=True).distinct()
+    for note in CustomerNote.objects.filter(id__in=list(note_ids)).only('note').iterator(chunk_size=500):
+        entries = list(CustomerNoteHistory.objects.filter(customer_note=note).order_by('id'))
+        newer_texts = [entry.previous_note for entry in entries[1:]] + [note.note]
+        for position, (entry, newer_text) in enumerate(zip(entries, newer_texts)):
+            entry.delta, entry.is_snapshot = encode_version(position, newer_text, entry.previous_note)
+            entry.previous_note = ""
+        CustomerNoteHistory.objects.bulk_update(entries, ['delta', 'is_snapshot', 'previous_note'])
+
+
+def expand_note_history(apps, schema_editor):
+    """Stores the whole previous text of every history entry again (newest first, from the note)"""
+    CustomerNote = apps.get_model('customers', 'CustomerNote')
+    CustomerNoteHistory = apps.get_model('customers', 'CustomerNoteHistory')
+    notes = {note.pk: note.note for note in CustomerNote.objects.filter(note_history__delta__isnull=False).distinct().only('note')}
+
+    entries = []
+    text = None
+    current_note = object()
+    for entry in CustomerNoteHistory.objects.order_by('customer_note_id', '-id').iterator(chunk_size=2000):
+        if entry.customer_note_id != current_note:
+            current_note, text = entry.customer_note_id, notes.get(entry.customer_note_id)
+        if entry.delta is None:
+            text = entry.previous_note  # stored whole already
+            continue
+        text = decompress_text(entry.delta) if entry.is_snapshot else apply_delta(text, entry.delta)
+        entry.previous_note, entry.delta, entry.is_snapshot = text, None, False
+        entries.append(entry)
+    CustomerNoteHistory.objects.bulk_update(entries, ['previous_note', 'delta', 'is_snapshot'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0045_note_history_deltas'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_note_history, expand_note_history),
+    ]
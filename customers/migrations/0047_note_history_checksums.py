@@ -0,0 +1,59 @@
+# Generated by Django 5.1.3 on 2026-10-19 18:56
+
+import json
+import re
+import zlib
+
+from django.db import migrations, models
+
+# copied from customers.deltas, like the helpers of 0046_compact_note_history
+_TOKENS = re.compile(r"\s+|\S+")
+
+
+def _apply_delta(newer_text, delta):
+    newer = _TOKENS.findall(newer_text)
+    return "".join(
+        "".join(newer[operation[0]:operation[1]]) if isinstance(operation, list) else operation
+        for operation in json.loads(zlib.decompress(delta))
+    )
+
+
+def _text_checksum(text):
+    return f"{zlib.crc32(text.encode('utf-8')):08x}"
+
+
+def backfill_newer_checksums(apps, schema_editor):
+    """Stores the checksum of the text each diff applies to, rebuilding every note's history from the note back"""
+    CustomerNote = apps.get_model('customers', 'CustomerNote')
+    CustomerNoteHistory = apps.get_model('customers', 'CustomerNoteHistory')
+    diffs = CustomerNoteHistory.objects.filter(delta__isnull=False, is_snapshot=False).exclude(customer_note=None)
+
+    for note in CustomerNote.objects.filter(id__in=list(diffs.values_list('customer_note_id', flat=True).distinct())).only('note').iterator(chunk_size=500):
+        entries = []
+        text = note.note
+        for entry in CustomerNoteHistory.objects.filter(customer_note=note).order_by('-id'):
+            if entry.delta is None:
+                text = entry.previous_note
+            elif entry.is_snapshot:
+                text = zlib.decompress(entry.delta).decode('utf-8')
+            else:
+                entry.newer_checksum = _text_checksum(text)
+                entries.append(entry)
+                text = _apply_delta(text, entry.delta)
+        CustomerNoteHistory.objects.bulk_update(entries, ['newer_checksum'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0046_compact_note_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customernotehistory',
+            name='newer_checksum',
+            field=models.CharField(blank=True, editable=False, max_length=8),
+        ),
+        migrations.RunPython(backfill_newer_checksums, migrations.RunPython.noop),
+    ]
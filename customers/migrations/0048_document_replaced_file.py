@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-19 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0047_note_history_checksums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerdocument',
+            name='replaced_file',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
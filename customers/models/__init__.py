@@ -1,3 +1,3 @@
 from .customer import Customer, CustomerRelationship
-from .relationships import CustomerDocument, CustomerNote, CustomerInterest, CustomerMailingList, CustomerNoteHistory, CustomerDocumentHistory
+from .relationships import CustomerDocument, DocumentBlob, CustomerNote, CustomerInterest, CustomerMailingList, CustomerNoteHistory, CustomerDocumentHistory, LabelRenderJob, CustomerImport
 from .contacts import Address, Email, Phone, ContactMethod
\ No newline at end of file
@@ -1,6 +1,8 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django.core.validators import MinLengthValidator, MaxLengthValidator, RegexValidator
 from django.core.exceptions import ValidationError
+from customers.addresses import normalize_address_key
 
 class Address(models.Model):
     """
@@ -72,6 +74,9 @@ class Address(models.Model):
         blank=False,
         null=False)
     mailing_address = models.BooleanField(default=True)
+
+    # uppercased address with USPS abbreviations - the same for every way an address is typed in (householding / dedupe)
+    normalized_key = models.CharField(max_length=400, blank=True, db_index=True, editable=False)
     
     def clean(self):
  # Ensure that a mailing address must have a street
@@ -83,6 +88,16 @@ class Address(models.Model):
         street = f"{self.street}, " if self.street else " "  
         return f"{address_type}: {street}{self.city}, {self.state} {self.zip_code}"
 
+    def save(self, *args, **kwargs):
+        """Keeps the normalized key in step with the street, city, state & zip code"""
+        self.normalized_key = normalize_address_key(self.street, self.city, self.state, self.zip_code)
+
+        # saves limited to some fields still store the new key
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'street', 'city', 'state', 'zip_code'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'normalized_key'}
+        super().save(*args, **kwargs)
+
 class Email(models.Model):
     """
         Email of Customers: Email is required and it is automatically set as a default email, other fields: type of email, etc. are not
@@ -95,6 +110,10 @@ class Email(models.Model):
     }
     email_type = models.CharField(max_length=4, choices=EMAIL_TYPE_CHOICES, blank=True, null=True)
     preferred_email = models.BooleanField(default=True)
+
+    class Meta:
+        # duplicate detection looks customers up by lowercased email address
+        indexes = [models.Index(Lower('email_address'), name='email_address_lower_idx')]
    
     
     def __str__(self):
@@ -105,6 +124,7 @@ class Phone(models.Model):
     phone_number = models.CharField(
         max_length=15,
         blank=False,
+        db_index=True,  # duplicate detection looks customers up by phone number
         validators=[
             RegexValidator(
                 regex=r'^\d{10}$|^\d{3}-\d{3}-\d{4}$',
@@ -140,8 +160,8 @@ class Phone(models.Model):
         phone_type = f" ({self.get_phone_type_display()})" if self.phone_type else ""  
         return f"{self.phone_number}{ext}{phone_type}"
     
-    def save(self, *args, **kwargs):
-        # Standardize the phone number format to `330-674-2811`
+    def standardize_phone_number(self):
+        """Standardizes the phone number format to `330-674-2811` (also used before bulk inserts, which skip save)"""
         if self.phone_number:
             # Remove all non-digit characters
             digits_only = ''.join(filter(str.isdigit, self.phone_number))
@@ -149,7 +169,9 @@ class Phone(models.Model):
             # Format if it has 10 digits
             if len(digits_only) == 10:
                 self.phone_number = f"{digits_only[:3]}-{digits_only[3:6]}-{digits_only[6:]}"
-        
+
+    def save(self, *args, **kwargs):
+        self.standardize_phone_number()
         super().save(*args, **kwargs)
 
 class ContactMethod(models.Model):
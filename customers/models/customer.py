@@ -1,6 +1,8 @@
 from django.db import models
+from django.db.models import F
 from django.core.validators import ValidationError
 from app_users.models import CustomUser
+from customers.matching import name_key, phonetic_key
 
 
 class Customer(models.Model):
@@ -58,7 +60,32 @@ class Customer(models.Model):
 
     # keeps track of who creates the customer
     creator = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='creator_customer') # if the CustomUser is deleted -> author is set to null 
-    
+
+    # blocking keys of the duplicate detection (customers.duplicates): the normalized name & its soundex
+    name_key = models.CharField(max_length=160, blank=True, db_index=True, editable=False)
+    phonetic_key = models.CharField(max_length=160, blank=True, db_index=True, editable=False)
+
+    # bumped whenever the customer's notes or documents (or PROFILE_PAGE_FIELDS) change - the cached pages of the
+    # profile are keyed by it
+    profile_version = models.PositiveIntegerField(default=0, editable=False)
+
+    # fields of the customer the cached pages of the profile show (the name, the creator's profile link)
+    PROFILE_PAGE_FIELDS = ('first_name', 'last_name', 'customer_type', 'creator_id')
+
+    # fields of the customer printed on its mailing labels (the display name)
+    LABEL_FIELDS = ('first_name', 'last_name', 'customer_type')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Keeps the loaded values of PROFILE_PAGE_FIELDS - saves compare them to tell what changed"""
+        instance = super().from_db(db, field_names, values)
+        instance.remember_stored_fields()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        self.remember_stored_fields(None if fields is None else [self._meta.get_field(field).attname for field in fields])
+
     def clean(self):
         """
             Validation: Ensure both first and last name fields are provided for a customer of type "person".
@@ -75,6 +102,55 @@ class Customer(models.Model):
             if self.last_name:
                 raise ValidationError("For non-person entities, please do not include a last name. Add a First Name, only.")
 
+    def set_match_keys(self):
+        """Sets the duplicate detection keys from the name (also used before bulk inserts, which skip save)"""
+        self.name_key = name_key(self.first_name, self.last_name)
+        self.phonetic_key = phonetic_key(self.name_key)
+
+    def remember_stored_fields(self, fields=None):
+        """Keeps the values of PROFILE_PAGE_FIELDS (or of the given ones among them) as they are in the database"""
+        stored = self.__dict__.setdefault('_stored_fields', {})
+        for field in self.PROFILE_PAGE_FIELDS if fields is None else set(fields) & set(self.PROFILE_PAGE_FIELDS):
+            if field in self.__dict__:  # a deferred field that was never read can't have changed
+                stored[field] = self.__dict__[field]
+
+    def changed_fields(self, fields):
+        """
+            The fields (of PROFILE_PAGE_FIELDS) changed since the customer was loaded or last saved - no query: the
+            values are compared with the ones it was loaded with (every field of a customer that was never saved)
+        """
+        stored = self.__dict__.get('_stored_fields', {})
+        return {
+            field for field in fields
+            if field in self.__dict__ and (field not in stored or self.__dict__[field] != stored[field])
+        }
+
+    def save(self, *args, **kwargs):
+        """Keeps the duplicate detection keys in step with the name & bumps profile_version when the profile changes"""
+        self.set_match_keys()
+
+        # saves limited to some fields still store the new keys
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'first_name', 'last_name'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'name_key', 'phonetic_key'}
+
+        # the cached profile pages are invalidated when a field they show changes: the version is bumped in the UPDATE
+        # itself (F()), never written back from this instance - notes & documents may have bumped it since it was loaded
+        saved = set(self.PROFILE_PAGE_FIELDS)
+        if update_fields is not None:
+            saved &= {'creator_id' if field == 'creator' else field for field in update_fields}
+        if not self._state.adding:
+            if self.changed_fields(saved):
+                self.profile_version = F('profile_version') + 1
+                if update_fields is not None:
+                    kwargs['update_fields'] = {*kwargs['update_fields'], 'profile_version'}
+            elif update_fields is None:
+                self.profile_version = F('profile_version')
+        super().save(*args, **kwargs)
+
+        if hasattr(self.profile_version, 'resolve_expression'):
+            del self.profile_version  # read from the database the next time it is used
+        self.remember_stored_fields(saved)
 
     def __str__(self):
         """
@@ -1,14 +1,20 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Aggregate, Case, Count, F, OuterRef, Q, Subquery, When, Window
+from django.db.models.functions import Coalesce, RowNumber
 import os
 from app_users.models import CustomUser
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from django.utils.text import get_valid_filename
 
 from django.core.validators import RegexValidator, MinLengthValidator, MaxLengthValidator
 
 # provides an interface to access static files & file storage paths
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django_cleanup import cleanup
+
+from customers.deltas import encode_version, text_checksum
 
 
 def validate_file_type(value):
@@ -20,6 +26,24 @@ def validate_file_type(value):
     if ext not in valid_extensions:
         raise ValidationError(f"Unsupported file type: {ext}. Only PDF and Word documents are allowed.")
 
+class DocumentBlob(models.Model):
+    """
+        A stored file, keyed by the SHA-256 of its content: documents with the same content (the blank W-9 attached to
+        many customers) share one blob instead of each storing a copy. reference_count is the number of documents
+        pointing to it - the blob is deleted when the last one goes (customers.documents.release_blob) & django-cleanup
+        deletes its file.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to="document_blobs/")
+    size = models.PositiveBigIntegerField(default=0)
+    reference_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.reference_count} document(s))"
+
+
+@cleanup.ignore  # a stored file can be shared - see customers.documents.release_document_file
 class CustomerDocument(models.Model):
     """
         Allows for the Linking of Multiple Documents to Individual Customers
@@ -55,7 +79,48 @@ class CustomerDocument(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     
     customer = models.ForeignKey('Customer', on_delete=models.CASCADE, related_name="documents")
+
+    # uploads are spooled to local disk & pushed to the storage backend in the background (customers.documents)
+    UPLOAD_STATUS_CHOICES = [
+        ('processing', 'Processing'),
+        ('stored', 'Stored'),
+        ('failed', 'Upload failed'),
+    ]
+    upload_status = models.CharField(max_length=10, choices=UPLOAD_STATUS_CHOICES, default='stored', editable=False)
+    spooled_name = models.CharField(max_length=255, blank=True, editable=False, help_text="Name of the upload in the local spool until it is stored")
+    upload_attempts = models.PositiveIntegerField(default=0, editable=False)
+    upload_error = models.TextField(blank=True, editable=False)
+    stored_at = models.DateTimeField(null=True, blank=True, editable=False, help_text="When the current file was stored")
+
+    # the stored file is shared by every document with the same content - file then points to the blob's file &
+    # file_name keeps the name the document is shown under
+    blob = models.ForeignKey(DocumentBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='documents', editable=False)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False, help_text="SHA-256 of the uploaded file")
+    file_name = models.CharField(max_length=255, blank=True, editable=False)
+    # the file of its own a document stored before blobs had - deleted once the upload replacing it is stored
+    replaced_file = models.CharField(max_length=255, blank=True, editable=False)
+
+    # small image of the first page, rendered in the background (customers.previews) & shared by documents with the
+    # same content - cleared when the document is edited
+    preview = models.ImageField(upload_to="document_previews/", blank=True, editable=False)
     
+    @property
+    def is_stored(self):
+        """The file is in storage (it can be downloaded)"""
+        return self.upload_status == 'stored'
+
+    @property
+    def last_modified(self):
+        """When the current file was stored (documents stored before uploads were spooled: when they were created)"""
+        return self.stored_at or self.created_at
+
+    @property
+    def display_name(self):
+        """The name of the file (a shared blob is named after its hash, not after the customer)"""
+        if self.blob_id and self.file_name:
+            return self.file_name
+        return os.path.basename(self.file.name)
+
     def clean(self):
         super().clean()
         # If file_type is 'other', ensure that file_detail is provided.
@@ -69,25 +134,57 @@ class CustomerDocument(models.Model):
         """
             Returns the File Name & Description or just the file name, both have the timestamp
         """
-        file_name = os.path.basename(self.file.name)  # Extract just the file name
+        file_name = self.display_name  # Extract just the file name
         if self.file_detail:  
             return f'{file_name} - Desc: {self.file_detail}'  
         else:  
             return f'{file_name}'
         
-    def save(self, *args, **kwargs):
-        """Custom save method to update the file name of the file uploaded"""
+    def rename_file(self):
+        """Names the uploaded file after the customer, file type & year (also used before bulk inserts, which skip save)"""
         if self.file:
             file_type = dict(self.FILE_TYPES).get(self.file_type, "")
             customer_name = self.customer.display_name
             year = timezone.now().year
             new_file_name = f"{customer_name}_{file_type}_{year}.pdf"
-            self.file.name = new_file_name
+            self.file_name = get_valid_filename(new_file_name)  # as the storage would name it
+            # a shared blob keeps its name in storage
+            if not self.blob_id:
+                self.file.name = new_file_name
+
+    def save(self, *args, **kwargs):
+        """Custom save method to update the file name of the file uploaded"""
+        self.rename_file()
         super().save(*args, **kwargs)
         
     class Meta:
         # order so that the most recent customer created is shown first
         ordering = ['-created_at']
+        # the profile pages through a customer's documents, newest first (customers.profile)
+        indexes = [models.Index(fields=['customer', '-created_at', '-id'], name='document_customer_newest')]
+
+
+class CustomerNoteQuerySet(models.QuerySet):
+    """Querysets of notes"""
+
+    def with_note_numbers(self):
+        """
+            Annotates note_number - the position of each note among its customer's notes, oldest first - with a
+            ROW_NUMBER() window, so a list of notes is numbered in the same single query (no count per note).
+
+            - the window numbers the notes the query selects: select a customer's notes first (customer.notes), but
+              narrow them down with numbered_filter() so the notes left out still count
+        """
+        return self.annotate(note_number=Window(RowNumber(), partition_by=[F('customer_id')], order_by=F('id').asc()))
+
+    def numbered_filter(self, *args, **kwargs):
+        """
+            with_note_numbers(), keeping only the notes that match the lookups / Q objects given: the condition is put
+            in a window expression, which django filters on around the query numbering the notes (a QUALIFY)
+        """
+        numbered = self.with_note_numbers()
+        matched = Case(When(Q(*args, **kwargs), then=F('note_number')), default=None)
+        return numbered.alias(numbered_match=matched).filter(numbered_match__isnull=False)
 
 
 class CustomerNote(models.Model):
@@ -113,10 +210,50 @@ class CustomerNote(models.Model):
     class Meta:
         # order so that the most recent customer created is shown first
         ordering = ['-created_at']
-        
+        # the profile pages through a customer's notes, newest first (customers.profile)
+        indexes = [models.Index(fields=['customer', '-created_at', '-id'], name='note_customer_newest')]
+
+    objects = CustomerNoteQuerySet.as_manager()
+
     @property
     def note_number(self):
-        return CustomerNote.objects.filter(customer=self.customer, id__lte=self.id).count()
+        """
+            Position of the note among its customer's notes, oldest first: annotated when the note comes from
+            CustomerNote.objects.with_note_numbers() - counted (a query) when it was loaded on its own
+        """
+        if getattr(self, '_note_number', None) is None:
+            self._note_number = CustomerNote.objects.filter(customer_id=self.customer_id, id__lte=self.id).count()
+        return self._note_number
+
+    @note_number.setter
+    def note_number(self, value):
+        # set by the with_note_numbers() annotation
+        self._note_number = value
+
+    def save(self, *args, **kwargs):
+        """
+            Records the version of the note before an edit in its history - in the same transaction as the edit, from
+            the stored text, whoever saves it (forms, admin...). Set .editor to the user making the edit.
+        """
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            if not self._state.adding and (update_fields is None or 'note' in update_fields):
+                previous = CustomerNote.objects.select_for_update().filter(pk=self.pk).values_list('note', flat=True).first()
+                if previous is not None and previous != self.note:
+                    self.record_edit(previous)
+            super().save(*args, **kwargs)
+
+    def record_edit(self, previous_text):
+        """
+            Adds the version before an edit to the history: a compressed reverse diff against the edited text (with a
+            checksum of it, so a chain broken by an edit that was not recorded is detected) or, every few edits, all
+            of it - see customers.note_history
+        """
+        delta, is_snapshot = encode_version(self.note_history.count(), self.note, previous_text)
+        return CustomerNoteHistory.objects.create(
+            customer_note=self, edited_by=getattr(self, 'editor', None), delta=delta, is_snapshot=is_snapshot,
+            newer_checksum=text_checksum(self.note),
+        )
         
 class CustomerInterest(models.Model):
     """
@@ -150,6 +287,66 @@ class CustomerInterest(models.Model):
             # Return the default star image URL from settings
             return settings.DEFAULT_STAR_IMAGE_URL
 
+class CustomerMailingListQuerySet(models.QuerySet):
+    """Querysets of mailing lists"""
+
+    def with_counts(self):
+        """
+            Annotates every mailing list with customer_total & address_total - counted on the m2m tables with correlated
+            subqueries, so they come back with the mailing lists in the same query (no .count() per list)
+        """
+        return self.annotate(
+            customer_total=_through_count(CustomerMailingList.customers.through),
+            address_total=_through_count(CustomerMailingList.addresses.through),
+        )
+
+    def with_summary(self):
+        """
+            with_counts() plus what the mailing list index shows - all in the same single query:
+
+            - mailable_total: addresses on the list that are still marked as mailing addresses
+            - interest_names: the names of the list's interests, joined with ', ' ('' when there are none)
+        """
+        interest_names = (
+            CustomerMailingList.interests.through.objects.filter(customermailinglist=OuterRef('pk'))
+            .order_by()
+            .values('customermailinglist')
+            .annotate(names=GroupConcat('customerinterest__name'))
+            .values('names')
+        )
+        return self.with_counts().annotate(
+            mailable_total=_through_count(CustomerMailingList.addresses.through, address__mailing_address=True),
+            interest_names=Coalesce(Subquery(interest_names, output_field=models.CharField()), models.Value("")),
+        )
+
+
+def _through_count(through, **filters):
+    """Subquery counting the rows of a mailing list m2m table that belong to the outer mailing list (& match filters)"""
+    rows = (
+        through.objects.filter(customermailinglist=OuterRef('pk'), **filters)
+        .order_by()
+        .values('customermailinglist')
+        .annotate(total=Count('*'))
+        .values('total')
+    )
+    return Coalesce(Subquery(rows, output_field=models.IntegerField()), 0)
+
+
+class GroupConcat(Aggregate):
+    """
+        Joins the values of a group into one ', ' separated string:
+        GROUP_CONCAT on sqlite (development), STRING_AGG on postgres (production)
+    """
+    function = "GROUP_CONCAT"
+    output_field = models.CharField()
+
+    def __init__(self, expression, **extra):
+        super().__init__(expression, models.Value(", "), **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function="STRING_AGG", **extra_context)
+
+
 class CustomerMailingList(models.Model):
     """Creates a mailing list based on interests"""
     name = models.CharField(max_length=255, unique=True, validators=[MinLengthValidator(4), MaxLengthValidator(50), RegexValidator(regex=r'^[a-zA-Z0-9\s-]+$', message="Name can only contain letters, spaces, numbers and dashes.")], help_text="Mailing List Name: 'Fish Sale', 'Summer Camp' (if based on an interest) or a custom name")
@@ -160,6 +357,17 @@ class CustomerMailingList(models.Model):
     # creates a timestamp for when the mailing list was created
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # bumped (by signals) whenever list membership or a member address changes - keys cached label pdfs
+    membership_version = models.PositiveIntegerField(default=1, editable=False)
+
+    # dynamic lists: members come from a stored rule (see customers.mailing_lists) - the snapshot on the m2m tables is
+    # only refreshed when the list is viewed, exported or printed, the membership signals leave it alone
+    is_dynamic = models.BooleanField(default=False)
+    rule = models.JSONField(default=dict, blank=True, help_text="interests, states, zip_prefixes, customer_types, created_after, created_before")
+    refreshed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = CustomerMailingListQuerySet.as_manager()
+
 
     def __str__(self):
         return self.name
@@ -174,17 +382,141 @@ class CustomerMailingList(models.Model):
         """
         return self.customers.count()
 
+    def remove_addresses(self, address_ids):
+        """
+            Removes addresses from this mailing list, then the customers that no longer have an address on it.
+            Both are removed set-wise (one delete each) whatever the number of addresses.
+
+            - returns the ids of the customers that were removed
+        """
+        self.addresses.remove(*address_ids)
+
+        # customers of the removed addresses without any address left on the list
+        customer_ids = list(
+            self.customers.filter(addresses__in=address_ids)
+            .exclude(addresses__mailing_addresses=self)
+            .values_list('id', flat=True)
+            .distinct()
+        )
+        if customer_ids:
+            self.customers.remove(*customer_ids)
+        return customer_ids
+
+
+class LabelRenderJob(models.Model):
+    """Tracks a mailing label pdf rendered in the background (very large mailing lists)"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    mailing_list = models.ForeignKey(CustomerMailingList, on_delete=models.CASCADE, related_name="label_jobs")
+    template = models.CharField(max_length=30, default="avery_5160", help_text="Label sheet / envelope layout (customers.labels.LABEL_TEMPLATES)")
+    start_position = models.PositiveIntegerField(default=0, help_text="0-based label slot the first label is printed on")
+    dedupe = models.BooleanField(default=False, help_text="One label per household (duplicate addresses are merged)")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+
+    # file name of the finished pdf in the label cache
+    pdf_name = models.CharField(max_length=255, blank=True)
+
+    # throughput of the run
+    labels = models.PositiveIntegerField(default=0)
+    pages = models.PositiveIntegerField(default=0)
+    seconds = models.FloatField(default=0)
+
+    error = models.TextField(blank=True)
+    requested_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='label_jobs') # if the CustomUser is deleted -> set to null
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Labels for {self.mailing_list} ({self.get_status_display()})'
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    @property
+    def labels_per_second(self):
+        """Returns the rendering throughput in labels per second"""
+        return self.labels / self.seconds if self.seconds else 0
+
+
+class CustomerImport(models.Model):
+    """Tracks a csv / excel file of customers being imported in the background (customers.imports)"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    # name of the uploaded file & of its copy in the import directory (CUSTOMER_IMPORT_ROOT)
+    file_name = models.CharField(max_length=255)
+    staged_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+
+    # rows that are likely duplicates of a customer are skipped unless allowed
+    allow_duplicates = models.BooleanField(default=False)
+
+    # progress & throughput of the run
+    rows = models.PositiveIntegerField(default=0)
+    imported = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    seconds = models.FloatField(default=0)
+
+    # csv report of the rows that were not imported (row number, column & error) - in the import directory
+    report_name = models.CharField(max_length=255, blank=True)
+
+    error = models.TextField(blank=True)
+    requested_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='customer_imports') # if the CustomUser is deleted -> set to null
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Import of {self.file_name} ({self.get_status_display()})'
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    @property
+    def rows_per_minute(self):
+        """Returns the import throughput in rows per minute"""
+        return self.rows * 60 / self.seconds if self.seconds else 0
+
     
 class CustomerNoteHistory(models.Model):
-    """Stores the edit history of CustomerNotes"""
+    """Stores the edit history of CustomerNotes - the versions are rebuilt by customers.note_history"""
     customer_note = models.ForeignKey(CustomerNote, on_delete=models.SET_NULL, related_name="note_history", null=True)
-    previous_note = models.TextField()
+    # the whole previous text: entries stored before the history was kept as diffs
+    previous_note = models.TextField(blank=True)
+    # zlib compressed: a reverse diff rebuilding the previous text from the next version, or all of it (is_snapshot)
+    delta = models.BinaryField(null=True, editable=False)
+    is_snapshot = models.BooleanField(default=False, editable=False)
+    # checksum of the version the diff applies to ('' for entries stored before it was kept)
+    newer_checksum = models.CharField(max_length=8, blank=True, editable=False)
     edited_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='edit_authors') # if the CustomUser is deleted -> author is set to null 
     edited_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
         return f'{self.customer_note} was last edited by {self.edited_by} at {self.edited_at.strftime("%B %d, %Y, %I:%M %p")}'
 
+    def clean(self):
+        super().clean()
+        # an entry without a diff has the previous text
+        if self.delta is None and not self.previous_note:
+            raise ValidationError({'previous_note': "The previous note is required."})
+
 class CustomerDocumentHistory(models.Model):
     """
     Tracks changes made to a CustomerDocument.
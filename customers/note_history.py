@@ -0,0 +1,81 @@
+from django.db.models import Q
+
+from .deltas import apply_delta, compress_text, decompress_text, text_checksum
+from .models import CustomerNoteHistory
+
+# The edit history of a note is kept as reverse diffs: each history entry rebuilds the version of the note before an
+# edit from the version after it (the next entry, or the note itself for the newest one) - with a full snapshot every
+# few entries. Entries are recorded by CustomerNote.save(); entries stored before the diffs keep the whole previous
+# text in previous_note. A diff carries a checksum of the text it was made against: if that text was changed without
+# an entry being recorded (a queryset update...) the versions behind it can't be rebuilt & are None - until an entry
+# stored whole.
+
+
+def _stored_text(entry):
+    """The text of a history entry stored whole (a snapshot or an entry from before the diffs) - None for a diff"""
+    if entry.delta is None:
+        return entry.previous_note
+    if entry.is_snapshot:
+        return decompress_text(entry.delta)
+    return None
+
+
+def _entry_text(entry, newer_text):
+    """The text of an entry, from the version after it - None if that version is not the one its diff was made against"""
+    stored = _stored_text(entry)
+    if stored is not None:
+        return stored
+    if newer_text is None or (entry.newer_checksum and entry.newer_checksum != text_checksum(newer_text)):
+        return None
+    return apply_delta(newer_text, entry.delta)
+
+
+def note_versions(note):
+    """
+        The history of a note, newest first, with their editors: each entry has the text of the note before that edit
+        in .text (None if it can't be rebuilt) - rebuilt in a single pass from the note back (one query)
+    """
+    entries = list(note.note_history.select_related('edited_by').order_by('-id'))
+    text = note.note
+    for entry in entries:
+        text = entry.text = _entry_text(entry, text)
+    return entries
+
+
+def note_version(entry):
+    """
+        The text of the note before the edit of a history entry: rebuilt from the nearest newer snapshot (or the note),
+        so at most SNAPSHOT_INTERVAL diffs are read & applied - None if the chain is broken
+    """
+    stored = _stored_text(entry)
+    if stored is not None:
+        return stored
+
+    history = CustomerNoteHistory.objects.filter(customer_note_id=entry.customer_note_id)
+    anchor = (
+        history.filter(Q(is_snapshot=True) | Q(delta__isnull=True), id__gt=entry.id).order_by('id').values_list('id', flat=True).first()
+    )
+    chain = history.filter(id__gte=entry.id)
+    if anchor is None:
+        text = entry.customer_note.note if entry.customer_note_id else None
+    else:
+        chain = chain.filter(id__lte=anchor)
+        text = None  # the first (newest) entry of the chain is the snapshot
+
+    for link in chain.order_by('-id'):
+        text = _entry_text(link, text)
+        if text is None:
+            return None  # broken chain: stop
+    return text
+
+
+def materialize_note_history(note):
+    """
+        Stores the diffs of a note's history whole (compressed) - they can't be rebuilt once the note is deleted
+    """
+    entries = [
+        entry for entry in note_versions(note) if entry.delta is not None and not entry.is_snapshot and entry.text is not None
+    ]
+    for entry in entries:
+        entry.delta, entry.is_snapshot = compress_text(entry.text), True
+    CustomerNoteHistory.objects.bulk_update(entries, ['delta', 'is_snapshot'])
@@ -0,0 +1,138 @@
+import io
+import logging
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from PIL import Image, ImageDraw, ImageFont
+from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+
+from .models import CustomerDocument
+from .profile import bump_profile_version
+from .tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_FOLDER = "document_previews"
+PREVIEW_SIZE = (200, 260)  # the most a preview measures (pixels) - about the shape of a letter page
+PAGE_SIZE = (612, 792)  # a letter page at 72 dpi: what the first page is drawn on before it is shrunk
+PAGE_MARGIN = 36
+TEXT_LINE_HEIGHT = 12
+
+
+def preview_name(document):
+    """
+        Storage name of a document's preview: previews are cached by content, so documents sharing a stored file share
+        their preview (documents stored before uploads were hashed get one of their own)
+    """
+    if document.content_hash:
+        return f"{PREVIEW_FOLDER}/{document.content_hash}.png"
+    return f"{PREVIEW_FOLDER}/document-{document.pk}.png"
+
+
+def render_first_page(file):
+    """
+        PNG (bytes) of a small preview of the first page of a pdf - None for other files, encrypted or empty pdfs.
+
+        Pages are not rasterized (no pdf renderer is installed): the largest image on the page is shown (a scanned
+        form is a single image), otherwise the text of the page is drawn where the lines would be.
+    """
+    try:
+        reader = PdfReader(file)
+        if reader.is_encrypted and not reader.decrypt(""):
+            return None
+        page = reader.pages[0]
+    except (PdfReadError, IndexError, ValueError) as e:
+        logger.info("No preview: %s", e)
+        return None
+
+    canvas = Image.new("RGB", PAGE_SIZE, "white")
+    scan = _largest_image(page)
+    if scan is not None:
+        scan.thumbnail(PAGE_SIZE)
+        canvas.paste(scan.convert("RGB"), ((PAGE_SIZE[0] - scan.width) // 2, (PAGE_SIZE[1] - scan.height) // 2))
+    else:
+        text = page.extract_text() or ""
+        if not text.strip():
+            return None
+        draw = ImageDraw.Draw(canvas)
+        font = ImageFont.load_default()
+        lines = text.splitlines()[:(PAGE_SIZE[1] - 2 * PAGE_MARGIN) // TEXT_LINE_HEIGHT]
+        for number, line in enumerate(lines):
+            draw.text((PAGE_MARGIN, PAGE_MARGIN + number * TEXT_LINE_HEIGHT), line[:90], fill="black", font=font)
+
+    canvas.thumbnail(PREVIEW_SIZE)
+    output = io.BytesIO()
+    canvas.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+def _largest_image(page):
+    """The largest image on a pdf page that can be decoded (None without any)"""
+    largest = None
+    try:
+        images = list(page.images)
+    except Exception:  # images in filters pypdf/pillow can't decode
+        return None
+    for image_file in images:
+        try:
+            image = image_file.image
+        except Exception:
+            continue
+        if largest is None or image.width * image.height > largest.width * largest.height:
+            largest = image
+    return largest
+
+
+def render_document_preview(document_id):
+    """
+        Background job: renders the preview of a stored document - or reuses the one cached in storage for the same
+        content - & sets it on every stored document showing that file. Returns True once the document has a preview.
+    """
+    document = CustomerDocument.objects.filter(pk=document_id, upload_status='stored').exclude(file="").first()
+    if document is None:
+        return False
+    storage = document.preview.storage
+    name = preview_name(document)
+
+    if not storage.exists(name):
+        try:
+            with document.file.storage.open(document.file.name, "rb") as file:
+                png = render_first_page(file)
+        except FileNotFoundError:
+            return False
+        if png is None:
+            return False
+        name = storage.save(name, ContentFile(png))
+
+    showing = CustomerDocument.objects.filter(file=document.file.name, upload_status='stored')
+    if not showing.update(preview=name):
+        # deleted or replaced in the meantime
+        release_preview(name)
+        return False
+    bump_profile_version(showing.values('customer_id'))
+    return True
+
+
+def queue_document_previews(document_ids):
+    """Renders the previews of documents in the background, once the transaction saving them has committed"""
+    document_ids = list(document_ids)
+
+    def queue():
+        for document_id in document_ids:
+            run_in_background(render_document_preview, document_id)
+
+    transaction.on_commit(queue)
+
+
+def release_preview(name):
+    """A document no longer shows this preview: deleted after the transaction committed, unless another document does"""
+    if not name:
+        return
+
+    def delete():
+        if not CustomerDocument.objects.filter(preview=name).exists():
+            CustomerDocument._meta.get_field('preview').storage.delete(name)
+
+    transaction.on_commit(delete)
@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Prefetch, Q
+from django.shortcuts import get_object_or_404
+
+from .models import Address, ContactMethod, Customer, CustomerInterest, CustomerMailingList, Email, Phone
+
+# items on the first page of each section of the profile - the rest is loaded by "load more" (newest first)
+NOTES_PAGE_SIZE = 10
+DOCUMENTS_PAGE_SIZE = 9  # three rows of the documents grid
+ALL_NOTES_PAGE_SIZE = 20
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def bump_profile_version(customer_ids):
+    """
+        Increments the profile_version of customers (ids or a values('pk') queryset) in a single UPDATE: their cached
+        profile pages are not used any more
+    """
+    Customer.objects.filter(pk__in=customer_ids).update(profile_version=F('profile_version') + 1)
+
+
+# ------------------------- KEYSET PAGINATION: newest first, on (created_at, id) -------------------------
+def encode_cursor(row):
+    """Cursor of the last row of a page: its created_at (microseconds since the epoch) & id - '1718000000000000-42'"""
+    microseconds = (row.created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{microseconds}-{row.pk}"
+
+
+def decode_cursor(cursor):
+    """(created_at, id) of a cursor - None for the first page (no cursor) or one that was tampered with"""
+    try:
+        microseconds, pk = (int(part) for part in (cursor or "").split("-"))
+        return _EPOCH + timedelta(microseconds=microseconds), pk
+    except (ValueError, OverflowError):
+        return None
+
+
+def after_cursor(cursor):
+    """Q of the rows after a cursor (older, or as old with a lower id) - Q() for the first page"""
+    position = decode_cursor(cursor)
+    if position is None:
+        return Q()
+    created_at, pk = position
+    return Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+
+
+def keyset_page(queryset, size):
+    """
+        The first size rows of a queryset (already narrowed down to the rows after the cursor), newest first, & the
+        cursor of the next page (None on the last page) - one row more is read to know if there is a next page
+    """
+    rows = list(queryset.order_by('-created_at', '-pk')[:size + 1])
+    next_cursor = encode_cursor(rows[size - 1]) if len(rows) > size else None
+    return rows[:size], next_cursor
+
+
+# ------------------------- SECTIONS of the profile: pages of notes & documents -------------------------
+PROFILE_SECTIONS = {
+    # section: (page size, template of a page, whether the page depends on the user viewing it)
+    'notes': (NOTES_PAGE_SIZE, 'customers/partials/profile_notes_page.html', False),
+    'documents': (DOCUMENTS_PAGE_SIZE, 'customers/partials/profile_documents_page.html', True),
+    'all-notes': (ALL_NOTES_PAGE_SIZE, 'customers/partials/all_notes_page.html', False),
+}
+
+
+def profile_section_page(customer, section, cursor=None):
+    """
+        A page of a section of the profile: (rows, next cursor).
+
+        - notes & documents come with their author (select_related)
+        - the notes of the all notes page are numbered among all of the customer's notes (the page is narrowed down
+          after they are numbered)
+    """
+    size = PROFILE_SECTIONS[section][0]
+    after = after_cursor(cursor)
+    if section == 'notes':
+        rows = customer.notes.filter(after).select_related('author')
+    elif section == 'documents':
+        rows = customer.documents.filter(after).select_related('author')
+    else:
+        rows = customer.notes.numbered_filter(after).select_related('author')
+    return keyset_page(rows, size)
+
+
+def cached_section_page(customer, section, cursor, user, render):
+    """
+        The html of a page of a profile section - rendered by render() the first time & then from the cache, until the
+        customer's notes, documents or name change (the key has the customer's profile_version)
+    """
+    key = f"customer-profile:{customer.pk}:{customer.profile_version}:{section}:{cursor or 'first'}"
+    if PROFILE_SECTIONS[section][2]:
+        key += f":user-{user.pk}"
+    return cache.get_or_set(key, render, settings.PROFILE_FRAGMENT_CACHE_TIMEOUT)
+
+
+# ------------------------- PROFILE LOADER: everything the profile page shows, in a fixed number of queries -------------------------
+def profile_queryset():
+    """
+        Customers with everything their profile shows: the creator & the number of documents in the customer's query,
+        then one query per related list (ordered like the page lists them).
+
+        - the prefetched lists are kept on the customer for the request: customer.addresses.all, .count & .exists (&
+          preferred_contact_methods_display) are answered from them, the templates never query again
+    """
+    return Customer.objects.select_related('creator').annotate(document_count=Count('documents')).prefetch_related(
+        Prefetch('interests', queryset=CustomerInterest.objects.order_by('name')),
+        Prefetch('preferred_contact_methods', queryset=ContactMethod.objects.order_by('id')),
+        Prefetch('addresses', queryset=Address.objects.order_by('id')),
+        Prefetch('phones', queryset=Phone.objects.order_by('id')),
+        Prefetch('emails', queryset=Email.objects.order_by('id')),
+        Prefetch('mailing_lists', queryset=CustomerMailingList.objects.order_by('-created_at')),
+    )
+
+
+def load_customer_profile(customer_id):
+    """
+        Context of the profile page of a customer (404 if there is none): the customer (see profile_queryset) & the
+        first pages of their notes & documents with their authors - 9 queries however much the customer has
+    """
+    customer = get_object_or_404(profile_queryset(), pk=customer_id)
+    customer_notes, notes_cursor = profile_section_page(customer, 'notes')
+    customer_documents, documents_cursor = profile_section_page(customer, 'documents')
+    return {
+        'customer': customer,
+        'customer_notes': customer_notes,
+        'notes_cursor': notes_cursor,
+        'customer_documents': customer_documents,
+        'documents_cursor': documents_cursor,
+    }
@@ -1,14 +1,22 @@
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.db.models import F, Q
 from django.dispatch import receiver
 from django.apps import apps
 
-from .models import CustomerMailingList, Customer, Address
+from .models import CustomerMailingList, Customer, Address, CustomerDocument, CustomerNote
+from .documents import release_document_file
+from .note_history import materialize_note_history
+from .profile import bump_profile_version
 
 @receiver(m2m_changed, sender=CustomerMailingList.interests.through)
 def update_customers_and_addresses(sender, instance, action, **kwargs):
     """Updates the mailing list customers and their mailing addresses when interests change.
        Only customers with valid mailing addresses are included in the list."""
     
+    # dynamic lists are refreshed from their rule when they are used (see customers.mailing_lists)
+    if instance.is_dynamic:
+        return
+
     if action in ["post_add", "post_remove", "post_clear"]:
         Customer = apps.get_model('customers', 'Customer')
         Address = apps.get_model('customers', 'Address')
@@ -41,12 +49,13 @@ def update_customers_and_addresses(sender, instance, action, **kwargs):
 def update_customer_mailing_lists(sender, instance, action, reverse, model, pk_set, **kwargs):
     """
     Automatically add or remove customers from mailing lists when their interests change.
+    Dynamic lists are skipped - they are refreshed from their rule when they are used.
     """
     CustomerMailingList = apps.get_model('customers', 'CustomerMailingList')
 
     if action == "post_add":
         # When interests are added, find mailing lists matching the added interests
-        mailing_lists = CustomerMailingList.objects.filter(interests__in=instance.interests.all()).distinct()
+        mailing_lists = CustomerMailingList.objects.filter(interests__in=instance.interests.all(), is_dynamic=False).distinct()
         
         for mailing_list in mailing_lists:
             # makes sure the customer is active and has at least one valid mailing address
@@ -60,7 +69,7 @@ def update_customer_mailing_lists(sender, instance, action, reverse, model, pk_s
 
     elif action == "post_remove":
         #customer interes is removed - see if the customer is still part of the mailing list
-        mailing_lists = CustomerMailingList.objects.filter(interests__in=pk_set).distinct()
+        mailing_lists = CustomerMailingList.objects.filter(interests__in=pk_set, is_dynamic=False).distinct()
 
         for mailing_list in mailing_lists:
             # see if customer has any interests in list
@@ -79,6 +88,7 @@ def update_mailing_list_on_address_change(sender, instance, **kwargs):
     """
     Updates mailing lists when an address is added, modified, or removed.
     makes sures only active customers with at least one valid mailing address are included.
+    Dynamic lists are skipped - they are refreshed from their rule when they are used.
     """
     CustomerMailingList = apps.get_model('customers', 'CustomerMailingList')
 
@@ -88,12 +98,84 @@ def update_mailing_list_on_address_change(sender, instance, **kwargs):
     for customer in customers:
         if not customer.is_inactive and customer.addresses.filter(mailing_address=True).exists():
             # Add the customer to mailing lists that match their interests
-            mailing_lists = CustomerMailingList.objects.filter(interests__in=customer.interests.all()).distinct()
+            mailing_lists = CustomerMailingList.objects.filter(interests__in=customer.interests.all(), is_dynamic=False).distinct()
             for mailing_list in mailing_lists:
                 mailing_list.customers.add(customer)
 
         else:
             # Remove the customer from mailing lists if they are inactive or no longer have a valid mailing address
-            mailing_lists = CustomerMailingList.objects.filter(customers=customer).distinct()
+            mailing_lists = CustomerMailingList.objects.filter(customers=customer, is_dynamic=False).distinct()
             for mailing_list in mailing_lists:
                 mailing_list.customers.remove(customer)
+
+
+# ------------------------- MAILING LIST VERSIONS: invalidates cached label pdfs -------------------------
+def bump_membership_version(mailing_lists):
+    """Increments the membership_version of the given mailing lists (queryset) in a single UPDATE"""
+    CustomerMailingList.objects.filter(pk__in=mailing_lists.values('pk')).update(
+        membership_version=F('membership_version') + 1
+    )
+
+@receiver(m2m_changed, sender=CustomerMailingList.customers.through)
+@receiver(m2m_changed, sender=CustomerMailingList.addresses.through)
+def bump_version_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Customers or addresses were added to / removed from a mailing list (from either side of the relationship)"""
+    if not reverse:
+        if action in ["post_add", "post_remove", "post_clear"]:
+            bump_membership_version(CustomerMailingList.objects.filter(pk=instance.pk))
+    elif action in ["post_add", "post_remove"]:
+        bump_membership_version(CustomerMailingList.objects.filter(pk__in=pk_set))
+    elif action == "pre_clear":
+        # the lists are only known before a reverse clear (customer.mailing_lists.clear())
+        bump_membership_version(instance.mailing_lists.all() if isinstance(instance, Customer) else instance.mailing_addresses.all())
+
+@receiver(post_save, sender=Address)
+@receiver(pre_delete, sender=Address)
+def bump_version_on_address_change(sender, instance, **kwargs):
+    """A member address was edited or is about to be deleted"""
+    bump_membership_version(CustomerMailingList.objects.filter(addresses=instance))
+
+@receiver(post_save, sender=Customer)
+def bump_version_on_customer_change(sender, instance, created, update_fields, **kwargs):
+    """The name printed on a label comes from the customer - bump lists the customer (or their addresses) are on"""
+    # only when a saved field printed on the labels changed (the values the customer was loaded with are compared)
+    saved = Customer.LABEL_FIELDS if update_fields is None else set(Customer.LABEL_FIELDS) & set(update_fields)
+    if not created and instance.changed_fields(saved):
+        bump_membership_version(
+            CustomerMailingList.objects.filter(Q(customers=instance) | Q(addresses__customer_addresses=instance))
+        )
+
+@receiver(m2m_changed, sender=Customer.addresses.through)
+def bump_version_on_customer_address_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Linking / unlinking a customer & an address changes who is printed on that address's label"""
+    if action in ["post_add", "post_remove"]:
+        address_ids = [instance.pk] if reverse else pk_set
+    elif action == "pre_clear":
+        address_ids = [instance.pk] if reverse else instance.addresses.values('pk')
+    else:
+        return
+    bump_membership_version(CustomerMailingList.objects.filter(addresses__in=address_ids))
+
+
+# ------------------------- DOCUMENT BLOBS: reference counts of the shared stored files -------------------------
+@receiver(post_delete, sender=CustomerDocument)
+def release_document_blob(sender, instance, **kwargs):
+    """A deleted document (also when its customer is deleted) no longer references its stored file"""
+    release_document_file(instance)
+
+
+# ------------------------- PROFILE VERSIONS: invalidates the cached pages of a customer's profile -------------------------
+@receiver(post_save, sender=CustomerNote)
+@receiver(post_delete, sender=CustomerNote)
+@receiver(post_save, sender=CustomerDocument)
+@receiver(post_delete, sender=CustomerDocument)
+def bump_profile_version_on_change(sender, instance, **kwargs):
+    """A note or document was added, edited or deleted - the pages of its customer's notes & documents change"""
+    bump_profile_version([instance.customer_id])
+
+
+# ------------------------- NOTE HISTORY: diffs are rebuilt from the note -------------------------
+@receiver(pre_delete, sender=CustomerNote)
+def materialize_history_on_note_delete(sender, instance, **kwargs):
+    """The history of a deleted note is kept (customer_note is set to NULL) - its diffs are stored whole first"""
+    materialize_note_history(instance)
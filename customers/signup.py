@@ -0,0 +1,169 @@
+import os
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.http import QueryDict
+
+from .addresses import normalize_address_key
+from .documents import queue_document_uploads, spool_upload
+from .forms import CreateAddressForm, CreateCustomerForm, CreateDocumentForm, CreateEmailForm, CreateNoteForm, CreatePhoneForm
+from .models import Address, Customer, CustomerDocument, CustomerNote, Email, Phone
+
+# all forms used in the multi-step sign-up process - in the order they are used
+FORM_CLASSES = [
+    CreateCustomerForm,
+    CreateAddressForm,
+    CreatePhoneForm,
+    CreateEmailForm,
+    CreateDocumentForm,
+    CreateNoteForm,
+]
+
+# session key holding the data of the steps filled in so far (nothing is written to the db until the last step)
+SIGNUP_SESSION_KEY = "signup_data"
+
+
+class SignupError(Exception):
+    """The staged sign-up can't be saved (no customer step, or a step no longer validates)"""
+
+
+def staging_storage():
+    """Local storage the files uploaded during a sign-up wait in until the customer is saved"""
+    return FileSystemStorage(location=settings.SIGNUP_STAGING_ROOT)
+
+
+def clear_stale_uploads(max_age=None):
+    """Deletes staged uploads of abandoned sign-ups (older than SIGNUP_STAGING_MAX_AGE seconds)"""
+    storage = staging_storage()
+    if not os.path.isdir(storage.location):
+        return
+    cutoff = time.time() - (settings.SIGNUP_STAGING_MAX_AGE if max_age is None else max_age)
+    for name in storage.listdir("")[1]:
+        if os.path.getmtime(storage.path(name)) < cutoff:
+            storage.delete(name)
+
+
+def stage_step(session, step, form, files):
+    """
+        Keeps the submitted data of a validated sign-up step in the session.
+
+        - the posted values are kept (not the cleaned data), so the step can be validated again when it is saved
+        - uploaded files are written to the staging storage under a random name - the session holds their names
+    """
+    clear_stale_uploads()
+
+    data = {key: values for key, values in form.data.lists() if key != "csrfmiddlewaretoken"}
+    staged_files = {}
+    for field_name, upload in files.items():
+        extension = os.path.splitext(upload.name)[1]
+        staged_name = staging_storage().save(f"{uuid.uuid4().hex}{extension}", upload)
+        staged_files[field_name] = {"staged_name": staged_name, "name": upload.name}
+
+    signup_data = session.get(SIGNUP_SESSION_KEY, {})
+    discard_files(signup_data.get(str(step), {}).get("files", {}))
+    signup_data[str(step)] = {"data": data, "files": staged_files}
+    session[SIGNUP_SESSION_KEY] = signup_data
+
+
+def discard_files(staged_files):
+    """Deletes staged uploads"""
+    storage = staging_storage()
+    for staged in staged_files.values():
+        storage.delete(staged["staged_name"])
+
+
+def discard_signup(session):
+    """Forgets a sign-up in progress & deletes its staged uploads (nothing was written to the db)"""
+    for entry in session.pop(SIGNUP_SESSION_KEY, {}).values():
+        discard_files(entry.get("files", {}))
+    session.pop("signup_step", None)
+
+
+def _staged_forms(signup_data, stack):
+    """Rebuilds & validates the form of every staged step - {form class: bound form}"""
+    storage = staging_storage()
+    forms = {}
+    for step, FormClass in enumerate(FORM_CLASSES):
+        entry = signup_data.get(str(step))
+        if entry is None:
+            continue  # skipped step
+
+        data = QueryDict(mutable=True)
+        for key, values in entry["data"].items():
+            data.setlist(key, values)
+        files = {
+            field_name: File(stack.enter_context(storage.open(staged["staged_name"], "rb")), name=staged["name"])
+            for field_name, staged in entry["files"].items()
+        }
+
+        form = FormClass(data, files)
+        if not form.is_valid():
+            raise SignupError(f"Step {step + 1} of the sign-up is no longer valid.")
+        forms[FormClass] = form
+    return forms
+
+
+def commit_signup(session, user):
+    """
+        Saves a staged sign-up in one transaction: the customer, then a bulk insert per kind of related row (addresses,
+        phones, emails, their links to the customer, notes & documents).
+
+        - the interests are added last, so the mailing list signals see the customer's addresses
+        - documents are spooled, not uploaded: a background job pushes them to storage once the transaction committed
+        - returns the new customer & clears the staged data (staged uploads are deleted)
+    """
+    signup_data = session.get(SIGNUP_SESSION_KEY, {})
+
+    with ExitStack() as stack:
+        forms = _staged_forms(signup_data, stack)
+        if CreateCustomerForm not in forms:
+            raise SignupError("The sign-up has no customer.")
+
+        def instances(FormClass):
+            return [forms[FormClass].save(commit=False)] if FormClass in forms else []
+
+        with transaction.atomic():
+            customer_form = forms[CreateCustomerForm]
+            customer = customer_form.save(commit=False)
+            customer.creator = user
+            customer.save()
+
+            # bulk inserts skip save(): the normalized address key & phone format are set here
+            addresses = instances(CreateAddressForm)
+            for address in addresses:
+                address.normalized_key = normalize_address_key(address.street, address.city, address.state, address.zip_code)
+            phones = instances(CreatePhoneForm)
+            for phone in phones:
+                phone.standardize_phone_number()
+            emails = instances(CreateEmailForm)
+
+            Address.objects.bulk_create(addresses)
+            Phone.objects.bulk_create(phones)
+            Email.objects.bulk_create(emails)
+            Customer.addresses.through.objects.bulk_create([Customer.addresses.through(customer=customer, address=address) for address in addresses])
+            Customer.phones.through.objects.bulk_create([Customer.phones.through(customer=customer, phone=phone) for phone in phones])
+            Customer.emails.through.objects.bulk_create([Customer.emails.through(customer=customer, email=email) for email in emails])
+
+            notes = instances(CreateNoteForm)
+            documents = instances(CreateDocumentForm)
+            for row in notes + documents:
+                row.customer = customer
+                row.author = user
+            # the staged files are copied to the document spool & pushed to storage in the background (after commit)
+            for document in documents:
+                spool_upload(document, forms[CreateDocumentForm].cleaned_data['file'])
+                document.rename_file()
+            CustomerNote.objects.bulk_create(notes)
+            CustomerDocument.objects.bulk_create(documents)
+            queue_document_uploads([document.pk for document in documents])
+
+            # interests & contact methods last: the mailing list signals need the addresses
+            customer_form.save_m2m()
+
+    discard_signup(session)
+    return customer
@@ -0,0 +1,40 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+
+class LocalCloudinaryStorage(FileSystemStorage):
+    """
+        Offline stand-in for the Cloudinary storage (development & tests): files are kept under MEDIA_ROOT & served from
+        MEDIA_URL like FileSystemStorage, but a save can behave like an upload to the cloud:
+
+        - settings.LOCAL_STORAGE_LATENCY: seconds every save takes
+        - fail_next(times): the next saves raise a ConnectionError, like a network error or a Cloudinary outage
+    """
+    _failures = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def fail_next(cls, times=1):
+        """Makes the next saves (of any instance) fail"""
+        with cls._lock:
+            cls._failures += times
+
+    @classmethod
+    def reset_failures(cls):
+        with cls._lock:
+            cls._failures = 0
+
+    def _save(self, name, content):
+        latency = getattr(settings, "LOCAL_STORAGE_LATENCY", 0)
+        if latency:
+            time.sleep(latency)
+        with LocalCloudinaryStorage._lock:
+            failing = LocalCloudinaryStorage._failures > 0
+            if failing:
+                LocalCloudinaryStorage._failures -= 1
+        if failing:
+            raise ConnectionError(f"Simulated storage outage while uploading {name}")
+        return super()._save(name, content)
@@ -0,0 +1,166 @@
+import csv
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+
+class Echo:
+    """File-like object that hands back what is written to it - lets csv.writer produce one line at a time"""
+    def write(self, value):
+        return value
+
+
+def stream_csv(header, rows):
+    """Generator that yields a csv file one line at a time: the header straight away, then a line per row"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+# ------------------------- ZIP: written to a non-seekable buffer & handed out as soon as it is compressed -------------------------
+class _ZipBuffer:
+    """Write-only stream zipfile writes to - the bytes written so far are taken out with drain()"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(members, compression=zipfile.ZIP_DEFLATED, compresslevel=None):
+    """
+        Generator that yields a zip archive piece by piece.
+
+        - members: iterable of (file name in the archive, iterable of bytes) - each member is read one chunk at a time
+        - nothing is held in memory apart from the chunk being compressed (sizes are written after each member)
+        - compresslevel: 1 (fastest) to 9 - files that are compressed already (pdfs) gain little from a high level
+    """
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=compression, compresslevel=compresslevel) as archive:
+        for name, chunks in members:
+            with archive.open(name, "w") as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    # the compressor holds on to small writes - only yield once it has output something
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            # closing a member flushes the compressor & writes its sizes
+            yield buffer.drain()
+    # the central directory is written when the archive is closed
+    yield buffer.drain()
+
+
+# ------------------------- XLSX: a single sheet of inline strings, written row by row -------------------------
+# characters that are not allowed in xml (control characters other than tab / new lines)
+_INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+
+_XLSX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+
+
+def _xlsx_column(index):
+    """Column letters of a 0-based column: 0 -> 'A', 27 -> 'AB'"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def _xlsx_cell(value, reference):
+    """
+        One inline string cell (empty cells are left out - the reference of every cell, e.g. 'C2', keeps the cells after
+        an empty one in their column)
+    """
+    if value is None or value == "":
+        return ""
+    text = escape(_INVALID_XML_CHARS.sub("", str(value)))
+    return f'<c r="{reference}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_sheet(header, rows, rows_per_chunk=500):
+    """Yields the worksheet xml, encoded in chunks of rows_per_chunk rows"""
+    yield (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+    ).encode()
+
+    columns = []
+    lines = []
+    for row_number, row in enumerate(_chain_header(header, rows), start=1):
+        # column letters are worked out once, for the widest row so far
+        while len(columns) < len(row):
+            columns.append(_xlsx_column(len(columns)))
+        cells = "".join(_xlsx_cell(value, f"{columns[index]}{row_number}") for index, value in enumerate(row))
+        lines.append(f'<row r="{row_number}">{cells}</row>')
+        if len(lines) >= rows_per_chunk:
+            yield "".join(lines).encode()
+            lines.clear()
+
+    lines.append("</sheetData></worksheet>")
+    yield "".join(lines).encode()
+
+
+def _chain_header(header, rows):
+    """Puts the header row in front of the rows"""
+    yield header
+    yield from rows
+
+
+def stream_xlsx(header, rows, sheet_name="Sheet1"):
+    """
+        Generator that yields an Excel workbook (.xlsx) with one sheet: the header row, then a row per row.
+        The workbook is zipped as the rows come in - no spreadsheet library & no full copy of the sheet in memory.
+    """
+    # sheet names are limited to 31 characters & can't contain []:*?/\
+    sheet_name = escape(re.sub(r"[\[\]:*?/\\]", "", sheet_name)[:31] or "Sheet1", {'"': "&quot;"})
+
+    members = [
+        ("[Content_Types].xml", [_XLSX_CONTENT_TYPES.encode()]),
+        ("_rels/.rels", [_XLSX_RELS.encode()]),
+        ("xl/workbook.xml", [_XLSX_WORKBOOK.format(sheet_name=sheet_name).encode()]),
+        ("xl/_rels/workbook.xml.rels", [_XLSX_WORKBOOK_RELS.encode()]),
+        ("xl/worksheets/sheet1.xml", _xlsx_sheet(header, rows)),
+    ]
+    return stream_zip(members)
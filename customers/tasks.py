@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# thread pool shared by all background jobs of this process - created on first use (after gunicorn forks its workers)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Returns the process wide thread pool used to run background jobs"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_TASK_WORKERS, thread_name_prefix="customers-task"
+            )
+        return _executor
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+        Runs func(*args, **kwargs) outside of the request/response cycle on a background thread.
+
+        - jobs must record their own progress / errors (e.g. on a model) - nothing is returned to the caller
+        - settings.BACKGROUND_TASKS_SYNCHRONOUS runs the job straight away instead (tests, management commands)
+    """
+    if settings.BACKGROUND_TASKS_SYNCHRONOUS:
+        func(*args, **kwargs)
+        return
+
+    def run():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Background task %s failed", getattr(func, "__name__", func))
+        finally:
+            # every thread gets its own db connection - close it so it is not leaked
+            connections.close_all()
+
+    _get_executor().submit(run)
@@ -385,6 +385,30 @@ class AddressModelTestCase(TestCase):
         with self.assertRaises(ValidationError, msg="The mailing_address field should raise a ValidationError for NULL values."):
             address.full_clean()  # Should raise a ValidationError
 
+    def test_normalized_key(self):
+        """
+            Tests that the normalized key is stored on save & is the same for the same address typed differently.
+        """
+        self.assertEqual(self.address.normalized_key, "123 RIDGE RD|ALBANY|IL|89561")
+
+        address = Address.objects.create(street=" 123  ridge road. ", city="albany", state="IL", zip_code="89561")
+        self.assertEqual(address.normalized_key, self.address.normalized_key)
+
+        address = Address.objects.create(street="45 North Main Street, Suite #2", city="Saint Marys", state="OH", zip_code="45885")
+        self.assertEqual(address.normalized_key, "45 N MAIN ST STE # 2|ST MARYS|OH|45885")
+
+        address = Address.objects.create(street="P.O. Box 12", city="Canton", state="OH", zip_code="44718")
+        self.assertTrue(address.normalized_key.startswith("PO BOX 12|"))
+
+    def test_normalized_key_update_fields(self):
+        """
+            Tests that a save limited to some address fields also stores the new normalized key.
+        """
+        self.address.street = "9 Oak Avenue"
+        self.address.save(update_fields=["street"])
+        self.address.refresh_from_db()
+        self.assertEqual(self.address.normalized_key, "9 OAK AVE|ALBANY|IL|89561")
+
 class EmailModelTestCase(TestCase):
     def setUp(self):
         """
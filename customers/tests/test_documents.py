@@ -0,0 +1,431 @@
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.urls import reverse
+from io import BytesIO, StringIO
+import zipfile
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from app_users.models import CustomUser
+from customers.models import Customer, CustomerDocument, DocumentBlob
+from customers.documents import store_document
+from customers.storage import LocalCloudinaryStorage
+from customers.previews import PREVIEW_SIZE, render_first_page
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+
+def make_pdf(text="Request for Taxpayer Identification Number", image=None):
+    """A one page pdf with a line of text - or a scanned page (a single image filling it)"""
+    output = BytesIO()
+    pdf = canvas.Canvas(output)
+    if image is not None:
+        pdf.drawImage(ImageReader(image), 0, 0, width=595, height=842)
+    else:
+        pdf.drawString(72, 770, text)
+    pdf.showPage()
+    pdf.save()
+    return output.getvalue()
+
+
+class DocumentTestCase(TestCase):
+    """Uploads documents of a customer into throwaway media & spool directories"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user, a customer, throwaway media & spool directories & no wait between attempts.
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+        self.customer = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person", creator=self.user)
+
+        self.media_root = tempfile.mkdtemp()
+        self.spool_root = tempfile.mkdtemp()
+        upload_settings = override_settings(
+            MEDIA_ROOT=self.media_root, DOCUMENT_SPOOL_ROOT=self.spool_root, DOCUMENT_UPLOAD_ATTEMPTS=3, DOCUMENT_UPLOAD_RETRY_DELAY=0,
+        )
+        upload_settings.enable()
+        self.addCleanup(upload_settings.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        self.addCleanup(shutil.rmtree, self.spool_root, True)
+        self.addCleanup(LocalCloudinaryStorage.reset_failures)
+
+    def upload(self, customer=None, content=b"%PDF-1.4 scanned"):
+        """Posts a pdf to the add document page & returns the new document (its upload not pushed yet)"""
+        customer = customer or self.customer
+        upload = SimpleUploadedFile("scan.pdf", content, content_type="application/pdf")
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('customer-add-document', args=[customer.id]), {'file_type': 'w9', 'file': upload})
+        self.assertRedirects(response, reverse('view_customer_profile', args=[customer.id]), fetch_redirect_response=False)
+        self.callbacks = callbacks
+        return CustomerDocument.objects.latest('id')
+
+    def stored_files(self):
+        folder = os.path.join(self.media_root, "document_blobs")
+        return os.listdir(folder) if os.path.isdir(folder) else []
+
+
+class DocumentUploadTestCase(DocumentTestCase):
+    """Tests that uploaded documents are spooled in the request & pushed to storage in the background, with retries"""
+
+    def test_upload_is_spooled(self):
+        """Tests that the request only spools the file & the background job stores it once the document is saved"""
+        document = self.upload()
+        self.assertEqual(document.upload_status, 'processing')
+        self.assertEqual(os.listdir(self.spool_root), [document.spooled_name])
+        self.assertEqual(self.stored_files(), [], "Nothing should be uploaded in the request.")
+
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True):
+            for callback in self.callbacks:
+                callback()
+
+        document.refresh_from_db()
+        self.assertTrue(document.is_stored)
+        self.assertEqual((document.spooled_name, document.upload_attempts), ("", 1))
+        self.assertEqual(self.stored_files(), [os.path.basename(document.file.name)])
+        self.assertEqual(os.listdir(self.spool_root), [])
+
+    def test_failed_uploads_are_retried(self):
+        """Tests that an upload failing for a while is stored by a later attempt"""
+        document = self.upload()
+        LocalCloudinaryStorage.fail_next(2)
+        self.assertTrue(store_document(document.id))
+
+        document.refresh_from_db()
+        self.assertTrue(document.is_stored)
+        self.assertEqual(document.upload_attempts, 3)
+
+    def test_every_attempt_failed(self):
+        """Tests that a document whose every attempt failed keeps its spooled file & is stored by the command later"""
+        document = self.upload()
+        LocalCloudinaryStorage.fail_next(3)
+        self.assertFalse(store_document(document.id))
+
+        document.refresh_from_db()
+        self.assertEqual(document.upload_status, 'failed')
+        self.assertIn("Simulated storage outage", document.upload_error)
+        self.assertEqual(os.listdir(self.spool_root), [document.spooled_name])
+
+        out = StringIO()
+        call_command("store_spooled_documents", failed=True, stuck_after=0, stdout=out)
+        self.assertIn("Stored 1 of 1 document(s)", out.getvalue())
+        document.refresh_from_db()
+        self.assertTrue(document.is_stored)
+
+    def test_deleted_while_processing(self):
+        """Tests that a document deleted before its upload ran leaves nothing behind"""
+        document = self.upload()
+        self.client.post(reverse('document_delete', args=[self.customer.id, document.id]))
+        self.assertEqual(os.listdir(self.spool_root), [])
+        self.assertFalse(store_document(document.id))
+        self.assertEqual(self.stored_files(), [])
+
+    def test_profile_shows_processing(self):
+        """Tests that the profile shows the upload status (polling it) until the file can be downloaded"""
+        document = self.upload()
+        status_url = reverse('document-upload-status', args=[self.customer.id, document.id])
+        response = self.client.get(reverse('view_customer_profile', args=[self.customer.id]))
+        self.assertContains(response, "Processing")
+        self.assertContains(response, status_url)
+
+        store_document(document.id)
+        response = self.client.get(status_url, HTTP_HX_REQUEST="true")
+        self.assertNotContains(response, "hx-trigger", msg_prefix="A stored document should stop polling.")
+        self.assertContains(response, reverse('document-download', args=[self.customer.id, document.id]))
+
+
+class DocumentBlobTestCase(DocumentTestCase):
+    """Tests that documents with the same content share one stored file, counted & deleted with its last document"""
+
+    def test_same_content_stored_once(self):
+        """Tests that the same pdf attached to two customers is uploaded once & each document keeps its own name"""
+        other = Customer.objects.create(first_name="John", last_name="Smith", customer_type="person", creator=self.user)
+        first = self.upload()
+        self.assertTrue(store_document(first.id))
+        # the storage is down: the second document does not need it
+        LocalCloudinaryStorage.fail_next(3)
+        second = self.upload(customer=other)
+        self.assertTrue(store_document(second.id))
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        blob = DocumentBlob.objects.get()
+        self.assertEqual((first.blob, second.blob, blob.reference_count), (blob, blob, 2))
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(len(self.stored_files()), 1, "The content should only be stored once.")
+        self.assertEqual(second.upload_attempts, 1)
+        self.assertTrue(str(first).startswith("Jane_Doe_W-9_"))
+        self.assertTrue(str(second).startswith("John_Smith_W-9_"))
+
+    def test_last_reference_deletes_blob(self):
+        """Tests that the stored file is deleted with its last document (also when the customer is deleted)"""
+        other = Customer.objects.create(first_name="John", last_name="Smith", customer_type="person", creator=self.user)
+        store_document(self.upload().id)
+        store_document(self.upload(customer=other).id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.delete()
+        self.assertEqual(DocumentBlob.objects.get().reference_count, 1)
+        self.assertEqual(len(self.stored_files()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('document_delete', args=[other.id, CustomerDocument.objects.get().id]))
+        self.assertFalse(DocumentBlob.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    def test_replaced_file_released(self):
+        """Tests that replacing a document's file releases the blob of the old file"""
+        document = self.upload()
+        store_document(document.id)
+        upload = SimpleUploadedFile("scan.pdf", b"%PDF-1.4 signed", content_type="application/pdf")
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('document_edit', args=[self.customer.id, document.id]), {'file_type': 'w9', 'file': upload})
+        self.assertEqual(response.status_code, 302)
+
+        document.refresh_from_db()
+        self.assertTrue(document.is_stored)
+        self.assertEqual(DocumentBlob.objects.get().sha256, document.content_hash)
+        self.assertEqual(len(self.stored_files()), 1, "The old file should be deleted.")
+
+    def test_file_stored_before_blobs(self):
+        """Tests that a document with a file of its own (stored before blobs) still deletes it with the document"""
+        upload = SimpleUploadedFile("old.pdf", b"%PDF-1.4 old", content_type="application/pdf")
+        document = CustomerDocument.objects.create(customer=self.customer, file=upload, file_type="w9")
+        path = document.file.path
+        self.assertTrue(os.path.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            document.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_file_before_blobs_kept_until_stored(self):
+        """Tests that the own file of a document from before blobs is only deleted once the file replacing it is stored"""
+        upload = SimpleUploadedFile("old.pdf", b"%PDF-1.4 old", content_type="application/pdf")
+        document = CustomerDocument.objects.create(customer=self.customer, file=upload, file_type="w9")
+        path = document.file.path
+
+        LocalCloudinaryStorage.fail_next(3)
+        upload = SimpleUploadedFile("scan.pdf", b"%PDF-1.4 signed", content_type="application/pdf")
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('document_edit', args=[self.customer.id, document.id]), {'file_type': 'w9', 'file': upload})
+        document.refresh_from_db()
+        self.assertEqual(document.upload_status, 'failed')
+        self.assertTrue(os.path.exists(path), "The old file should be kept while the new one is not stored.")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(store_document(document.id))
+        document.refresh_from_db()
+        self.assertEqual(document.replaced_file, "")
+        self.assertFalse(os.path.exists(path))
+
+
+class DocumentDownloadTestCase(DocumentTestCase):
+    """Tests the document download view: conditional requests, byte ranges & handing the transfer to the front-end server"""
+
+    content = b"%PDF-1.4 " + bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.document = self.upload(content=self.content)
+        store_document(self.document.id)
+        self.document.refresh_from_db()
+        self.url = reverse('document-download', args=[self.customer.id, self.document.id])
+
+    def download(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_whole_file(self):
+        """Tests that the file is sent under the document's name with its validators"""
+        response, body = self.download()
+        self.assertEqual((response.status_code, body), (200, self.content))
+        self.assertEqual(response.headers['ETag'], f'"{self.document.content_hash}"')
+        self.assertEqual(response.headers['Accept-Ranges'], "bytes")
+        self.assertIn(f'filename="{self.document.display_name}"', response.headers['Content-Disposition'])
+        self.assertIn("private", response.headers['Cache-Control'])
+
+    def test_conditional_requests(self):
+        """Tests that a browser with the current copy gets a 304 without the file"""
+        response, body = self.download(if_none_match=f'"{self.document.content_hash}"')
+        self.assertEqual((response.status_code, body), (304, b""))
+        response, body = self.download(if_none_match='"something-else"')
+        self.assertEqual(response.status_code, 200)
+        response, body = self.download(if_modified_since=response.headers['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_byte_ranges(self):
+        """Tests that a range of the file is sent with 206 Partial Content"""
+        size = len(self.content)
+        for header, start, end in [("bytes=0-99", 0, 99), ("bytes=1000-", 1000, size - 1), ("bytes=-10", size - 10, size - 1), ("bytes=5-99999", 5, size - 1)]:
+            response, body = self.download(range=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(body, self.content[start:end + 1], header)
+            self.assertEqual(response.headers['Content-Range'], f"bytes {start}-{end}/{size}")
+            self.assertEqual(int(response.headers['Content-Length']), end - start + 1)
+
+        response, body = self.download(range=f"bytes={size}-")
+        self.assertEqual((response.status_code, response.headers['Content-Range']), (416, f"bytes */{size}"))
+        response, body = self.download(range="bytes=0-9,20-29")
+        self.assertEqual((response.status_code, body), (200, self.content), "Several ranges should get the whole file.")
+
+    def test_if_range(self):
+        """Tests that a range of a file that changed since is answered with the whole file"""
+        response, body = self.download(range="bytes=0-9", if_range=f'"{self.document.content_hash}"')
+        self.assertEqual(response.status_code, 206)
+        response, body = self.download(range="bytes=0-9", if_range='"an-older-version"')
+        self.assertEqual((response.status_code, body), (200, self.content))
+
+    def test_offload(self):
+        """Tests that the front-end server is told which file to send instead of the file being streamed"""
+        with self.settings(DOCUMENT_DOWNLOAD_OFFLOAD='x-accel-redirect'):
+            response, body = self.download()
+        self.assertEqual(response.headers['X-Accel-Redirect'], f"/protected-media/{self.document.file.name}")
+        self.assertEqual(body, b"")
+        with self.settings(DOCUMENT_DOWNLOAD_OFFLOAD='x-sendfile'):
+            response, body = self.download()
+        self.assertEqual(response.headers['X-Sendfile'], self.document.file.path)
+        self.assertIn(self.document.display_name, response.headers['Content-Disposition'])
+
+    def test_not_downloadable(self):
+        """Tests that a document still processing can't be downloaded & that users must be logged in"""
+        processing = self.upload()
+        response = self.client.get(reverse('document-download', args=[self.customer.id, processing.id]))
+        self.assertEqual(response.status_code, 404)
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+
+
+class DocumentPreviewTestCase(DocumentTestCase):
+    """Tests the first page previews rendered in the background, cached by content & cleared when a document is edited"""
+
+    def store(self, document):
+        """Stores a spooled document, running the preview job it queues"""
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True), self.captureOnCommitCallbacks(execute=True):
+            store_document(document.id)
+        document.refresh_from_db()
+        return document
+
+    def preview_files(self):
+        folder = os.path.join(self.media_root, "document_previews")
+        return os.listdir(folder) if os.path.isdir(folder) else []
+
+    def test_render_first_page(self):
+        """Tests that text & scanned pdfs get a small png, other files none"""
+        preview = Image.open(BytesIO(render_first_page(BytesIO(make_pdf()))))
+        self.assertEqual(preview.format, "PNG")
+        self.assertLessEqual(preview.size, PREVIEW_SIZE)
+        self.assertNotEqual(preview.getextrema(), ((255, 255), (255, 255), (255, 255)), "The text should be drawn.")
+
+        scan = Image.new("RGB", (300, 400), "red")
+        preview = Image.open(BytesIO(render_first_page(BytesIO(make_pdf(image=scan)))))
+        self.assertEqual(preview.convert("RGB").getpixel((preview.width // 2, preview.height // 2)), (255, 0, 0))
+
+        self.assertIsNone(render_first_page(BytesIO(b"PK\x03\x04 a word document")))
+
+    def test_preview_after_upload(self):
+        """Tests that a stored document gets a preview, shown on the profile & search results"""
+        document = self.store(self.upload(content=make_pdf()))
+        self.assertEqual(document.preview.name, f"document_previews/{document.content_hash}.png")
+        self.assertEqual(self.preview_files(), [f"{document.content_hash}.png"])
+
+        response = self.client.get(reverse('view_customer_profile', args=[self.customer.id]))
+        self.assertContains(response, f'src="{document.preview.url}"')
+        response = self.client.get(reverse('search-documents'), {'search_document': "Jane_Doe"})
+        self.assertContains(response, f'src="{document.preview.url}"')
+
+    def test_preview_shared_by_content(self):
+        """Tests that a document with the same content uses the cached preview instead of rendering it again"""
+        other = Customer.objects.create(first_name="John", last_name="Smith", customer_type="person", creator=self.user)
+        pdf = make_pdf()
+        first = self.store(self.upload(content=pdf))
+        with patch("customers.previews.render_first_page") as render:
+            second = self.store(self.upload(customer=other, content=pdf))
+        render.assert_not_called()
+        self.assertEqual(first.preview.name, second.preview.name)
+
+        # the preview stays while a document still shows it
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(len(self.preview_files()), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.preview_files(), [])
+
+    def test_edit_clears_preview(self):
+        """Tests that an edit recording a history entry clears the preview, rendered again from the cache"""
+        document = self.store(self.upload(content=make_pdf()))
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True), self.captureOnCommitCallbacks(execute=True):
+            with patch("customers.previews.render_first_page") as render:
+                self.client.post(reverse('document_edit', args=[self.customer.id, document.id]), {'file_type': 'seed_tag'})
+                self.assertEqual(CustomerDocument.objects.get().preview, "", "The edit should clear the preview.")
+        render.assert_not_called()
+        document.refresh_from_db()
+        self.assertTrue(document.edit_history.exists())
+        self.assertEqual(document.preview.name, f"document_previews/{document.content_hash}.png")
+
+    def test_replaced_file(self):
+        """Tests that a replaced file gets the preview of its new content & the old one is deleted"""
+        document = self.store(self.upload(content=make_pdf()))
+        upload = SimpleUploadedFile("scan.pdf", make_pdf("Signed"), content_type="application/pdf")
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('document_edit', args=[self.customer.id, document.id]), {'file_type': 'w9', 'file': upload})
+        document.refresh_from_db()
+        self.assertEqual(self.preview_files(), [f"{document.content_hash}.png"])
+        self.assertEqual(document.preview.name, f"document_previews/{document.content_hash}.png")
+
+
+class DocumentZipTestCase(DocumentTestCase):
+    """Tests the zip download of documents: by customer, file type or search, streamed as the files are read"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = Customer.objects.create(first_name="John", last_name="Smith", customer_type="person", creator=self.user)
+        self.w9 = self.upload(content=b"%PDF-1.4 jane w9")
+        self.second_w9 = self.upload(content=b"%PDF-1.4 jane w9 corrected")
+        self.smith_w9 = self.upload(customer=self.other, content=b"%PDF-1.4 john w9")
+        for document in [self.w9, self.second_w9, self.smith_w9]:
+            store_document(document.id)
+        self.processing = self.upload(content=b"%PDF-1.4 not stored yet")
+
+    def download(self, **params):
+        response = self.client.get(reverse('download-documents-zip'), params)
+        self.assertTrue(response.streaming, "The archive should be streamed.")
+        self.assertEqual(response.headers['Content-Type'], "application/zip")
+        archive = zipfile.ZipFile(BytesIO(b"".join(response.streaming_content)))
+        return response, {name: archive.read(name) for name in archive.namelist()}
+
+    def test_customer_documents(self):
+        """Tests that a customer's stored documents are zipped, a name used twice is numbered"""
+        response, files = self.download(customer=self.customer.id)
+        name = os.path.splitext(CustomerDocument.objects.get(pk=self.w9.pk).display_name)[0]
+        self.assertEqual(files, {
+            f"Jane_Doe/{name}.pdf": b"%PDF-1.4 jane w9",
+            f"Jane_Doe/{name} (2).pdf": b"%PDF-1.4 jane w9 corrected",
+        })
+        self.assertIn('filename="Jane_Doe_documents.zip"', response.headers['Content-Disposition'])
+
+    def test_file_type_and_search(self):
+        """Tests that every customer's documents of a file type or found by a search are zipped"""
+        CustomerDocument.objects.filter(pk=self.second_w9.pk).update(file_type='seed_tag')
+        response, files = self.download(file_type='w9')
+        self.assertEqual(sorted(files.values()), [b"%PDF-1.4 jane w9", b"%PDF-1.4 john w9"])
+
+        response, files = self.download(search_document="John_Smith")
+        self.assertEqual(list(files.values()), [b"%PDF-1.4 john w9"])
+
+    def test_missing_file_left_out(self):
+        """Tests that a file missing from storage does not break the archive"""
+        os.remove(CustomerDocument.objects.get(pk=self.smith_w9.pk).file.path)
+        response, files = self.download(file_type='w9')
+        self.assertEqual(len(files), 2)
+
+    def test_documents_required(self):
+        """Tests that the documents to download must be chosen"""
+        self.assertEqual(self.client.get(reverse('download-documents-zip')).status_code, 400)
+        self.assertEqual(self.client.get(reverse('download-documents-zip'), {'customer': "x"}).status_code, 400)
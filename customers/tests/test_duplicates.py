@@ -0,0 +1,201 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.db.models.signals import m2m_changed
+from django.urls import reverse
+from io import StringIO
+import csv
+import os
+import shutil
+import tempfile
+
+from app_users.models import CustomUser
+from customers.models import Customer, Address, Email, Phone, CustomerMailingList
+from customers.duplicate_clusters import UnionFind, find_duplicate_clusters
+from customers.duplicates import find_duplicates, match_keys
+from customers.imports import IMPORT_COLUMNS, import_customers
+from customers.matching import name_key, phone_key, phonetic_key, soundex
+from customers.signals import update_customers_and_addresses
+
+
+class MatchingKeyTestCase(TestCase):
+    """Tests the blocking keys: normalized names, soundex, phone numbers"""
+
+    def test_name_key(self):
+        """Tests that the ways a name is typed in share a key"""
+        self.assertEqual(name_key("The Smith-Jones Farm, LLC"), "SMITH JONES FARM")
+        self.assertEqual(name_key("josé", "o'brien"), "JOSE O BRIEN")
+
+    def test_soundex(self):
+        """Tests the american soundex codes (H & W don't separate letters with the same code)"""
+        self.assertEqual([soundex(word) for word in ["Robert", "Rupert", "Ashcraft", "Tymczak", "Pfister", "Lee"]],
+                         ["R163", "R163", "A261", "T522", "P236", "L000"])
+        self.assertEqual(phonetic_key(name_key("Jon", "Smyth")), phonetic_key(name_key("John", "Smith")))
+
+    def test_phone_key(self):
+        """Tests that phone numbers are keyed as they are stored"""
+        self.assertEqual(phone_key("(330) 674.2811"), "330-674-2811")
+        self.assertEqual(phone_key("+1 330 674 2811"), "330-674-2811")
+        self.assertEqual(phone_key("674-2811"), "")
+
+
+class DuplicateDetectionTestCase(TestCase):
+    """Tests the duplicate candidates found with the blocking keys: at sign-up, during imports & as customers change"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user & an existing customer (Jane Doe) with an address, phone & email.
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        self.customer = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person")
+        self.customer.addresses.add(Address.objects.create(street="123 North Main Street", city="Canton", state="OH", zip_code="44718"))
+        self.customer.phones.add(Phone.objects.create(phone_number="3306742811", phone_type="cell"))
+        self.customer.emails.add(Email.objects.create(email_address="Jane.Doe@Test.com"))
+        Customer.objects.create(first_name="Other", last_name="Person", customer_type="person")
+
+    def test_keys_kept_in_step_with_the_name(self):
+        """Tests that the name keys are stored on save, also when only some fields are saved"""
+        self.assertEqual((self.customer.name_key, self.customer.phonetic_key), ("JANE DOE", "J500 D000"))
+        self.customer.last_name = "Smith"
+        self.customer.save(update_fields=["last_name"])
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).name_key, "JANE SMITH")
+
+    def test_find_duplicates(self):
+        """Tests that every kind of key is matched & the candidates are scored"""
+        keys = match_keys("Jayne", "Doe", phones=["(330) 674-2811"], emails=["jane.doe@test.com"],
+                          addresses=[("123 N Main St", "Canton", "oh", "44718-1234")])
+
+        # one indexed lookup per kind of key & one for the customers found
+        with self.assertNumQueries(6):
+            candidates = find_duplicates(keys)
+
+        self.assertEqual([candidate.customer for candidate in candidates], [self.customer])
+        self.assertEqual(candidates[0].reasons, ["phonetic", "phone", "email", "address"])
+        self.assertEqual(candidates[0].score, 1.0)
+
+        self.assertEqual(find_duplicates(match_keys("Nobody", "Here")), [])
+        self.assertEqual(find_duplicates(match_keys("Jane", "Doe"))[0].reason_labels, "same name")
+
+    def test_signup_step_one_warns(self):
+        """Tests that step 1 of the sign-up lists similar customers until the user confirms the customer is new"""
+        data = {'first_name': 'Jane', 'last_name': 'Doe', 'customer_type': 'person'}
+        response = self.client.post(reverse('create_customer_view_partial'), data)
+        self.assertContains(response, "This customer may already exist")
+        self.assertContains(response, reverse('view_customer_profile', args=[self.customer.id]))
+        self.assertEqual(self.client.session.get('signup_step', 0), 0, "The step should not be staged yet.")
+
+        response = self.client.post(reverse('create_customer_view_partial'), {**data, 'not_a_duplicate': '1'})
+        self.assertContains(response, "Step 2 of 6")
+        self.assertEqual(self.client.session['signup_step'], 1)
+
+    def test_signup_new_name_goes_straight_on(self):
+        """Tests that a customer that looks like nobody goes straight to step 2"""
+        response = self.client.post(reverse('create_customer_view_partial'), {'first_name': 'Zed', 'last_name': 'Quux', 'customer_type': 'person'})
+        self.assertContains(response, "Step 2 of 6")
+
+    def test_import_skips_duplicates(self):
+        """Tests that import rows like an existing customer or an earlier row are skipped & reported (unless allowed)"""
+        import_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, import_dir, True)
+        path = os.path.join(import_dir, "customers.csv")
+
+        rows = [
+            {"first_name": "Jane", "last_name": "Doe", "customer_type": "person", "email_address": "JANE.DOE@test.com"},
+            {"first_name": "Sam", "last_name": "Lee", "customer_type": "person", "phone_number": "330-555-0000", "phone_type": "cell"},
+            {"first_name": "Samuel", "last_name": "Lee", "customer_type": "person", "phone_number": "3305550000", "phone_type": "cell",
+             "email_address": "sam@test.com"},
+            {"first_name": "New", "last_name": "Customer", "customer_type": "person"},
+            {"first_name": "Sam", "last_name": "Lee", "customer_type": "person", "phone_number": "3305550000", "phone_type": "home"},
+        ]
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(IMPORT_COLUMNS)
+            writer.writerows([row.get(column, "") for column in IMPORT_COLUMNS] for row in rows)
+
+        report = StringIO()
+        stats = import_customers(path, user=self.user, report=report)
+        self.assertEqual((stats.imported, stats.duplicates), (3, 2))
+        report_rows = list(csv.reader(StringIO(report.getvalue())))[1:]
+        self.assertEqual([row[:2] for row in report_rows], [["2", "duplicate"], ["6", "duplicate"]])
+        self.assertIn(f"customer #{self.customer.pk}", report_rows[0][2])
+        self.assertIn("row 3 (same name, same phone)", report_rows[1][2])
+
+        # the 3rd row shares the phone of the 2nd (same batch) but its name is different: not likely a duplicate
+        self.assertTrue(Customer.objects.filter(first_name="Samuel").exists())
+
+        stats = import_customers(path, user=self.user, skip_duplicates=False)
+        self.assertEqual(stats.imported, 5)
+
+
+class DuplicateClusterTestCase(TestCase):
+    """Tests the batch clustering of likely duplicates across the whole customer base"""
+
+    def setUp(self):
+        """
+            Sets up a chain of duplicates (Mary Major twice with the same phone, the 2nd with the email & address of
+            Mary Smith), two customers with only the same name & three customers sharing an office address.
+        """
+        def customer(first_name, last_name, phone=None, email=None, address=None):
+            customer = Customer.objects.create(first_name=first_name, last_name=last_name, customer_type="person")
+            if phone:
+                customer.phones.add(Phone.objects.create(phone_number=phone, phone_type="cell"))
+            if email:
+                customer.emails.add(Email.objects.create(email_address=email))
+            if address:
+                customer.addresses.add(Address.objects.create(street=address, city="Canton", state="OH", zip_code="44718"))
+            return customer
+
+        self.chain = [
+            customer("Mary", "Major", phone="3305550001"),
+            customer("Mary", "Major", phone="330-555-0001", email="mary@test.com", address="5 Elm Street"),
+            customer("Mary", "Smith", email="MARY@test.com", address="5 Elm St"),
+        ]
+        customer("Bob", "Stone")
+        customer("Bob", "Stone")
+        for first_name, last_name in [("Carl", "One"), ("Dana", "Two"), ("Evan", "Three")]:
+            customer(first_name, last_name, address="1 Office Park")
+
+    def test_union_find(self):
+        """Tests that pairs sharing a customer end up in one group"""
+        groups = UnionFind()
+        groups.union(1, 2)
+        groups.union(3, 4)
+        groups.union(2, 4)
+        groups.union(5, 6)
+        self.assertEqual(sorted(sorted(group) for group in groups.groups()), [[1, 2, 3, 4], [5, 6]])
+
+    def test_clusters(self):
+        """Tests that likely duplicates are chained into one cluster & every candidate pair is scored once"""
+        clusters, links, stats = find_duplicate_clusters()
+
+        self.assertEqual(clusters, [[customer.id for customer in self.chain]])
+        self.assertEqual(links[self.chain[2].id], (0.8, self.chain[1].id, ["email", "address"]))
+        # Mary Major twice & Bob Stone twice share 3 & 2 blocks but are scored once, the office address pairs are scored
+        self.assertEqual((stats.pairs, stats.matches, stats.clustered), (6, 2, 3))
+
+    def test_oversized_blocks_skipped(self):
+        """Tests that keys shared by too many customers are not paired up"""
+        clusters, links, stats = find_duplicate_clusters(max_block_size=2)
+        self.assertEqual(stats.skipped_blocks, 1)
+        self.assertEqual(stats.pairs, 3)
+        self.assertEqual(len(clusters), 1)
+
+    def test_worker_pool(self):
+        """Tests that a pool of worker processes finds the same clusters (every chunk is scored by a pool task)"""
+        self.assertEqual(find_duplicate_clusters(workers=2, chunk_size=2)[:2], find_duplicate_clusters()[:2])
+
+    def test_command_report(self):
+        """Tests that the management command writes one report line per clustered customer"""
+        report_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, report_dir, True)
+        path = os.path.join(report_dir, "duplicates.csv")
+        out = StringIO()
+        call_command("find_duplicate_customers", path, workers=1, stdout=out)
+
+        self.assertIn("1 clusters of 3 customers", out.getvalue())
+        with open(path) as report:
+            rows = list(csv.reader(report))
+        self.assertEqual(rows[0][:3], ["Cluster", "Cluster Size", "Customer ID"])
+        self.assertEqual([row[2] for row in rows[1:]], [str(customer.id) for customer in self.chain])
+        self.assertEqual(rows[3][-3:], [str(self.chain[1].id), "0.80", "same email, same address"])
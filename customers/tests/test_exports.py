@@ -0,0 +1,112 @@
+from django.test import TestCase
+from django.urls import reverse
+from io import BytesIO
+import csv
+import zipfile
+from xml.etree import ElementTree
+
+from app_users.models import CustomUser
+from customers.models import Customer, Address, Email, Phone, CustomerInterest, CustomerMailingList
+from customers.exports import EXPORT_COLUMNS, customer_export_rows, mailing_list_export_rows
+from customers.streaming import stream_xlsx
+
+SHEET_NS = {"s": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+
+
+def xlsx_rows(content):
+    """Reads the cell values of the first sheet of a streamed xlsx file"""
+    with zipfile.ZipFile(BytesIO(content)) as workbook:
+        assert workbook.testzip() is None, "Every member of the workbook should be readable."
+        sheet = ElementTree.fromstring(workbook.read("xl/worksheets/sheet1.xml"))
+    return [[cell.findtext("s:is/s:t", "", SHEET_NS) for cell in row.findall("s:c", SHEET_NS)] for row in sheet.iter(f"{{{SHEET_NS['s']}}}row")]
+
+
+class ExportTestCase(TestCase):
+    """Tests the streaming csv / excel exports of mailing lists & filtered customers"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user & a mailing list of 5 customers with a mailing address, preferred email & primary phone.
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        self.interest = CustomerInterest.objects.create(name="Tree Sale", slug="tree-sale")
+        self.mailing_list = CustomerMailingList.objects.create(name="Tree Sale")
+        for i in range(5):
+            customer = Customer.objects.create(first_name=f"First{i}", last_name=f"Last{i}", customer_type="person", creator=self.user)
+            address = Address.objects.create(street=f"{i} Main St", city="Canton", state="OH", zip_code="44718")
+            customer.addresses.add(address)
+            customer.emails.add(
+                Email.objects.create(email_address=f"old{i}@test.com", preferred_email=False),
+                Email.objects.create(email_address=f"first{i}@test.com", preferred_email=True),
+            )
+            customer.phones.add(Phone.objects.create(phone_number=f"330674281{i}", phone_type="cell", is_primary=True))
+            customer.interests.add(self.interest)
+            self.mailing_list.addresses.add(address)
+
+        # a farm with no contact details & no address
+        Customer.objects.create(first_name="Green Acres", customer_type="farm")
+
+    def test_mailing_list_rows_constant_queries(self):
+        """Tests that the rows are fetched with the same number of queries per chunk, whatever the number of rows"""
+        with self.assertNumQueries(4):
+            rows = list(mailing_list_export_rows(self.mailing_list))
+        self.assertEqual(rows[0], ("First0 Last0", "Person", "0 Main St", "Canton", "OH", "44718", "first0@test.com", "330-674-2810"))
+        self.assertEqual(len(rows), 5)
+
+        # 3 chunks of 2 addresses: the streamed address query + 3 prefetch queries per chunk
+        with self.assertNumQueries(10):
+            self.assertEqual(list(mailing_list_export_rows(self.mailing_list, chunk_size=2)), rows)
+
+    def test_customer_rows_constant_queries(self):
+        """Tests that customer rows get their mailing address & contact details with 3 prefetch queries per chunk"""
+        with self.assertNumQueries(4):
+            rows = list(customer_export_rows(Customer.objects.all()))
+
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[-1], ("Green Acres", "Farm", "", "", "", "", "", ""), "Missing details should be left blank.")
+
+    def test_export_mailing_list_csv(self):
+        """Tests that the mailing list is streamed as a csv attachment"""
+        response = self.client.get(reverse('export-mailing-list', args=[self.mailing_list.id]), {'format': 'csv'})
+
+        self.assertTrue(response.streaming, "The export should be streamed rather than buffered in the response.")
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('Tree Sale.csv', response['Content-Disposition'])
+
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], EXPORT_COLUMNS)
+        self.assertEqual(len(rows), 6)
+
+    def test_export_mailing_list_xlsx(self):
+        """Tests that the excel export is a valid workbook holding the header & a row per address"""
+        response = self.client.get(reverse('export-mailing-list', args=[self.mailing_list.id]), {'format': 'xlsx'})
+
+        self.assertTrue(response.streaming)
+        self.assertIn('Tree Sale.xlsx', response['Content-Disposition'])
+        rows = xlsx_rows(b"".join(response.streaming_content))
+        self.assertEqual(rows[0], EXPORT_COLUMNS)
+        self.assertEqual(rows[1][:3], ["First0 Last0", "Person", "0 Main St"])
+        self.assertEqual(len(rows), 6)
+
+    def test_stream_xlsx_escapes_values(self):
+        """Tests that xml special & control characters can't break the sheet"""
+        content = b"".join(stream_xlsx(["Name"], [["Smith & Sons <Farm>\x07"], [None]], sheet_name="A/B"))
+        self.assertEqual(xlsx_rows(content), [["Name"], ["Smith & Sons <Farm>"], []])
+
+    def test_export_customers_filters(self):
+        """Tests that the customer export uses the home page filters"""
+        url = reverse('export-customers')
+
+        response = self.client.get(url, {'format': 'csv', 'search_customer': 'First1'})
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual([row[0] for row in rows[1:]], ["First1 Last1"])
+
+        response = self.client.get(url, {'format': 'csv', 'selected_interests': 'tree-sale', 'selected_users': self.user.id})
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(len(rows), 6, "Only the 5 customers with the interest should be exported.")
+
+        response = self.client.get(url, {'start_date': 'not a date'})
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(len(rows), 7, "Unparseable dates should be ignored.")
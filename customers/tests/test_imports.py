@@ -0,0 +1,188 @@
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import m2m_changed
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from io import StringIO
+import csv
+import os
+import shutil
+import tempfile
+
+from app_users.models import CustomUser
+from customers.models import Customer, Address, ContactMethod, CustomerImport, CustomerInterest, CustomerMailingList
+from customers.imports import IMPORT_COLUMNS, import_customers, read_import_rows
+from customers.signals import update_customers_and_addresses
+from customers.streaming import stream_xlsx
+
+
+class CustomerImportTestCase(TestCase):
+    """Tests the bulk customer import: csv & excel files, batched bulk inserts, the error report & the mailing lists"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user, a Tree Sale interest & mailing list, an Email contact method & a throwaway import
+            directory.
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        self.import_dir = tempfile.mkdtemp()
+        import_settings = override_settings(CUSTOMER_IMPORT_ROOT=self.import_dir)
+        import_settings.enable()
+        self.addCleanup(import_settings.disable)
+        self.addCleanup(shutil.rmtree, self.import_dir, True)
+
+        # the signal tests disconnect the mailing list signals when they are done - make sure they are connected
+        m2m_changed.connect(update_customers_and_addresses, sender=CustomerMailingList.interests.through)
+
+        self.interest = CustomerInterest.objects.create(name="Tree Sale", slug="tree-sale")
+        self.mailing_list = CustomerMailingList.objects.create(name="Tree Sale")
+        self.mailing_list.interests.add(self.interest)
+        self.contact_method = ContactMethod.objects.create(method_name="Email")
+
+    def row(self, i, **values):
+        """An import row of customer i - a person with an address, phone & email"""
+        row = {
+            "first_name": f"First{i}", "last_name": f"Last{i}", "customer_type": "person",
+            "street": f"{i} North Main Street", "city": "Canton", "state": "oh", "zip_code": "44718",
+            "phone_number": f"330674{i:04d}", "phone_type": "cell",
+            "email_address": f"customer{i}@test.com", "email_type": "home",
+        }
+        row.update(values)
+        return [row.get(column, "") for column in IMPORT_COLUMNS]
+
+    def write_csv(self, rows, name="customers.csv"):
+        """Writes an import file with the IMPORT_COLUMNS header & returns its path"""
+        path = os.path.join(self.import_dir, name)
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(IMPORT_COLUMNS)
+            writer.writerows(rows)
+        return path
+
+    def test_import_csv(self):
+        """Tests that valid rows are saved with their contacts & invalid rows are reported, not saved"""
+        rows = [self.row(i, interests="tree-sale", contact_methods="email") for i in range(3)]
+        rows.append(self.row(3, customer_type="alien", zip_code="123"))
+        rows.append(self.row(4, interests="Fish Sale"))
+        report = StringIO()
+
+        stats = import_customers(self.write_csv(rows), user=self.user, report=report)
+
+        self.assertEqual((stats.rows, stats.imported, stats.failed), (5, 3, 2))
+        self.assertEqual(Customer.objects.count(), 3)
+        customer = Customer.objects.get(first_name="First1")
+        self.assertEqual(customer.creator, self.user)
+        address = customer.addresses.get()
+        self.assertEqual(address.state, "OH")
+        self.assertEqual(address.normalized_key, "1 N MAIN ST|CANTON|OH|44718", "Bulk inserts should still set the key.")
+        self.assertEqual(customer.phones.get().phone_number, "330-674-0001", "Bulk inserts should still format the number.")
+        self.assertEqual(customer.emails.get().email_address, "customer1@test.com")
+        self.assertEqual(list(customer.interests.all()), [self.interest])
+        self.assertEqual(list(customer.preferred_contact_methods.all()), [self.contact_method])
+
+        # one line per error: the spreadsheet row number (the header is row 1), the column & the message
+        report_rows = list(csv.reader(StringIO(report.getvalue())))
+        self.assertEqual(report_rows[0], ["Row", "Column", "Error"])
+        self.assertEqual({(row[0], row[1]) for row in report_rows[1:]}, {("5", "customer_type"), ("5", "customer"), ("5", "zip_code"), ("6", "interests")})
+
+    def test_import_xlsx(self):
+        """Tests that an excel workbook is read like a csv file (header names are matched loosely)"""
+        header = [column.replace("_", " ").title() for column in IMPORT_COLUMNS]
+        path = os.path.join(self.import_dir, "customers.xlsx")
+        with open(path, "wb") as file:
+            # the rows have empty cells (interests, contact methods, ...) - the cells after them keep their column
+            for chunk in stream_xlsx(header, [self.row(i) for i in range(3)]):
+                file.write(chunk)
+
+        rows = list(read_import_rows(path))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual((rows[2]["first_name"], rows[2]["zip_code"]), ("First2", "44718"))
+
+        stats = import_customers(path, user=self.user)
+        self.assertEqual(stats.imported, 3)
+        self.assertEqual(Address.objects.count(), 3)
+
+    def test_queries_per_batch(self):
+        """Tests that the number of queries depends on the number of batches, not on the number of rows"""
+        def count_queries(rows, batch_size):
+            path = self.write_csv(rows, name=f"customers{len(rows)}.csv")
+            with CaptureQueriesContext(connection) as context:
+                import_customers(path, user=self.user, batch_size=batch_size)
+            return len(context.captured_queries)
+
+        few = count_queries([self.row(i, interests="tree-sale") for i in range(5)], batch_size=50)
+        many = count_queries([self.row(i, interests="tree-sale") for i in range(5, 45)], batch_size=50)
+        self.assertEqual(few, many, "A batch should be saved with the same queries whatever its size.")
+
+        two_batches = count_queries([self.row(i) for i in range(45, 85)], batch_size=20)
+        self.assertLess(two_batches, 2 * many)
+
+    def test_mailing_lists_reconciled_once(self):
+        """Tests that the customers join the mailing lists of their interests with their mailing addresses"""
+        version = CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version
+        dynamic = CustomerMailingList.objects.create(name="Dynamic List", is_dynamic=True, rule={})
+        CustomerMailingList.objects.filter(pk=dynamic.pk).update(refreshed_at="2026-01-01T00:00:00Z")
+
+        rows = [self.row(i, interests="Tree Sale") for i in range(4)]
+        rows.append(self.row(4, interests="Tree Sale", mailing_address="no"))
+        rows.append(self.row(5))
+        import_customers(self.write_csv(rows), user=self.user)
+
+        self.mailing_list.refresh_from_db()
+        self.assertEqual(self.mailing_list.customers.count(), 4, "Customers without a mailing address are left out.")
+        self.assertEqual(self.mailing_list.addresses.count(), 4)
+        self.assertEqual(self.mailing_list.membership_version, version + 1, "The version should be bumped once.")
+        self.assertIsNone(CustomerMailingList.objects.get(pk=dynamic.pk).refreshed_at, "Dynamic lists should be marked stale.")
+
+    def test_unreadable_file(self):
+        """Tests that a file without the required columns is refused by the command"""
+        path = os.path.join(self.import_dir, "customers.csv")
+        with open(path, "w") as file:
+            file.write("name,town\nJane,Canton\n")
+
+        with self.assertRaisesMessage(Exception, "first_name & customer_type are required"):
+            call_command("import_customers", path, stdout=StringIO())
+
+    def test_import_command(self):
+        """Tests that the management command imports the file, writes the error report & reports the throughput"""
+        path = self.write_csv([self.row(0), self.row(1, state="XX")])
+        report_path = os.path.join(self.import_dir, "errors.csv")
+        out = StringIO()
+        call_command("import_customers", path, user="test@test.com", errors=report_path, stdout=out)
+
+        self.assertIn("1 of 2 rows imported (1 failed, 0 duplicates)", out.getvalue())
+        self.assertIn("rows/min", out.getvalue())
+        self.assertEqual(Customer.objects.get().creator, self.user)
+        with open(report_path) as report:
+            self.assertEqual(list(csv.reader(report))[1][:2], ["3", "state"])
+
+    @override_settings(BACKGROUND_TASKS_SYNCHRONOUS=True)
+    def test_import_view(self):
+        """Tests that an uploaded file is imported in the background & its error report can be downloaded"""
+        with open(self.write_csv([self.row(0), self.row(1, customer_type="")]), "rb") as file:
+            upload = SimpleUploadedFile("partner list.csv", file.read(), content_type="text/csv")
+        response = self.client.post(reverse('import-customers'), {'file': upload})
+
+        customer_import = CustomerImport.objects.get()
+        self.assertRedirects(response, reverse('customer-import-status', args=[customer_import.id]))
+        self.assertEqual((customer_import.status, customer_import.imported, customer_import.failed), ('done', 1, 1))
+        self.assertEqual(customer_import.requested_by, self.user)
+
+        response = self.client.get(reverse('customer-import-status', args=[customer_import.id]), HTTP_HX_REQUEST="true")
+        self.assertContains(response, "1 of 2 rows imported")
+        self.assertNotContains(response, "hx-trigger", msg_prefix="A finished import should stop polling.")
+
+        response = self.client.get(reverse('customer-import-report', args=[customer_import.id]))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="partner list_errors.csv"')
+        self.assertIn(b"customer_type", b"".join(response.streaming_content))
+
+    def test_import_view_refuses_other_files(self):
+        """Tests that only csv & excel files can be uploaded"""
+        upload = SimpleUploadedFile("customers.pdf", b"%PDF-1.4", content_type="application/pdf")
+        response = self.client.post(reverse('import-customers'), {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(CustomerImport.objects.exists())
@@ -0,0 +1,344 @@
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from io import BytesIO, StringIO
+import os
+import shutil
+import tempfile
+import time
+
+from app_users.models import CustomUser
+from customers.models import Customer, Address, CustomerMailingList
+from django.core.management import call_command
+from pypdf import PdfReader
+from customers.models import LabelRenderJob
+from customers.labels import (
+    mailing_list_label_rows,
+    render_labels,
+    cached_labels_pdf,
+    evict_label_cache,
+    page_aligned_chunks,
+    render_labels_in_parallel,
+    LABEL_TEMPLATES,
+    mailing_list_dedupe_counts,
+)
+
+
+class LabelTestSetUp(TestCase):
+    """Shared label test data - holds no tests itself"""
+    def setUp(self):
+        """
+            Sets up a logged in user & a mailing list with 35 labelled addresses (more than one Avery 5160 sheet).
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        # rendered pdfs are cached in a throwaway directory
+        self.cache_dir = tempfile.mkdtemp()
+        cache_settings = override_settings(LABEL_CACHE_ROOT=self.cache_dir)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+
+        self.mailing_list = CustomerMailingList.objects.create(name="Tree Sale")
+        for i in range(35):
+            customer = Customer.objects.create(first_name=f"First{i}", last_name=f"Last{i}", customer_type="person")
+            address = Address.objects.create(street=f"{i} Main St", city="Canton", state="OH", zip_code="44718")
+            customer.addresses.add(address)
+            self.mailing_list.addresses.add(address)
+
+        # an address with no customer should not produce a label
+        self.mailing_list.addresses.add(Address.objects.create(street="1 Empty Rd", city="Canton", state="OH", zip_code="44718"))
+
+
+class MailingListLabelTestCase(LabelTestSetUp):
+    """Tests the label rows, the pdf rendering & the label view"""
+
+    def test_label_rows_single_query(self):
+        """Tests that all label rows (address & customer name) are fetched in one query"""
+        with self.assertNumQueries(1):
+            rows = list(mailing_list_label_rows(self.mailing_list))
+
+        self.assertEqual(len(rows), 35, "Every address with a customer should have exactly one label.")
+        self.assertEqual(rows[0], ("First0 Last0", "0 Main St", "Canton", "OH", "44718"))
+
+    def test_label_rows_use_newest_customer(self):
+        """Tests that a shared address is labelled once, with the newest linked customer (as address.customer_addresses.first())"""
+        address = Address.objects.get(street="0 Main St")
+        farm = Customer.objects.create(first_name="Green Acres", customer_type="farm")
+        farm.addresses.add(address)
+
+        rows = list(mailing_list_label_rows(self.mailing_list))
+        self.assertEqual(len(rows), 35, "A shared address should still produce a single label.")
+        self.assertEqual(rows[0][0], address.customer_addresses.first().mailing_list_name)
+        self.assertEqual(rows[0][0], "Green Acres")
+
+    def test_render_labels_page_breaks(self):
+        """Tests that labels wrap onto a new page and that the start position counts as used label slots"""
+        rows = list(mailing_list_label_rows(self.mailing_list))
+
+        output = BytesIO()
+        self.assertEqual(render_labels(rows, output), 35)
+        self.assertEqual(output.getvalue().count(b"/Type /Page\n"), 2, "35 labels need two sheets.")
+
+        # starting on the last slot of the first sheet leaves 1 label on page 1 and 30 + 4 after
+        output = BytesIO()
+        self.assertEqual(render_labels(rows, output, start_position=29), 35, "No labels should be skipped with a start position.")
+        self.assertEqual(output.getvalue().count(b"/Type /Page\n"), 3)
+
+    def test_generate_labels_pdf_view_streams(self):
+        """Tests that the label view streams back a pdf attachment"""
+        response = self.client.post(reverse('generate_labels_pdf', args=[self.mailing_list.id]), {'start_position': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming, "The pdf should be streamed rather than buffered in the response.")
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('Tree Sale_labels.pdf', response['Content-Disposition'])
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+
+
+class LabelCacheTestCase(LabelTestSetUp):
+    """Tests the cached label pdfs & the mailing list membership version"""
+
+    def test_version_bumped_on_membership_change(self):
+        """Tests that adding / removing members and editing member addresses bump the membership version"""
+        version = CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version
+
+        address = Address.objects.create(street="9 Oak Ave", city="Canton", state="OH", zip_code="44718")
+        self.mailing_list.addresses.add(address)
+        self.assertGreater(CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version, version)
+
+        version = CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version
+        address.street = "10 Oak Ave"
+        address.save()
+        self.assertGreater(CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version, version)
+
+        version = CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version
+        address.mailing_addresses.remove(self.mailing_list)
+        self.assertGreater(CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version, version)
+
+    def test_version_not_bumped_for_other_lists(self):
+        """Tests that editing an address that is not on the list leaves the version alone"""
+        version = CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version
+        Address.objects.create(street="9 Oak Ave", city="Canton", state="OH", zip_code="44718").save()
+        self.assertEqual(CustomerMailingList.objects.get(pk=self.mailing_list.pk).membership_version, version)
+
+    def test_cached_pdf_reused_until_version_changes(self):
+        """Tests that a cached pdf is served without touching the label rows, and re-rendered after a change"""
+        mailing_list = CustomerMailingList.objects.get(pk=self.mailing_list.pk)
+        path, stats = cached_labels_pdf(mailing_list, start_position=3)
+        self.assertEqual(stats.labels, 35)
+
+        # cache hit: no queries at all
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_labels_pdf(mailing_list, start_position=3), (path, None))
+
+        # a different start position is a different pdf
+        self.assertNotEqual(cached_labels_pdf(mailing_list, start_position=0)[0], path)
+
+        # changing the list gives a new pdf & the stale version is removed
+        self.mailing_list.addresses.remove(Address.objects.get(street="0 Main St"))
+        mailing_list = CustomerMailingList.objects.get(pk=self.mailing_list.pk)
+        new_path, _ = cached_labels_pdf(mailing_list, start_position=3)
+        self.assertNotEqual(new_path, path)
+        self.assertFalse(os.path.exists(path), "Pdfs of older membership versions should be removed.")
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(new_path)])
+
+    def test_evict_label_cache_by_age_and_size(self):
+        """Tests that old pdfs are evicted first, then the least recently used until the cache fits"""
+        def cache_file(name, size, age):
+            path = os.path.join(self.cache_dir, name)
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+            os.utime(path, (time.time() - age, time.time() - age))
+            return path
+
+        expired = cache_file("expired.pdf", 10, 1000)
+        oldest = cache_file("oldest.pdf", 100, 300)
+        newest = cache_file("newest.pdf", 100, 100)
+        kept = cache_file("kept.pdf", 100, 200)
+
+        evict_label_cache(keep=kept, max_age=500, max_bytes=250)
+
+        self.assertFalse(os.path.exists(expired), "Pdfs older than the max age should be evicted.")
+        self.assertFalse(os.path.exists(oldest), "The least recently used pdf should be evicted to fit the size limit.")
+        self.assertTrue(os.path.exists(newest))
+        self.assertTrue(os.path.exists(kept), "The pdf being served should never be evicted.")
+
+
+class ParallelLabelRenderTestCase(LabelTestSetUp):
+    """Tests the process pool label engine, the management command & the background label jobs"""
+
+    def test_page_aligned_chunks(self):
+        """Tests that only the first chunk starts part way into a sheet and every chunk ends on a page boundary"""
+        rows = list(mailing_list_label_rows(self.mailing_list))
+        chunks = list(page_aligned_chunks(rows, start_position=29, pages_per_chunk=1))
+
+        self.assertEqual([(start, len(chunk)) for start, chunk in chunks], [(29, 1), (0, 30), (0, 4)])
+        self.assertEqual([row for _, chunk in chunks for row in chunk], rows, "Chunks should keep the label order.")
+
+    def test_render_labels_in_parallel(self):
+        """Tests that chunks rendered by worker processes are concatenated into one pdf, in order"""
+        rows = list(mailing_list_label_rows(self.mailing_list))
+        output = BytesIO()
+        stats = render_labels_in_parallel(rows, output, start_position=29, workers=2, pages_per_chunk=1)
+
+        self.assertEqual((stats.labels, stats.pages), (35, 3))
+        self.assertGreater(stats.labels_per_second, 0)
+
+        output.seek(0)
+        pages = PdfReader(output).pages
+        self.assertEqual(len(pages), 3)
+        self.assertIn("First0 Last0", pages[0].extract_text())
+        self.assertIn("First1 Last1", pages[1].extract_text())
+        self.assertIn("First34 Last34", pages[2].extract_text())
+
+    def test_render_mailing_labels_command(self):
+        """Tests the management command writes the pdf and reports the throughput"""
+        path = os.path.join(self.cache_dir, "labels.pdf")
+        out = StringIO()
+        call_command("render_mailing_labels", self.mailing_list.id, output=path, workers=2, pages_per_chunk=1, stdout=out)
+
+        self.assertIn("35 labels on 2 pages", out.getvalue())
+        self.assertIn("labels/s", out.getvalue())
+        self.assertEqual(len(PdfReader(path).pages), 2)
+
+    @override_settings(BACKGROUND_TASKS_SYNCHRONOUS=True)
+    def test_background_label_job(self):
+        """Tests that the print labels page can start a background job & download its pdf once it is done"""
+        response = self.client.post(reverse('start_label_render_job', args=[self.mailing_list.id]), {'start_position': 3})
+        self.assertEqual(response.status_code, 200)
+
+        job = LabelRenderJob.objects.get(mailing_list=self.mailing_list)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.start_position, job.labels, job.pages), (2, 35, 2))
+        self.assertContains(response, reverse('download_label_render_job', args=[job.id]))
+
+        response = self.client.get(reverse('download_label_render_job', args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+
+
+class LabelTemplateTestCase(LabelTestSetUp):
+    """Tests the label template library: precomputed layouts, one font per page & the reusable page decoration"""
+
+    def test_slots_fit_on_page(self):
+        """Tests that every template has one slot per label & every slot lies on the page"""
+        for key, layout in LABEL_TEMPLATES.items():
+            self.assertEqual(len(layout.slots), layout.labels_per_page, key)
+            page_width, page_height = layout.page_size
+            for x, y in layout.slots:
+                self.assertTrue(0 < x < page_width and 0 < y < page_height, f"{key} has a slot off the page.")
+
+    def test_font_set_once_per_page(self):
+        """Tests that the labels of a page share one text object, so the font is only set once per page"""
+        rows = list(mailing_list_label_rows(self.mailing_list))
+        output = BytesIO()
+        render_labels(rows, output, template="avery_5163")
+
+        output.seek(0)
+        pages = PdfReader(output).pages
+        self.assertEqual(len(pages), 4, "35 labels need four sheets of 10 labels.")
+        for page in pages:
+            # reportlab's page preamble sets the default font, the labels set theirs once
+            self.assertEqual(page.get_contents().get_data().count(b" Tf"), 2, "The font should not be set per label.")
+
+        # 80 labels per sheet
+        output = BytesIO()
+        render_labels(rows, output, template="avery_5167")
+        output.seek(0)
+        self.assertEqual(len(PdfReader(output).pages), 1)
+
+    def test_envelope_return_address_form(self):
+        """Tests that envelopes get one address per page & the return address is drawn once as a shared form"""
+        rows = list(mailing_list_label_rows(self.mailing_list))[:3]
+        output = BytesIO()
+        render_labels(rows, output, template="envelope_10", return_address=("Tree Farm", "1 Farm Rd"))
+
+        output.seek(0)
+        reader = PdfReader(output)
+        self.assertEqual(len(reader.pages), 3)
+        forms = {page["/Resources"]["/XObject"].raw_get("/FormXob.label_page_decoration").idnum for page in reader.pages}
+        self.assertEqual(len(forms), 1, "Every envelope should reuse the same return address form.")
+        self.assertIn("Tree Farm", reader.pages[2].extract_text())
+        self.assertIn("First2 Last2", reader.pages[2].extract_text())
+
+    @override_settings(LABEL_RETURN_ADDRESS=["Tree Farm", "1 Farm Rd"])
+    def test_template_part_of_cache_key(self):
+        """Tests that each template (and envelope return address) is cached as its own pdf"""
+        mailing_list = CustomerMailingList.objects.get(pk=self.mailing_list.pk)
+        sheet_path, _ = cached_labels_pdf(mailing_list, template="avery_5160")
+        envelope_path, stats = cached_labels_pdf(mailing_list, template="envelope_10")
+        self.assertNotEqual(sheet_path, envelope_path)
+        self.assertEqual((stats.labels, stats.pages), (35, 35))
+
+        with override_settings(LABEL_RETURN_ADDRESS=["New Farm"]):
+            self.assertNotEqual(cached_labels_pdf(mailing_list, template="envelope_10")[0], envelope_path)
+
+    def test_print_labels_page_template_grid(self):
+        """Tests that the print labels page shows the grid of the picked template & falls back to Avery 5160"""
+        url = reverse('print_labels_page', args=[self.mailing_list.id])
+
+        response = self.client.get(url, {'template': 'avery_5167'})
+        self.assertEqual(response.context['layout'], LABEL_TEMPLATES['avery_5167'])
+        self.assertContains(response, 'class="label-cell', count=80)
+
+        response = self.client.get(url, {'template': 'unknown'})
+        self.assertEqual(response.context['template'], 'avery_5160')
+        self.assertContains(response, 'class="label-cell', count=30)
+
+    def test_generate_labels_pdf_with_template(self):
+        """Tests that the label view prints on the posted template"""
+        response = self.client.post(
+            reverse('generate_labels_pdf', args=[self.mailing_list.id]), {'start_position': 1, 'template': 'avery_5163'}
+        )
+        pages = PdfReader(BytesIO(b"".join(response.streaming_content))).pages
+        self.assertEqual(len(pages), 4)
+
+
+class HouseholdingTestCase(LabelTestSetUp):
+    """Tests merging duplicate addresses (same normalized address) into one label per household"""
+
+    def setUp(self):
+        """Adds a spouse whose own address row is the same address as the first customer's, typed differently"""
+        super().setUp()
+        spouse = Customer.objects.create(first_name="Spouse", last_name="Last0", customer_type="person")
+        self.duplicate = Address.objects.create(street="0 main street", city="CANTON", state="OH", zip_code="44718")
+        spouse.addresses.add(self.duplicate)
+        self.mailing_list.addresses.add(self.duplicate)
+
+    def test_dedupe_label_rows(self):
+        """Tests that only the first address of a household is labelled when deduping, in the same single query"""
+        self.assertEqual(len(list(mailing_list_label_rows(self.mailing_list))), 36)
+
+        with self.assertNumQueries(1):
+            rows = list(mailing_list_label_rows(self.mailing_list, dedupe=True))
+        self.assertEqual(len(rows), 35)
+        self.assertEqual(rows[0], ("First0 Last0", "0 Main St", "Canton", "OH", "44718"), "The first address entered should be kept.")
+
+    def test_dedupe_counts(self):
+        """Tests the label & household counts shown before printing"""
+        with self.assertNumQueries(1):
+            self.assertEqual(mailing_list_dedupe_counts(self.mailing_list), (36, 35))
+
+        response = self.client.get(reverse('print_labels_page', args=[self.mailing_list.id]))
+        self.assertEqual(response.context['duplicate_count'], 1)
+        self.assertContains(response, "1 duplicate address")
+
+    def test_dedupe_part_of_cache_key(self):
+        """Tests that deduped labels are cached separately"""
+        mailing_list = CustomerMailingList.objects.get(pk=self.mailing_list.pk)
+        path, stats = cached_labels_pdf(mailing_list)
+        deduped_path, deduped_stats = cached_labels_pdf(mailing_list, dedupe=True)
+
+        self.assertNotEqual(path, deduped_path)
+        self.assertEqual((stats.labels, deduped_stats.labels), (36, 35))
+
+    def test_create_mailing_list_dedupes_addresses(self):
+        """Tests that a new mailing list only gets one address per household when asked to"""
+        addresses = f"{Address.objects.get(street='0 Main St').id},{self.duplicate.id}"
+
+        self.client.post(reverse('create-customer-mailing-list'), {'name': 'Merged', 'selected_addresses': addresses, 'dedupe_addresses': 'on'})
+        self.assertEqual(CustomerMailingList.objects.get(name='Merged').addresses.count(), 1)
+
+        self.client.post(reverse('create-customer-mailing-list'), {'name': 'Not Merged', 'selected_addresses': addresses})
+        self.assertEqual(CustomerMailingList.objects.get(name='Not Merged').addresses.count(), 2)
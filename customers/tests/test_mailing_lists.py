@@ -0,0 +1,446 @@
+from django.template.loader import render_to_string
+from django.test import TestCase
+from django.urls import reverse
+
+from app_users.models import CustomUser
+from customers.models import Customer, Address, CustomerInterest, CustomerMailingList
+
+
+class MailingListTestSetUp(TestCase):
+    """Shared mailing list test data - holds no tests itself"""
+    def setUp(self):
+        """
+            Sets up a logged in user & a mailing list of 60 customers, each with their own mailing address.
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        self.interest = CustomerInterest.objects.create(name="Tree Sale", slug="tree-sale")
+        self.mailing_list = CustomerMailingList.objects.create(name="Tree Sale")
+        self.mailing_list.interests.add(self.interest)
+        self.addresses = []
+        for i in range(60):
+            customer = Customer.objects.create(first_name=f"First{i}", last_name=f"Last{i}", customer_type="person")
+            address = Address.objects.create(street=f"{i} Main St", city="Canton", state="OH", zip_code="44718")
+            customer.addresses.add(address)
+            self.mailing_list.customers.add(customer)
+            self.mailing_list.addresses.add(address)
+            self.addresses.append(address)
+
+
+class MailingListDetailsTestCase(MailingListTestSetUp):
+    """Tests the paginated mailing list details page"""
+
+    def details_queries(self, **params):
+        """Returns the number of queries run to render the details page"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('view-mailing-list-details', args=[self.mailing_list.pk]), params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_counts_come_with_the_list(self):
+        """Tests that the customer & address totals are annotated on the mailing list"""
+        mailing_list = CustomerMailingList.objects.with_counts().get(pk=self.mailing_list.pk)
+        self.assertEqual((mailing_list.customer_total, mailing_list.address_total), (60, 60))
+        self.assertEqual(CustomerMailingList.objects.with_counts().get(pk=CustomerMailingList.objects.create(name="Empty").pk).customer_total, 0)
+
+    def test_first_page_and_cursor(self):
+        """Tests that the first page holds 50 addresses & the cursor link loads the rest"""
+        url = reverse('view-mailing-list-details', args=[self.mailing_list.pk])
+        response = self.client.get(url)
+
+        self.assertEqual(len(response.context['addresses']), 50)
+        self.assertEqual(response.context['next_cursor'], self.addresses[49].id)
+        self.assertContains(response, "Total customers: 60")
+        self.assertContains(response, f"?after={self.addresses[49].id}&n=51")
+
+        # HTMX: only the rows of the next page, numbered on from the first page
+        response = self.client.get(url, {'after': self.addresses[49].id, 'n': 51}, HTTP_HX_REQUEST='true')
+        self.assertTemplateUsed(response, 'customers/partials/mailing_list_address_rows.html')
+        self.assertTemplateNotUsed(response, 'customers/mailing_list_details.html')
+        self.assertEqual([address.id for address in response.context['addresses']], [address.id for address in self.addresses[50:]])
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertContains(response, "51. ")
+
+    def test_constant_queries(self):
+        """Tests that the page runs the same number of queries however big the list is"""
+        queries = self.details_queries()
+
+        # a list with 3 times as many customers on more than one address each
+        for i in range(120):
+            customer = Customer.objects.create(first_name=f"More{i}", last_name="Customer", customer_type="person")
+            address = Address.objects.create(street=f"{i} Oak Ave", city="Canton", state="OH", zip_code="44718")
+            customer.addresses.add(address, self.addresses[0])
+            self.mailing_list.addresses.add(address)
+
+        self.assertEqual(self.details_queries(), queries)
+        self.assertEqual(self.details_queries(after=self.addresses[10].id), queries)
+
+    def test_customers_without_address_prefetched(self):
+        """Tests that the customers without an address are listed from the prefetched addresses, not a query per customer"""
+        customer = Customer.objects.create(first_name="No", last_name="Address", customer_type="person")
+        self.mailing_list.customers.add(customer)
+        mailing_list = CustomerMailingList.objects.prefetch_related('customers__addresses').get(pk=self.mailing_list.pk)
+        with self.assertNumQueries(0):
+            html = render_to_string('customers/partials/mailing_list_details.html', {'mailing_list': mailing_list})
+        with_address = Customer.objects.get(first_name="First0")
+        self.assertIn(f'id="mailing-list-customer-{customer.pk}"', html)
+        self.assertNotIn(f'id="mailing-list-customer-{with_address.pk}"', html, "A customer with an address should not be listed.")
+
+    def test_edit_mode_delete_swaps_only_the_row(self):
+        """Tests that removing a customer in edit mode returns an empty swap for that row only"""
+        customer = Customer.objects.get(first_name="First0")
+        response = self.client.post(
+            reverse('delete-customer-mailing-list', args=[self.mailing_list.pk, customer.pk]),
+            {'customer_id': customer.pk, 'edit_mode': 'true'},
+            HTTP_HX_REQUEST='true',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        self.assertFalse(self.mailing_list.customers.filter(pk=customer.pk).exists())
+        self.assertEqual(self.mailing_list.customers.count(), 59)
+
+
+class MailingListIndexTestCase(MailingListTestSetUp):
+    """Tests the annotated, paginated mailing list index"""
+
+    def index_queries(self, **params):
+        """Returns the response & the number of queries run to render the index"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('list-mailing-lists'), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_summary_annotations(self):
+        """Tests that the counts & interest names are annotated on each list"""
+        # the customer leaves the list (signals) but their address stays on it, no longer mailable
+        self.addresses[0].mailing_address = False
+        self.addresses[0].save()
+        # added on the m2m table so the interest signal doesn't rebuild the list's members
+        CustomerMailingList.interests.through.objects.create(
+            customermailinglist=self.mailing_list,
+            customerinterest=CustomerInterest.objects.create(name="Fish Sale", slug="fish-sale"),
+        )
+
+        mailing_list = CustomerMailingList.objects.with_summary().get(pk=self.mailing_list.pk)
+        self.assertEqual((mailing_list.customer_total, mailing_list.address_total, mailing_list.mailable_total), (59, 60, 59))
+        self.assertEqual(sorted(mailing_list.interest_names.split(", ")), ["Fish Sale", "Tree Sale"])
+
+        empty = CustomerMailingList.objects.with_summary().get(pk=CustomerMailingList.objects.create(name="Empty").pk)
+        self.assertEqual((empty.mailable_total, empty.interest_names), (0, ""), "Lists without addresses or interests should get 0 & ''.")
+
+    def test_sorting_and_pages(self):
+        """Tests that the index can be sorted by size & date & is split into pages"""
+        for i in range(25):
+            CustomerMailingList.objects.create(name=f"Small List {i}")
+
+        response, _ = self.index_queries(sort="largest")
+        self.assertEqual(response.context['mailing_lists'][0], self.mailing_list, "The biggest list should come first.")
+        self.assertEqual(len(response.context['mailing_lists']), 20)
+        self.assertContains(response, "Page 1 of 2")
+
+        response, _ = self.index_queries(sort="oldest", page=2)
+        self.assertEqual(len(response.context['mailing_lists']), 6)
+        self.assertEqual(response.context['mailing_lists'][5].name, "Small List 24")
+
+        response, _ = self.index_queries(sort="newest", page="last")
+        self.assertEqual(response.context['mailing_lists'].number, 1, "Unparseable pages should fall back to the first page.")
+        self.assertEqual(response.context['mailing_lists'][0].name, "Small List 24")
+
+    def test_constant_queries(self):
+        """Tests that the index runs the same number of queries however many lists there are"""
+        _, queries = self.index_queries()
+
+        for i in range(15):
+            mailing_list = CustomerMailingList.objects.create(name=f"Another List {i}")
+            mailing_list.addresses.add(*self.addresses[:i])
+            mailing_list.interests.add(self.interest)
+
+        response, more_queries = self.index_queries(sort="largest")
+        self.assertEqual(more_queries, queries)
+        self.assertContains(response, "Tree Sale")
+
+
+class MailingListBulkAddressTestCase(MailingListTestSetUp):
+    """Tests the bulk add / remove address endpoints of the mailing list builder & edit page"""
+
+    def test_bulk_add_renders_every_row(self):
+        """Tests that many address / customer pairs are checked in one query & rendered in one partial"""
+        customers = [address.customer_addresses.get() for address in self.addresses[:30]]
+
+        with self.assertNumQueries(3):  # session + user + the address / customer links
+            response = self.client.post(reverse('add-selected-addresses'), {
+                'address_id': ",".join(str(address.id) for address in self.addresses[:30]),
+                'customer_id': [customer.id for customer in customers],
+            })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'customers/partials/selected_addresses.html')
+        self.assertEqual(response.content.decode().count("<li class"), 30)
+        self.assertContains(response, "First29 Last29")
+
+    def test_bulk_add_rejects_bad_pairs(self):
+        """Tests that mismatched, unknown or unlinked pairs are refused"""
+        url = reverse('add-selected-addresses')
+        first, second = self.addresses[0], self.addresses[1]
+
+        self.assertEqual(self.client.post(url, {'address_id': [first.id, second.id], 'customer_id': [first.customer_addresses.get().id]}).status_code, 400)
+        self.assertEqual(self.client.post(url, {'address_id': "1,x", 'customer_id': "1,2"}).status_code, 400)
+        response = self.client.post(url, {'address_id': [first.id], 'customer_id': [second.customer_addresses.get().id]})
+        self.assertEqual(response.status_code, 404, "An address can only be added with its own customer.")
+
+    def test_bulk_remove_selected(self):
+        """Tests that the selected addresses of a list being built are checked in one query"""
+        url = reverse('remove-selected-addresses')
+        ids = ",".join(str(address.id) for address in self.addresses[:10])
+
+        self.assertEqual(self.client.post(url, {'address_id': ids}).status_code, 204)
+        self.assertEqual(self.client.post(url, {'address_id': f"{ids},999999"}).status_code, 404)
+        self.assertEqual(self.mailing_list.addresses.count(), 60, "Nothing is saved while the list is being built.")
+
+    def test_remove_addresses_from_mailing_list(self):
+        """Tests that addresses & the customers left without one are removed set-wise"""
+        # the first customer also has a second address on the list - they stay on it
+        shared = self.addresses[0].customer_addresses.get()
+        shared.addresses.add(self.addresses[1])
+
+        url = reverse('remove-mailing-list-addresses', args=[self.mailing_list.pk])
+        removed = [address.id for address in self.addresses[:5]] + [self.addresses[1].id]
+        response = self.client.post(url, {'address_id': [str(address_id) for address_id in removed[:1]] + [",".join(str(address_id) for address_id in removed[1:])]}, HTTP_HX_REQUEST='true')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['removed_addresses'], removed[:5])
+        self.assertEqual(self.mailing_list.addresses.count(), 55)
+        self.assertEqual(self.mailing_list.customers.count(), 55)
+        self.assertFalse(self.mailing_list.customers.filter(pk=shared.pk).exists())
+
+        # addresses no longer on the list can't be removed again
+        self.assertEqual(self.client.post(url, {'address_id': removed[:1]}).status_code, 404)
+
+    def test_remove_keeps_customers_with_another_address(self):
+        """Tests that a customer with an address left on the list stays on it"""
+        customer = self.addresses[0].customer_addresses.get()
+        customer.addresses.add(self.addresses[1])
+
+        removed_customers = self.mailing_list.remove_addresses([self.addresses[0].id])
+
+        self.assertEqual(removed_customers, [])
+        self.assertTrue(self.mailing_list.customers.filter(pk=customer.pk).exists())
+        self.assertEqual(self.mailing_list.addresses.count(), 59)
+
+    def test_remove_redirects_without_htmx(self):
+        """Tests that a plain form post goes back to the details page with a message"""
+        response = self.client.post(reverse('remove-mailing-list-addresses', args=[self.mailing_list.pk]), {'address_id': self.addresses[0].id})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("status=success", response.url)
+
+
+class MailingListCombineTestCase(MailingListTestSetUp):
+    """Tests creating mailing lists from the union, intersection or difference of lists & interests"""
+
+    def setUp(self):
+        """
+            Adds a Fish Sale list holding the last 20 customers of the Tree Sale list & 10 customers of its own,
+            & a Pond interest shared by the first 10 customers.
+        """
+        super().setUp()
+        self.fish_sale = CustomerMailingList.objects.create(name="Fish Sale")
+        for address in self.addresses[40:]:
+            self.fish_sale.addresses.add(address)
+            self.fish_sale.customers.add(*address.customer_addresses.all())
+        for i in range(10):
+            customer = Customer.objects.create(first_name=f"Fish{i}", last_name="Buyer", customer_type="person")
+            address = Address.objects.create(street=f"{i} Lake Rd", city="Canton", state="OH", zip_code="44718")
+            customer.addresses.add(address)
+            self.fish_sale.customers.add(customer)
+            self.fish_sale.addresses.add(address)
+
+        self.pond = CustomerInterest.objects.create(name="Pond", slug="pond")
+        for address in self.addresses[:10]:
+            address.customer_addresses.get().interests.add(self.pond)
+
+    def test_operations(self):
+        """Tests the members of a union, intersection & difference of two lists"""
+        from customers.mailing_lists import combine_mailing_lists
+
+        union = combine_mailing_lists("Everyone", "union", [self.mailing_list, self.fish_sale])
+        intersection = combine_mailing_lists("Both Sales", "intersection", [self.mailing_list, self.fish_sale])
+        difference = combine_mailing_lists("Trees Not Fish", "difference", [self.mailing_list, self.fish_sale])
+
+        self.assertEqual((union.addresses.count(), union.customers.count()), (70, 70))
+        self.assertEqual(set(intersection.addresses.all()), set(self.addresses[40:]))
+        self.assertEqual(set(difference.addresses.all()), set(self.addresses[:40]))
+        self.assertEqual(difference.customers.count(), 40)
+        self.assertFalse(difference.interests.exists(), "Combined lists are snapshots without interests.")
+
+    def test_interest_operands(self):
+        """Tests that interests combine with lists through their active customers' mailing addresses"""
+        from customers.mailing_lists import combine_mailing_lists
+
+        inactive = self.addresses[0].customer_addresses.get()
+        inactive.is_inactive = True
+        inactive.save()
+
+        pond_only = combine_mailing_lists("Pond Only", "union", [self.pond])
+        self.assertEqual(set(pond_only.addresses.all()), set(self.addresses[1:10]))
+
+        no_pond = combine_mailing_lists("No Pond", "difference", [self.mailing_list, self.pond])
+        self.assertEqual(no_pond.addresses.count(), 51, "The inactive customer's address isn't part of the interest.")
+        self.assertEqual(no_pond.customers.count(), 51)
+
+    def test_constant_queries(self):
+        """Tests that combining runs the same number of queries however many members the lists have"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from customers.mailing_lists import combine_mailing_lists
+
+        small = CustomerMailingList.objects.create(name="Small")
+        small.addresses.add(self.addresses[0])
+
+        with CaptureQueriesContext(connection) as small_queries:
+            combine_mailing_lists("Small Union", "union", [small, self.pond])
+        with CaptureQueriesContext(connection) as large_queries:
+            combine_mailing_lists("Large Union", "union", [self.mailing_list, self.pond])
+        self.assertEqual(len(large_queries), len(small_queries))
+
+    def test_combine_view(self):
+        """Tests that the combine page creates the list & refuses combining a list with itself"""
+        url = reverse('combine-mailing-lists')
+        self.assertContains(self.client.get(url), "Fish Sale")
+
+        response = self.client.post(url, {
+            'name': 'Trees Not Fish', 'operation': 'difference',
+            'base': f'list-{self.mailing_list.pk}', 'others': [f'list-{self.fish_sale.pk}', f'interest-{self.pond.pk}'],
+        })
+        mailing_list = CustomerMailingList.objects.get(name='Trees Not Fish')
+        self.assertRedirects(response, reverse('view-mailing-list-details', args=[mailing_list.pk]))
+        self.assertEqual(mailing_list.addresses.count(), 30)
+
+        response = self.client.post(url, {
+            'name': 'Itself', 'operation': 'union', 'base': f'list-{self.fish_sale.pk}', 'others': [f'list-{self.fish_sale.pk}'],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(CustomerMailingList.objects.filter(name='Itself').exists())
+
+
+class DynamicMailingListTestCase(MailingListTestSetUp):
+    """Tests rule based mailing lists that are only refreshed when they are used"""
+
+    def setUp(self):
+        """Adds a farm in Akron, PA & a dynamic list of the Ohio customers (not refreshed yet)"""
+        super().setUp()
+        self.farm = Customer.objects.create(first_name="Green Acres", customer_type="farm")
+        self.farm_address = Address.objects.create(street="1 Farm Rd", city="Akron", state="PA", zip_code="15001")
+        self.farm.addresses.add(self.farm_address)
+        self.dynamic = CustomerMailingList.objects.create(name="Ohio", is_dynamic=True, rule={"states": ["oh"], "zip_prefixes": ["447"]})
+
+    def test_rule_filters(self):
+        """Tests that the snapshot holds the customers & addresses matching every filter of the rule"""
+        from customers.mailing_lists import refresh_dynamic_list
+
+        self.assertTrue(refresh_dynamic_list(self.dynamic))
+        self.assertEqual((self.dynamic.addresses.count(), self.dynamic.customers.count()), (60, 60))
+        self.assertIsNotNone(self.dynamic.refreshed_at)
+
+        self.dynamic.rule = {"customer_types": ["farm"]}
+        refresh_dynamic_list(self.dynamic)
+        self.assertEqual(list(self.dynamic.addresses.all()), [self.farm_address])
+        self.assertEqual(list(self.dynamic.customers.all()), [self.farm])
+
+        self.dynamic.rule = {"interests": ["tree-sale"], "created_after": "2000-01-01"}
+        self.addresses[0].customer_addresses.get().interests.add(self.interest)
+        refresh_dynamic_list(self.dynamic)
+        self.assertEqual(list(self.dynamic.addresses.all()), [self.addresses[0]])
+
+    def test_version_only_bumped_on_change(self):
+        """Tests that refreshing an unchanged list keeps its version (& its cached label pdfs)"""
+        from customers.mailing_lists import refresh_dynamic_list
+
+        refresh_dynamic_list(self.dynamic)
+        version = self.dynamic.membership_version
+
+        self.assertFalse(refresh_dynamic_list(self.dynamic))
+        self.assertEqual(self.dynamic.membership_version, version)
+
+        # (editing a member address bumps the version too)
+        self.addresses[0].zip_code = "44099"
+        self.addresses[0].save()
+        self.dynamic.refresh_from_db()
+        version = self.dynamic.membership_version
+        self.assertTrue(refresh_dynamic_list(self.dynamic))
+        self.assertEqual(self.dynamic.membership_version, version + 1)
+        self.assertEqual(self.dynamic.addresses.count(), 59)
+
+    def test_signals_skip_dynamic_lists(self):
+        """Tests that interest & address changes leave the snapshot alone until the list is used"""
+        from customers.mailing_lists import refresh_dynamic_list
+
+        self.dynamic.rule = {"interests": ["tree-sale"]}
+        self.dynamic.save()
+        self.dynamic.interests.add(self.interest)
+
+        customer = self.addresses[0].customer_addresses.get()
+        customer.interests.add(self.interest)
+        self.assertFalse(self.dynamic.customers.exists(), "Interest changes shouldn't write to dynamic lists.")
+
+        refresh_dynamic_list(self.dynamic)
+        self.assertEqual(list(self.dynamic.customers.all()), [customer])
+
+        self.addresses[0].mailing_address = False
+        self.addresses[0].save()
+        self.assertTrue(self.dynamic.customers.exists(), "Address changes shouldn't write to dynamic lists.")
+
+    def test_refreshed_when_viewed_or_exported(self):
+        """Tests that the details page refreshes stale snapshots & exports always refresh"""
+        from django.test import override_settings
+
+        url = reverse('view-mailing-list-details', args=[self.dynamic.pk])
+        self.assertContains(self.client.get(url), "Total customers: 60")
+
+        # a fresh snapshot is shown as it is, unless an update is asked for
+        self.addresses[0].zip_code = "44099"
+        self.addresses[0].save()
+        self.assertContains(self.client.get(url), "Total customers: 60")
+        self.assertContains(self.client.get(url, {'refresh': 1}), "Total customers: 59")
+
+        self.addresses[1].zip_code = "44099"
+        self.addresses[1].save()
+        with override_settings(DYNAMIC_MAILING_LIST_MAX_AGE=0):
+            self.assertContains(self.client.get(url), "Total customers: 58")
+
+        self.addresses[2].zip_code = "44099"
+        self.addresses[2].save()
+        response = self.client.get(reverse('export-mailing-list', args=[self.dynamic.pk]), {'format': 'csv'})
+        self.assertEqual(len(b"".join(response.streaming_content).decode().splitlines()), 58)
+
+    def test_create_and_edit_view(self):
+        """Tests that the rule is saved from the form & the list is materialized straight away"""
+        response = self.client.post(reverse('create-dynamic-mailing-list'), {
+            'name': 'Pennsylvania Farms', 'customer_types': ['farm'], 'states': 'pa, OH', 'zip_prefixes': '150',
+        })
+        mailing_list = CustomerMailingList.objects.get(name='Pennsylvania Farms')
+        self.assertRedirects(response, reverse('view-mailing-list-details', args=[mailing_list.pk]))
+        self.assertTrue(mailing_list.is_dynamic)
+        self.assertEqual(mailing_list.rule['states'], ['PA', 'OH'])
+        self.assertEqual(list(mailing_list.customers.all()), [self.farm])
+
+        # the normal edit page sends dynamic lists to their rule
+        self.assertRedirects(self.client.get(reverse('edit-mailing-list', args=[mailing_list.pk])), reverse('edit-dynamic-mailing-list', args=[mailing_list.pk]))
+        response = self.client.post(reverse('edit-dynamic-mailing-list', args=[mailing_list.pk]), {'name': 'Pennsylvania Farms', 'states': 'Ohio'})
+        self.assertEqual(response.status_code, 200, "Full state names should be refused.")
+
+    def test_addresses_cant_be_removed_by_hand(self):
+        """Tests that bulk removal refuses dynamic lists (their members come from the rule)"""
+        from customers.mailing_lists import refresh_dynamic_list
+
+        refresh_dynamic_list(self.dynamic)
+        response = self.client.post(reverse('remove-mailing-list-addresses', args=[self.dynamic.pk]), {'address_id': self.addresses[0].id})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.dynamic.addresses.count(), 60)
@@ -0,0 +1,134 @@
+from django.test import TestCase
+from django.db import connection
+from django.db.models.signals import m2m_changed
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from app_users.models import CustomUser
+from customers.models import (
+    Customer, Address, Email, Phone, ContactMethod, CustomerDocument, CustomerInterest, CustomerMailingList, CustomerNote,
+    CustomerRelationship,
+)
+from customers.merges import MergeError, merge_customers
+from customers.signals import update_customers_and_addresses, update_customer_mailing_lists
+
+
+class CustomerMergeTestCase(TestCase):
+    """Tests merging a duplicate customer into another: everything moves in bulk, copies of contacts are left out"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user, the kept customer (Jane Doe: an address, phone, the Tree Sale interest & list) &
+            a duplicate of hers (the same address & phone typed differently, another address, an email, the Fish Sale
+            interest, a contact method, notes, a document, relationships & a hand picked mailing list).
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        # the signal tests disconnect the mailing list signals when they are done - make sure they are connected
+        m2m_changed.connect(update_customers_and_addresses, sender=CustomerMailingList.interests.through)
+        m2m_changed.connect(update_customer_mailing_lists, sender=Customer.interests.through)
+
+        self.tree_sale = CustomerInterest.objects.create(name="Tree Sale", slug="tree-sale")
+        self.fish_sale = CustomerInterest.objects.create(name="Fish Sale", slug="fish-sale")
+        self.tree_list = CustomerMailingList.objects.create(name="Tree Sale")
+        self.tree_list.interests.add(self.tree_sale)
+        self.fish_list = CustomerMailingList.objects.create(name="Fish Sale")
+        self.fish_list.interests.add(self.fish_sale)
+
+        self.kept = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person")
+        self.address = Address.objects.create(street="123 North Main Street", city="Canton", state="OH", zip_code="44718")
+        self.kept.addresses.add(self.address)
+        self.kept.phones.add(Phone.objects.create(phone_number="3306742811", phone_type="cell"))
+        self.kept.interests.add(self.tree_sale)
+
+        self.duplicate = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person")
+        self.address_copy = Address.objects.create(street="123 N Main St", city="Canton", state="OH", zip_code="44718")
+        self.other_address = Address.objects.create(street="9 Elm Street", city="Akron", state="OH", zip_code="44308")
+        self.duplicate.addresses.add(self.address_copy, self.other_address)
+        self.duplicate.phones.add(Phone.objects.create(phone_number="330-674-2811", phone_type="home"))
+        self.duplicate.emails.add(Email.objects.create(email_address="jane@test.com"))
+        self.duplicate.interests.add(self.tree_sale, self.fish_sale)
+        self.duplicate.preferred_contact_methods.add(ContactMethod.objects.create(method_name="Email"))
+        CustomerNote.objects.create(customer=self.duplicate, note="Called about the tree sale")
+        CustomerDocument.objects.create(customer=self.duplicate, file="customer_documents/w9.pdf", file_type="w9")
+
+        self.hand_picked = CustomerMailingList.objects.create(name="Hand Picked")
+        self.hand_picked.customers.add(self.duplicate)
+        self.hand_picked.addresses.add(self.address_copy)
+
+        self.other = Customer.objects.create(first_name="John", last_name="Doe", customer_type="person")
+        CustomerRelationship.objects.create(from_customer=self.duplicate, to_customer=self.other, relationship_type="spouse")
+        CustomerRelationship.objects.create(from_customer=self.kept, to_customer=self.other, relationship_type="spouse")
+        CustomerRelationship.objects.create(from_customer=self.duplicate, to_customer=self.kept, relationship_type="spouse")
+
+    def test_merge_moves_everything(self):
+        """Tests that the duplicate's rows move to the kept customer without copies & the duplicate is deleted"""
+        result = merge_customers(self.kept, self.duplicate, user=self.user)
+
+        self.assertFalse(Customer.objects.filter(pk=self.duplicate.pk).exists())
+        self.assertEqual(set(self.kept.addresses.all()), {self.address, self.other_address})
+        self.assertFalse(Address.objects.filter(pk=self.address_copy.pk).exists(), "An unused copy of an address should be deleted.")
+        self.assertEqual(self.kept.phones.count(), 1, "The same phone number should not be added twice.")
+        self.assertEqual(self.kept.emails.get().email_address, "jane@test.com")
+        self.assertEqual(set(self.kept.interests.all()), {self.tree_sale, self.fish_sale})
+        self.assertEqual(self.kept.preferred_contact_methods.count(), 1)
+        self.assertEqual(self.kept.documents.count(), 1)
+        self.assertEqual(self.kept.notes.count(), 2, "The duplicate's note & a note recording the merge.")
+        self.assertIn(f"Merged customer #{self.duplicate.pk}", self.kept.notes.first().note)
+
+        # a relationship with itself is dropped, the repeated one is only kept once
+        relationships = CustomerRelationship.objects.values_list('from_customer', 'to_customer')
+        self.assertEqual(list(relationships), [(self.kept.pk, self.other.pk)])
+
+        # the hand picked list keeps the customer & the kept copy of the address, the fish sale list adds them
+        self.assertEqual(list(self.hand_picked.customers.all()), [self.kept])
+        self.assertEqual(list(self.hand_picked.addresses.all()), [self.address])
+        self.assertIn(self.kept, self.fish_list.customers.all())
+        self.assertEqual(set(self.fish_list.addresses.all()), {self.address, self.other_address})
+
+        self.assertEqual((result.addresses, result.phones, result.emails, result.interests), (1, 0, 1, 1))
+        self.assertEqual((result.notes, result.documents, result.mailing_lists), (1, 1, 2))
+
+    def test_shared_copy_not_deleted(self):
+        """Tests that a copy of an address another customer lives at is only unlinked from the duplicate"""
+        self.other.addresses.add(self.address_copy)
+        merge_customers(self.kept, self.duplicate)
+        self.assertTrue(Address.objects.filter(pk=self.address_copy.pk).exists())
+        self.assertEqual(set(self.kept.addresses.all()), {self.address, self.other_address})
+
+    def test_merge_with_itself(self):
+        """Tests that a customer can't be merged with itself"""
+        with self.assertRaises(MergeError):
+            merge_customers(self.kept, self.kept)
+
+    def test_queries_do_not_grow_with_rows(self):
+        """Tests that the number of queries does not depend on the number of notes, documents & mailing lists"""
+        def count_queries(rows):
+            duplicate = Customer.objects.create(first_name="Jayne", last_name="Doe", customer_type="person")
+            duplicate.addresses.add(Address.objects.create(street=f"{rows} Oak Street", city="Canton", state="OH", zip_code="44718"))
+            CustomerNote.objects.bulk_create([CustomerNote(customer=duplicate, note=f"Note {i}") for i in range(rows)])
+            for i in range(rows):
+                CustomerMailingList.objects.create(name=f"List {rows}-{i}").customers.add(duplicate)
+
+            with CaptureQueriesContext(connection) as context:
+                merge_customers(self.kept, duplicate)
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(1), count_queries(20))
+
+    def test_merge_view(self):
+        """Tests that the merge is only done once the user has confirmed it"""
+        response = self.client.get(reverse('merge-customer', args=[self.kept.id]), {'duplicate': self.duplicate.id})
+        self.assertContains(response, f'value="{self.duplicate.id}"')
+
+        response = self.client.post(reverse('merge-customer', args=[self.kept.id]), {'duplicate': self.duplicate.id})
+        self.assertContains(response, "Confirm Merge")
+        self.assertTrue(Customer.objects.filter(pk=self.duplicate.pk).exists(), "Nothing should be merged before the confirmation.")
+
+        response = self.client.post(reverse('merge-customer', args=[self.kept.id]), {'duplicate': self.duplicate.id, 'confirm': '1'})
+        self.assertRedirects(response, reverse('view_customer_profile', args=[self.kept.id]), fetch_redirect_response=False)
+        self.assertFalse(Customer.objects.filter(pk=self.duplicate.pk).exists())
+
+        response = self.client.post(reverse('merge-customer', args=[self.kept.id]), {'duplicate': self.kept.id})
+        self.assertContains(response, "can&#x27;t be merged with itself")
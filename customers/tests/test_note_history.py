@@ -0,0 +1,153 @@
+from importlib import import_module
+from unittest import mock
+
+from django.apps import apps
+from django.db import DatabaseError
+from django.test import TestCase
+from django.urls import reverse
+
+from app_users.models import CustomUser
+from customers.deltas import SNAPSHOT_INTERVAL, apply_delta, encode_delta
+from customers.forms import CreateNoteForm
+from customers.models import Customer, CustomerNote, CustomerNoteHistory
+from customers.note_history import note_version, note_versions
+
+compaction = import_module('customers.migrations.0046_compact_note_history')
+checksums = import_module('customers.migrations.0047_note_history_checksums')
+
+LONG_NOTE = " ".join(f"Called about the spring tree sale, order {i} of white pines and blue spruce." for i in range(200))
+
+
+class DeltaTestCase(TestCase):
+    """Tests the reverse diffs the note history is stored as"""
+
+    def test_round_trip(self):
+        """Tests that a diff rebuilds the older text exactly - whitespace, unicode & empty texts included"""
+        cases = [
+            ("Soil test results came back", "Soil test results came back fine"),
+            ("line one\n\nline  two\t", "line one\nline two"),
+            ("", "Called Señora Pérez – no answer"),
+            ("Called Señora Pérez – no answer", ""),
+            (LONG_NOTE, LONG_NOTE.replace("order 150", "order 151")),
+        ]
+        for newer, older in cases:
+            self.assertEqual(apply_delta(newer, encode_delta(newer, older)), older, f"{older[:30]!r} should be rebuilt from {newer[:30]!r}")
+
+    def test_small_edit_is_small(self):
+        """Tests that a small edit of a long note is stored in a few bytes, not the whole text"""
+        delta = encode_delta(LONG_NOTE.replace("order 150", "order 151"), LONG_NOTE)
+        self.assertLess(len(delta), 100, "A one word edit should be stored as a short diff.")
+
+
+class NoteHistoryTestCase(TestCase):
+    """Tests that note edits are stored as compressed reverse diffs & that every version is rebuilt from them"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user & a customer with a note
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+        self.customer = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person", creator=self.user)
+        self.note = CustomerNote.objects.create(customer=self.customer, author=self.user, note="Version 0 " + LONG_NOTE)
+
+    def edit(self, count):
+        """Edits the note count times through the form - returns every version of it, oldest first"""
+        versions = [self.note.note]
+        for i in range(1, count + 1):
+            form = CreateNoteForm({'note': f"Version {i} " + LONG_NOTE}, instance=CustomerNote.objects.get(pk=self.note.pk), user=self.user)
+            self.assertTrue(form.is_valid(), form.errors)
+            form.save()
+            versions.append(f"Version {i} " + LONG_NOTE)
+        self.note.refresh_from_db()
+        return versions
+
+    def test_stored_as_diffs(self):
+        """Tests that the history is diffs with a full snapshot every SNAPSHOT_INTERVAL edits"""
+        self.edit(2 * SNAPSHOT_INTERVAL + 3)
+        entries = list(self.note.note_history.order_by('id'))
+        self.assertEqual([position for position, entry in enumerate(entries) if entry.is_snapshot], [SNAPSHOT_INTERVAL - 1, 2 * SNAPSHOT_INTERVAL - 1])
+        self.assertTrue(all(entry.previous_note == "" for entry in entries), "The whole text should not be stored any more.")
+        self.assertLess(max(len(entry.delta) for entry in entries if not entry.is_snapshot), 100)
+
+    def test_rebuild_versions(self):
+        """Tests that every version is rebuilt, all at once & one at a time"""
+        versions = self.edit(2 * SNAPSHOT_INTERVAL + 3)
+        entries = note_versions(self.note)
+        self.assertEqual([entry.text for entry in entries], versions[-2::-1])
+        for entry, text in zip(entries, versions[-2::-1]):
+            self.assertEqual(note_version(CustomerNoteHistory.objects.get(pk=entry.pk)), text)
+
+    def test_rebuild_one_version_is_bounded(self):
+        """Tests that one version is rebuilt from the nearest newer snapshot, not from every later edit"""
+        self.edit(3 * SNAPSHOT_INTERVAL)
+        oldest = self.note.note_history.order_by('id').first()
+        with self.assertNumQueries(2):
+            self.assertEqual(note_version(oldest), "Version 0 " + LONG_NOTE)
+
+    def test_older_entries(self):
+        """Tests that entries stored whole (before the diffs) still rebuild the versions before them"""
+        CustomerNoteHistory.objects.create(customer_note=self.note, previous_note="The first version", edited_by=self.user)
+        versions = self.edit(2)
+        self.assertEqual([entry.text for entry in note_versions(self.note)], versions[-2::-1] + ["The first version"])
+
+    def test_deleted_note_keeps_history(self):
+        """Tests that the diffs of a deleted note are stored whole first"""
+        versions = self.edit(3)
+        entry_ids = list(self.note.note_history.order_by('id').values_list('id', flat=True))
+        self.note.delete()
+        self.assertEqual([note_version(CustomerNoteHistory.objects.get(pk=pk)) for pk in entry_ids], versions[:-1])
+
+    def test_recorded_on_save(self):
+        """Tests that an edit saved without the form (the admin...) is recorded too - the form records the editor"""
+        self.edit(1)
+        note = CustomerNote.objects.get(pk=self.note.pk)
+        note.note = "Edited in the admin"
+        note.save()
+        entries = note_versions(note)
+        self.assertEqual([entry.edited_by for entry in entries], [None, self.user])
+        self.assertEqual(entries[0].text, "Version 1 " + LONG_NOTE)
+
+    def test_failed_save_records_nothing(self):
+        """Tests that the history entry of an edit is rolled back with the edit when saving the note fails"""
+        note = CustomerNote.objects.get(pk=self.note.pk)
+        note.note = "Never saved"
+        with mock.patch.object(CustomerNote, 'save_base', side_effect=DatabaseError("simulated")):
+            with self.assertRaises(DatabaseError):
+                note.save()
+        self.assertFalse(CustomerNoteHistory.objects.exists(), "A failed edit should leave no history behind.")
+
+    def test_broken_chain_detected(self):
+        """Tests that versions behind a change that was not recorded are not rebuilt wrong: they are None"""
+        self.edit(2)
+        CustomerNote.objects.filter(pk=self.note.pk).update(note="Changed by a queryset update")
+        self.note.refresh_from_db()
+        self.assertEqual([entry.text for entry in note_versions(self.note)], [None, None])
+        for entry in self.note.note_history.all():
+            self.assertIsNone(note_version(entry))
+
+    def test_note_detail(self):
+        """Tests that the note page shows the previous versions from the history"""
+        self.edit(2)
+        response = self.client.get(reverse('note_detail', args=[self.customer.id, self.note.pk]))
+        self.assertContains(response, "Version 0 Called about")
+        self.assertContains(response, "Version 1 Called about")
+
+    def test_compaction_migration(self):
+        """Tests that the migration stores existing history as diffs & that reversing it gives the whole texts back"""
+        for text in ["The first version", "The second version"]:
+            CustomerNoteHistory.objects.create(customer_note=self.note, previous_note=text, edited_by=self.user)
+        compaction.compact_note_history(apps, None)
+        self.assertFalse(self.note.note_history.filter(previous_note__gt="").exists())
+        self.assertEqual([entry.text for entry in note_versions(self.note)], ["The second version", "The first version"])
+
+        compaction.expand_note_history(apps, None)
+        self.assertEqual(list(self.note.note_history.order_by('id').values_list('previous_note', flat=True)), ["The first version", "The second version"])
+
+    def test_checksum_migration(self):
+        """Tests that the migration stores the checksum each diff was recorded with"""
+        self.edit(3)
+        recorded = list(self.note.note_history.order_by('id').values_list('newer_checksum', flat=True))
+        self.note.note_history.update(newer_checksum="")
+        checksums.backfill_newer_checksums(apps, None)
+        self.assertEqual(list(self.note.note_history.order_by('id').values_list('newer_checksum', flat=True)), recorded)
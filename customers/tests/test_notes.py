@@ -0,0 +1,64 @@
+from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from app_users.models import CustomUser
+from customers.models import Customer, CustomerNote
+
+
+class NoteNumberTestCase(TestCase):
+    """Tests that notes are numbered by a ROW_NUMBER() window in the query listing them, not by a count per note"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user & two customers with notes
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+        self.customer = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person", creator=self.user)
+        self.other = Customer.objects.create(first_name="John", last_name="Smith", customer_type="person", creator=self.user)
+
+    def add_notes(self, customer, count, text="Called about the tree sale"):
+        CustomerNote.objects.bulk_create([CustomerNote(customer=customer, author=self.user, note=f"{text} {i}") for i in range(count)])
+        return list(customer.notes.order_by('id'))
+
+    def test_with_note_numbers(self):
+        """Tests that the annotation numbers each customer's notes from 1, oldest first, like note_number did"""
+        notes = self.add_notes(self.customer, 3)
+        self.add_notes(self.other, 2)
+        notes[1].delete()
+
+        numbered = {note.pk: note.note_number for note in CustomerNote.objects.with_note_numbers()}
+        self.assertEqual(numbered[notes[0].pk], 1)
+        self.assertEqual(numbered[notes[2].pk], 2, "A deleted note should not count.")
+        self.assertEqual(sorted(note.note_number for note in self.other.notes.with_note_numbers()), [1, 2])
+
+        # a note loaded on its own is counted
+        self.assertEqual(CustomerNote.objects.get(pk=notes[2].pk).note_number, 2)
+
+    def test_numbered_filter(self):
+        """Tests that the notes left out by numbered_filter are still counted"""
+        self.add_notes(self.customer, 4)
+        self.add_notes(self.customer, 1, text="Soil test results")
+        found = CustomerNote.objects.numbered_filter(note__icontains="soil")
+        self.assertEqual([note.note_number for note in found], [5])
+        self.assertEqual(found.count(), 1)
+
+    def test_listing_notes_is_one_query(self):
+        """Tests that listing a customer's notes takes the same queries for 5 or 500 notes"""
+        def count_queries(customer, notes):
+            self.add_notes(customer, notes)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(reverse('view-all-notes', args=[customer.id]))
+            self.assertContains(response, f"Note #{notes} for")
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(self.customer, 5), count_queries(self.other, 500))
+
+    def test_search_notes_numbered(self):
+        """Tests that search results are numbered among all of their customer's notes"""
+        self.add_notes(self.customer, 3)
+        self.add_notes(self.customer, 1, text="Soil test results")
+        response = self.client.get(reverse('search-notes'), {'search_note': "soil"})
+        self.assertContains(response, "Note #4 for Jane Doe")
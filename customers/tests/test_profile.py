@@ -0,0 +1,187 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from app_users.models import CustomUser
+from customers.models import Address, ContactMethod, Customer, CustomerDocument, CustomerInterest, CustomerMailingList, CustomerNote, Email, Phone
+from customers.profile import NOTES_PAGE_SIZE, ALL_NOTES_PAGE_SIZE, after_cursor, decode_cursor, encode_cursor
+
+
+class ProfilePagesTestCase(TestCase):
+    """Tests that the profile loads the first page of notes & documents, & the rest through cached "load more" pages"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user & a customer - the cache is cleared so no page of a previous test is reused
+        """
+        cache.clear()
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+        self.customer = Customer.objects.create(first_name="Jane", last_name="Doe", customer_type="person", creator=self.user)
+
+    def add_notes(self, count):
+        """Adds notes one minute apart (oldest first): 'Tree sale call 0', 'Tree sale call 1', ..."""
+        start = timezone.now() - timedelta(days=1)
+        notes = CustomerNote.objects.bulk_create([CustomerNote(customer=self.customer, author=self.user, note=f"Tree sale call {i}") for i in range(count)])
+        for i, note in enumerate(notes):
+            CustomerNote.objects.filter(pk=note.pk).update(created_at=start + timedelta(minutes=i))
+        return list(self.customer.notes.order_by('id'))
+
+    def section_url(self, section, cursor=None):
+        url = reverse('customer-profile-section', args=[self.customer.id, section])
+        return f"{url}?after={cursor}" if cursor else url
+
+    def test_cursor(self):
+        """Tests that a cursor keeps created_at to the microsecond & that a tampered one is ignored"""
+        note = self.add_notes(1)[0]
+        self.assertEqual(decode_cursor(encode_cursor(note)), (note.created_at, note.pk))
+        for cursor in ("", "abc", "1-2-3", "99999999999999999999999-1"):
+            self.assertIsNone(decode_cursor(cursor), f"{cursor!r} should not be a cursor.")
+        self.assertEqual(CustomerNote.objects.filter(after_cursor("abc")).count(), 1)
+
+    def test_first_page(self):
+        """Tests that the profile shows the newest notes & a button loading the older ones"""
+        notes = self.add_notes(NOTES_PAGE_SIZE + 2)
+        response = self.client.get(reverse('view_customer_profile', args=[self.customer.id]))
+        self.assertEqual(len(response.context['customer_notes']), NOTES_PAGE_SIZE)
+        self.assertContains(response, "Tree sale call 11")
+        self.assertNotContains(response, "Tree sale call 1...", msg_prefix="The oldest notes should be left for load more.")
+        self.assertContains(response, self.section_url('notes', encode_cursor(notes[2])))
+
+    def test_load_more(self):
+        """Tests that the next page starts after the cursor, also between notes created at the same time"""
+        notes = self.add_notes(NOTES_PAGE_SIZE + 2)
+        CustomerNote.objects.filter(pk__in=[notes[1].pk, notes[2].pk]).update(created_at=notes[2].created_at)
+
+        response = self.client.get(self.section_url('notes', encode_cursor(notes[2])))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Tree sale call 1...")
+        self.assertContains(response, "Tree sale call 0...")
+        self.assertNotContains(response, "Tree sale call 2...", msg_prefix="A note shown on the first page should not be repeated.")
+        self.assertNotContains(response, "Load more notes", msg_prefix="The last page should not have a load more button.")
+
+    def test_cache_invalidated_by_version(self):
+        """Tests that pages are cached & that a new note bumps the version, so the pages are rendered again"""
+        self.add_notes(1)
+        self.client.get(self.section_url('notes'))
+        with self.assertNumQueries(3):  # session, user & customer - the page comes from the cache
+            self.client.get(self.section_url('notes'))
+
+        version = Customer.objects.get(pk=self.customer.pk).profile_version
+        CustomerNote.objects.create(customer=self.customer, author=self.user, note="Soil test results")
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.profile_version, version + 1)
+        self.assertContains(self.client.get(self.section_url('notes')), "Soil test results")
+
+    def test_conditional_request(self):
+        """Tests that a browser revalidating a page gets a 304 until the customer's notes change"""
+        self.add_notes(1)
+        etag = self.client.get(self.section_url('notes')).headers['ETag']
+        self.assertEqual(self.client.get(self.section_url('notes'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.customer.notes.first().delete()
+        self.assertEqual(self.client.get(self.section_url('notes'), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_rename_invalidates_pages(self):
+        """Tests that renaming the customer bumps the version: cached pages showing the name are rendered again"""
+        self.add_notes(1)
+        url = self.section_url('all-notes')
+        etag = self.client.get(url).headers['ETag']
+        self.assertContains(self.client.get(url), "for Jane Doe")
+
+        customer = Customer.objects.get(pk=self.customer.pk)
+        customer.last_name = "Smith"
+        customer.save(update_fields=['last_name'])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertContains(self.client.get(url), "for Jane Smith")
+
+    def test_stale_customer_keeps_version(self):
+        """Tests that saving a customer loaded before a note changed does not write the older version back"""
+        stale = Customer.objects.get(pk=self.customer.pk)
+        CustomerNote.objects.create(customer=self.customer, author=self.user, note="Soil test results")
+        version = Customer.objects.get(pk=self.customer.pk).profile_version
+        stale.is_inactive = True
+        stale.save()
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).profile_version, version)
+
+    def test_unchanged_save_is_one_update(self):
+        """Tests that saving a customer without changing the profile is a single UPDATE that keeps the version"""
+        CustomerMailingList.objects.create(name="Tree Sale").customers.add(self.customer)
+        customer = Customer.objects.get(pk=self.customer.pk)
+        version = customer.profile_version
+        customer.is_inactive = True
+        with self.assertNumQueries(1):  # no re-read of the customer & no mailing list bump
+            customer.save()
+        self.assertEqual(customer.profile_version, version)
+
+    def test_rename_bumps_in_update(self):
+        """Tests that a rename bumps the profile version in its UPDATE & the versions of the customer's mailing lists"""
+        mailing_list = CustomerMailingList.objects.create(name="Tree Sale")
+        mailing_list.customers.add(self.customer)
+        membership_version = CustomerMailingList.objects.get(pk=mailing_list.pk).membership_version
+        customer = Customer.objects.get(pk=self.customer.pk)
+        version = customer.profile_version
+        customer.first_name = "Janet"
+        with self.assertNumQueries(2):  # the customer & its mailing lists
+            customer.save()
+        self.assertEqual(customer.profile_version, version + 1)
+        self.assertEqual(CustomerMailingList.objects.get(pk=mailing_list.pk).membership_version, membership_version + 1)
+
+        with self.assertNumQueries(1):  # saved again unchanged: no bump
+            customer.save()
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).profile_version, version + 1)
+
+    def test_all_notes_numbered_across_pages(self):
+        """Tests that the notes of later all notes pages keep their number among all of the customer's notes"""
+        notes = self.add_notes(ALL_NOTES_PAGE_SIZE + 5)
+        response = self.client.get(reverse('view-all-notes', args=[self.customer.id]))
+        self.assertContains(response, f"Note #{ALL_NOTES_PAGE_SIZE + 5} for")
+        self.assertNotContains(response, "Note #5 for")
+
+        response = self.client.get(self.section_url('all-notes', encode_cursor(notes[5])))
+        self.assertContains(response, "Note #5 for")
+        self.assertContains(response, "Note #1 for")
+
+    def test_invalid_requests(self):
+        """Tests that a tampered cursor is a bad request & an unknown section is not found"""
+        self.assertEqual(self.client.get(self.section_url('notes', "abc")).status_code, 400)
+        self.assertEqual(self.client.get(self.section_url('addresses')).status_code, 404)
+
+
+class ProfileLoaderTestCase(TestCase):
+    """Tests that the profile page is loaded in a fixed number of queries, however much the customer has"""
+
+    def setUp(self):
+        """
+            Sets up a logged in user
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+    def create_customer(self, count):
+        """A customer with count of each: addresses, phones, emails, interests, contact methods, mailing lists, notes & documents"""
+        customer = Customer.objects.create(first_name=f"Jane{count}", last_name="Doe", customer_type="person", creator=self.user)
+        for i in range(count):
+            customer.addresses.add(Address.objects.create(street=f"{i} Ridge Road", city="Albany", state="IL", zip_code="89561"))
+            customer.phones.add(Phone.objects.create(phone_number=f"555555{count:02}{i:02}", phone_type="cell"))
+            customer.emails.add(Email.objects.create(email_address=f"jane{i}@test.com"))
+            customer.interests.add(CustomerInterest.objects.create(name=f"Interest {count} {i}", slug=f"interest-{count}-{i}"))
+            customer.preferred_contact_methods.add(ContactMethod.objects.create(method_name=f"method {count} {i}"))
+            CustomerMailingList.objects.create(name=f"List {count} {i}").customers.add(customer)
+            CustomerNote.objects.create(customer=customer, author=self.user, note=f"Tree sale call {i}")
+            CustomerDocument.objects.create(customer=customer, author=self.user, file=f"customer_documents/w9-{i}.pdf", file_type="w9", upload_status='stored')
+        return customer
+
+    def test_query_budget(self):
+        """Tests the query budget of the profile: session, user, customer, 6 related lists, notes & documents"""
+        for count in (1, 15):
+            customer = self.create_customer(count)
+            with self.assertNumQueries(11):
+                response = self.client.get(reverse('view_customer_profile', args=[customer.id]))
+            self.assertContains(response, f"{count} Document{'s' if count > 1 else ''}:")
+            self.assertContains(response, f"{count} Phone Number")
+            self.assertContains(response, f"Interest {count} {count - 1}")
+            self.assertContains(response, f"List {count} 0")
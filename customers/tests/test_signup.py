@@ -0,0 +1,141 @@
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models.signals import m2m_changed
+from django.urls import reverse
+import os
+import shutil
+import tempfile
+
+from app_users.models import CustomUser
+from customers.models import Customer, Address, CustomerDocument, CustomerInterest, CustomerMailingList
+from customers.signals import update_customers_and_addresses, update_customer_mailing_lists
+from customers.signup import SIGNUP_SESSION_KEY
+
+STAGING_ROOT = tempfile.mkdtemp()
+MEDIA_ROOT = tempfile.mkdtemp()
+SPOOL_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(SIGNUP_STAGING_ROOT=STAGING_ROOT, MEDIA_ROOT=MEDIA_ROOT, DOCUMENT_SPOOL_ROOT=SPOOL_ROOT)
+class SignupWizardTestCase(TestCase):
+    """Tests the multi-step customer sign-up: steps are staged in the session & saved in one transaction at the end"""
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(STAGING_ROOT, ignore_errors=True)
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(SPOOL_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        """
+            Sets up a logged in user, a Tree Sale interest & mailing list & the posted data of every sign-up step.
+        """
+        self.user = CustomUser.objects.create_user(email="test@test.com", password="testpassword123")
+        self.client.login(email="test@test.com", password="testpassword123")
+
+        # the signal tests disconnect the mailing list signals when they are done - make sure they are connected
+        m2m_changed.connect(update_customers_and_addresses, sender=CustomerMailingList.interests.through)
+        m2m_changed.connect(update_customer_mailing_lists, sender=Customer.interests.through)
+
+        self.interest = CustomerInterest.objects.create(name="Tree Sale", slug="tree-sale")
+        self.mailing_list = CustomerMailingList.objects.create(name="Tree Sale")
+        self.mailing_list.interests.add(self.interest)
+
+        self.steps = [
+            {'first_name': 'Jane', 'last_name': 'Doe', 'customer_type': 'person', 'interests': [self.interest.id]},
+            {'street': '123 North Main Street', 'city': 'Canton', 'state': 'OH', 'zip_code': '44718', 'mailing_address': 'on'},
+            {'phone_number': '3306742811', 'phone_type': 'cell', 'can_call': 'on', 'is_primary': 'on'},
+            {'email_address': 'jane@test.com', 'email_type': 'home', 'preferred_email': 'on'},
+            {'file_type': 'w9', 'file_detail': 'Signed', 'file': SimpleUploadedFile("w9.pdf", b"%PDF-1.4 test", content_type="application/pdf")},
+            {'note': 'Met at the tree sale'},
+        ]
+
+    def post_step(self, step):
+        """Posts the data of a sign-up step (0 based)"""
+        return self.client.post(reverse('create_customer_view'), self.steps[step])
+
+    def test_nothing_written_until_last_step(self):
+        """Tests that the steps are only staged & the last one saves everything in one go"""
+        for step in range(5):
+            response = self.post_step(step)
+            self.assertRedirects(response, reverse('create_customer_view'), fetch_redirect_response=False)
+        self.assertFalse(Customer.objects.exists(), "No customer should be saved before the last step.")
+        self.assertEqual(len(os.listdir(STAGING_ROOT)), 1, "The uploaded document should wait in the staging storage.")
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.post_step(5)
+        self.assertRedirects(response, reverse('create_customer_success'), fetch_redirect_response=False)
+        self.assertEqual(len(callbacks), 1, "The document should be pushed to storage once the sign-up is saved.")
+
+        customer = Customer.objects.get()
+        self.assertEqual(customer.creator, self.user)
+        address = customer.addresses.get()
+        self.assertEqual(address.normalized_key, "123 N MAIN ST|CANTON|OH|44718", "Bulk inserts should still set the key.")
+        self.assertEqual(customer.phones.get().phone_number, "330-674-2811", "Bulk inserts should still format the number.")
+        self.assertEqual(customer.emails.get().email_address, "jane@test.com")
+        self.assertEqual(customer.notes.get().author, self.user)
+        document = customer.documents.get()
+        self.assertEqual(os.listdir(STAGING_ROOT), [], "Staged uploads should be deleted once saved.")
+        self.assertEqual(document.upload_status, 'processing')
+        spooled_name = document.spooled_name
+        self.assertIn(spooled_name, os.listdir(SPOOL_ROOT), "The upload should wait in the spool, not be stored in the request.")
+
+        # the background job pushes the spooled file to storage
+        with self.settings(BACKGROUND_TASKS_SYNCHRONOUS=True):
+            callbacks[0]()
+        document.refresh_from_db()
+        self.assertTrue(document.is_stored)
+        self.assertEqual(document.display_name, f"Jane_Doe_W-9_{document.created_at.year}.pdf", "The document should be renamed as on save().")
+        self.assertNotIn(spooled_name, os.listdir(SPOOL_ROOT))
+
+        # the interest was added after the address, so the customer joined the interest's mailing list with it
+        self.assertEqual(list(self.mailing_list.customers.all()), [customer])
+        self.assertEqual(list(self.mailing_list.addresses.all()), [address])
+
+        response = self.client.get(reverse('create_customer_success'))
+        self.assertContains(response, "Jane")
+        self.assertNotIn(SIGNUP_SESSION_KEY, self.client.session)
+
+    def test_commit_query_count(self):
+        """Tests that the last step saves the customer & the rows of every step with a fixed number of queries"""
+        for step in range(5):
+            self.post_step(step)
+
+        # 1 insert per table & the mailing list signals of the interest
+        with self.assertNumQueries(30):
+            self.post_step(5)
+
+    def test_skipped_steps(self):
+        """Tests that skipped steps are left out & a sign-up without a customer is refused"""
+        self.post_step(0)
+        for step in range(5):
+            self.client.get(reverse('skip_step'))
+        customer = Customer.objects.get()
+        self.assertFalse(customer.addresses.exists())
+
+        self.client.get(reverse('create_customer_success'))
+        for step in range(6):
+            response = self.client.get(reverse('skip_step'))
+        self.assertRedirects(response, reverse('sign_up_error'), fetch_redirect_response=False)
+        self.assertEqual(Customer.objects.count(), 1)
+
+    def test_cancel_discards_staged_steps(self):
+        """Tests that cancelling leaves nothing behind: no rows & no staged uploads"""
+        for step in range(5):
+            self.post_step(step)
+
+        response = self.client.get(reverse('cancel_signup'))
+        self.assertRedirects(response, reverse('cancel_confirmation'), fetch_redirect_response=False)
+        self.assertFalse(Customer.objects.exists())
+        self.assertFalse(Address.objects.exists())
+        self.assertFalse(CustomerDocument.objects.exists())
+        self.assertEqual(os.listdir(STAGING_ROOT), [])
+        self.assertNotIn(SIGNUP_SESSION_KEY, self.client.session)
+        self.assertNotIn('signup_step', self.client.session)
+
+    def test_invalid_step_is_not_staged(self):
+        """Tests that an invalid step is shown again & not staged"""
+        response = self.client.post(reverse('create_customer_view'), {'first_name': '', 'customer_type': 'person'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(SIGNUP_SESSION_KEY, self.client.session)
@@ -28,6 +28,9 @@ urlpatterns = [
     path('create-customer-partial/', create_customer_partial_view, name='create_customer_view_partial'),  # main sign-up page
 
     path('create-customer/success/', create_customer_success, name='create_customer_success'),  # Success page after customer is successfully signed up
+    path('import-customers/', import_customers_view, name='import-customers'),  # bulk import of a csv / excel file
+    path('import-customers/<int:import_id>/', customer_import_status, name='customer-import-status'),
+    path('import-customers/<int:import_id>/report/', download_customer_import_report, name='customer-import-report'),
     path('create-customer/error/', sign_up_error, name='sign_up_error'),  # Error page if customer cannot be signed up
     path('create-customer/skip/', create_customer_skip_step, name='skip_step'), # skip to the next page in the sign up process
     path('cancel_signup/', cancel_signup, name='cancel_signup'), # cancel signup process
@@ -44,28 +47,44 @@ urlpatterns = [
     path('search-notes', search_notes, name='search-notes'),
 
     path('<int:customer_id>/toggle-inactive/', toggle_inactive_status, name='toggle_inactive_status'),
+    path('<int:customer_id>/merge/', merge_customer_view, name='merge-customer'),  # merge a duplicate into the customer
     path('create-customer-mailing-list', create_customer_mailing_list, name='create-customer-mailing-list'),
     path('mailing-list/add-selected-address', add_selected_address_list, name='add-selected-address'),
     path('mailing-list/remove-selected-address', remove_selected_address_list, name='remove-selected-address'),
+    path('mailing-list/add-selected-addresses', add_selected_addresses_list, name='add-selected-addresses'),
+    path('mailing-list/remove-selected-addresses', remove_selected_addresses_list, name='remove-selected-addresses'),
 
     path("mailing-lists/", list_mailing_lists, name="list-mailing-lists"),
+    path("mailing-lists/combine/", combine_mailing_lists_view, name="combine-mailing-lists"),
+    path("mailing-lists/dynamic/", dynamic_mailing_list_view, name="create-dynamic-mailing-list"),
+    path("mailing-list/<int:pk>/rule", dynamic_mailing_list_view, name="edit-dynamic-mailing-list"),
     path("mailing-list/<int:pk>/", view_mailing_list_details, name="view-mailing-list-details"),
     path("mailing-list/<int:pk>/delete", mailing_list_delete_view, name="delete-mailing-list"),
     path("mailing-list/<int:mailing_id>/customer/<int:customer_id>/delete", delete_customer_from_mailing_list, name="delete-customer-mailing-list"),
     path("mailing-list/<int:pk>/edit", mailing_list_edit_view, name="edit-mailing-list"),
     path('mailing-list/<int:mailing_list_id>/print-labels/', print_labels_page, name='print_labels_page'),
     path('mailing-list/<int:mailing_list_id>/generate-labels/', generate_labels_pdf, name='generate_labels_pdf'),    
+    path('mailing-list/<int:mailing_list_id>/render-labels/', start_label_render_job, name='start_label_render_job'),
+    path('label-jobs/<int:job_id>/', label_render_job_status, name='label_render_job_status'),
+    path('label-jobs/<int:job_id>/download/', download_label_render_job, name='download_label_render_job'),
+    path('mailing-list/<int:mailing_list_id>/export/', export_mailing_list, name='export-mailing-list'),
+    path('export-customers/', export_customers, name='export-customers'),
     path('interest-customer-count/', interest_customer_count, name='interest-customer-count'),
 
 
     path('note/<int:customer_id>/<int:note_pk>/', note_detail_view, name='note_detail'),
     path('note/<int:customer_id>/<int:note_pk>/edit/', note_edit_view, name='note_edit'),
     path('notes/<int:customer_id>/view-all/', all_notes_view, name='view-all-notes'),
+    path('view-profile/<int:customer_id>/<slug:section>/', customer_profile_section, name='customer-profile-section'),
     path('document/<int:customer_id>/<int:document_pk>/edit/', document_edit_view, name='document_edit'),
     path('document/<int:customer_id>/<int:document_pk>/edit-history/', document_edit_history, name='document_edit_history'),
+    path('documents/zip/', download_documents_zip, name='download-documents-zip'),
+    path('document/<int:customer_id>/<int:document_pk>/download/', document_download_view, name='document-download'),
+    path('document/<int:customer_id>/<int:document_pk>/upload-status/', document_upload_status, name='document-upload-status'),
 
     path('document/<int:customer_id>/<int:document_pk>/delete/', document_delete_view, name='document_delete'),  
     path('mailing-list/<int:mailing_list_id>/remove/<int:customer_id>/<int:address_id>/', remove_customer_address_from_mailing_list, name='remove_customer_address_from_mailing_list'),
+    path('mailing-list/<int:mailing_list_id>/remove-addresses/', remove_addresses_from_mailing_list, name='remove-mailing-list-addresses'),
     
     path('address/<int:customer_id>/<int:address_pk>/edit/', address_edit_view, name='address-edit'),
     path('phone/<int:customer_id>/<int:phone_pk>/edit/', phone_edit_view, name='phone-edit'),
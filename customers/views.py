@@ -1,5 +1,6 @@
 # Django utilities for rendering templates and handling redirects
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 
 # Django ORM and query utilities
 from django.db.models import Q, Case, When, Value, IntegerField, BooleanField
@@ -10,14 +11,22 @@ from django.utils import timezone
 from django.utils.timezone import make_aware
 
 # Django HTTP utilities for responses and pagination
-from django.http import HttpResponse, JsonResponse, HttpResponseServerError
+from django.http import HttpResponse, JsonResponse, HttpResponseServerError, FileResponse, StreamingHttpResponse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 # Django authentication utilities
 from django.contrib.auth.decorators import login_required
 
+# Django utilities for conditional (ETag / Last-Modified) & Range requests
+from django.conf import settings
+from django.http import Http404, HttpResponseBadRequest
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+import mimetypes
+
 # Django text utility for generating slugs
-from django.utils.text import slugify  
+from django.utils.text import get_valid_filename, slugify
 
 # Import all forms and models from the current app
 from .forms import *  
@@ -33,9 +42,25 @@ from graphviz import Digraph
 import re
 
 # Import for generating PDF labels
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
-from reportlab.pdfgen import canvas  
+import os
+from .labels import DEFAULT_LABEL_TEMPLATE, LABEL_TEMPLATES, cached_labels_pdf, label_cache_root, mailing_list_dedupe_counts, run_label_render_job
+from .addresses import unique_addresses
+from .mailing_lists import refresh_dynamic_list, refresh_if_stale
+from .signup import FORM_CLASSES, SignupError, commit_signup, discard_signup, stage_step
+from .duplicates import find_duplicates, match_keys
+from .tasks import run_in_background
+from .documents import FileRange, document_zip_members, parse_byte_range, queue_document_uploads, spool_storage, spool_upload
+from .previews import queue_document_previews
+from .note_history import note_versions
+from .profile import PROFILE_SECTIONS, cached_section_page, decode_cursor, load_customer_profile, profile_section_page
+
+# Imports for streaming csv / excel exports
+from .exports import EXPORT_COLUMNS, customer_export_rows, mailing_list_export_rows
+
+# Imports for bulk customer imports (csv / excel files)
+from .imports import IMPORT_COLUMNS, import_root, run_customer_import
+import uuid
+from .streaming import stream_csv, stream_xlsx, stream_zip
 
 
 # --------------------------- PROJECT LAYOUT VIEWS USING DIGRAPHS / GRAPHVIZ ----------------------------
@@ -491,8 +516,8 @@ def customer_signup_diagram_view(request):
     dot.node('validate', 'Form Validation', shape='diamond', style='filled', fillcolor='#fffacd')
     
     # Customer creation paths
-    dot.node('create_cust', 'Create Customer:\n- Set creator=user\n- Save to session', shape='box', style='filled', fillcolor='#e6f3ff')
-    dot.node('process_partial', 'Process Partial Form:\n- Save instance\n- Add to customer', shape='box', style='filled', fillcolor='#e6f3ff')
+    dot.node('create_cust', 'Stage Step:\n- Posted data to session\n- Uploads to temp storage', shape='box', style='filled', fillcolor='#e6f3ff')
+    dot.node('process_partial', 'Commit Signup:\n- One transaction\n- Bulk insert rows', shape='box', style='filled', fillcolor='#e6f3ff')
     
     # Success/error paths
     dot.node('success', 'Redirect to\nSuccess Page', shape='box', style='filled', fillcolor='#e8f5e9')
@@ -506,7 +531,7 @@ def customer_signup_diagram_view(request):
     dot.node('skip_step', 'Skip Step Logic:\n- Increment step\n- Get next form', shape='box', style='filled', fillcolor='#e6f3ff')
     
     # Cancel flow
-    dot.node('cancel', 'Cancel Signup:\n- Delete customer\n- Clear session', shape='box', style='filled', fillcolor='#ffebee')
+    dot.node('cancel', 'Cancel Signup:\n- Discard staged steps\n- Clear session', shape='box', style='filled', fillcolor='#ffebee')
     dot.node('cancel_confirm', 'Show Cancellation\nConfirmation', shape='box', style='filled', fillcolor='#f5f5f5')
 
     # connect edges with arrows
@@ -524,14 +549,14 @@ def customer_signup_diagram_view(request):
     dot.edge('validate', 'htmx_check', label='Valid')
     
     # htmx
-    dot.edge('htmx_check', 'create_cust', label='Step 0\n(non-HTMX)')
-    dot.edge('htmx_check', 'process_partial', label='Steps 1-5\n(non-HTMX)')
+    dot.edge('htmx_check', 'create_cust', label='Steps 0-5\n(non-HTMX)')
     dot.edge('htmx_check', 'render_partial', label='HTMX')
     
     # successfully create a customer
     dot.edge('create_cust', 'check_step', label='Increment step')
-    dot.edge('process_partial', 'check_step', label='Increment step')
-    dot.edge('check_step', 'success', label='All steps complete')
+    dot.edge('check_step', 'process_partial', label='All steps complete')
+    dot.edge('process_partial', 'success')
+    dot.edge('process_partial', 'error', label='Invalid staged step')
     
     # partial render / htmx
     dot.edge('render_partial', 'check_step')
@@ -545,7 +570,6 @@ def customer_signup_diagram_view(request):
     dot.node('cancel_entry', 'Cancel Entry', shape='ellipse', style='filled', fillcolor='#f0f8ff')
     dot.edge('cancel_entry', 'cancel')
     dot.edge('cancel', 'cancel_confirm')
-    dot.edge('cancel', 'error', label='Failure')
 
     # ------ cluster info
     with dot.subgraph(name='cluster_session') as c:
@@ -575,11 +599,11 @@ def customer_signup_diagram_view(request):
     # ------- FORM INFO
     with dot.subgraph(name='cluster_form_types') as c:
         c.attr(label='Form Specific Processing', style='dashed')
-        c.node('addr', 'Address:\n- Save\n- customer.addresses.add()', shape='note')
-        c.node('phone', 'Phone:\n- Save\n- customer.phones.add()', shape='note')
-        c.node('email', 'Email:\n- Save\n- customer.emails.add()', shape='note')
-        c.node('doc', 'Document:\n- Set customer/user\n- Save', shape='note')
-        c.node('note', 'Note:\n- Set customer/user\n- Save', shape='note')
+        c.node('addr', 'Address:\n- Set normalized key\n- Bulk insert + link', shape='note')
+        c.node('phone', 'Phone:\n- Format number\n- Bulk insert + link', shape='note')
+        c.node('email', 'Email:\n- Bulk insert + link', shape='note')
+        c.node('doc', 'Document:\n- Set customer/user\n- Bulk insert (uploads file)', shape='note')
+        c.node('note', 'Note:\n- Set customer/user\n- Bulk insert', shape='note')
         
         dot.edge('process_partial', 'addr', style='dashed')
         dot.edge('process_partial', 'phone', style='dashed')
@@ -1045,7 +1069,8 @@ def search_notes(request):
     
     if search_note:
         query = Q(note__icontains=search_note)  # Search notes containing the query string
-        notes = CustomerNote.objects.filter(query).distinct()
+        # numbered among all of their customer's notes, in the same query
+        notes = CustomerNote.objects.numbered_filter(query).select_related('customer', 'author')
         
         # Annotate notes 
         notes = notes.annotate(
@@ -1064,6 +1089,14 @@ def search_notes(request):
     
     return render(request, 'customers/partials/notes_list.html', {'notes': notes, 'page': customers_page.number})
 
+def document_search_query(search_document):
+    """Helper function: the documents a search (from the home page) matches - by file name or file detail"""
+    return (
+        Q(file__icontains=search_document) |  # Search in file names
+        Q(file_name__icontains=search_document) |  # (documents sharing a stored file keep their name here)
+        Q(file_detail__icontains=search_document)  # Search in file details
+    )
+
 @login_required
 def search_documents(request):
     """
@@ -1075,11 +1108,7 @@ def search_documents(request):
 
     if search_document:
         # Build query to search for matching documents
-        query = (
-            Q(file__icontains=search_document) |  # Search in file names
-            Q(file_detail__icontains=search_document)  # Search in file details
-        )
-        documents = CustomerDocument.objects.filter(query).distinct()
+        documents = CustomerDocument.objects.filter(document_search_query(search_document)).distinct()
         
         # Annotate documents with the inactive status of their related customer
         documents = documents.annotate(
@@ -1096,7 +1125,7 @@ def search_documents(request):
     paginator = Paginator(documents, 10)
     customers_page = paginator.get_page(page)
     
-    return render(request, 'customers/partials/documents_list.html', {'documents': documents, 'page': customers_page.number})
+    return render(request, 'customers/partials/documents_list.html', {'documents': documents, 'page': customers_page.number, 'search_document': search_document})
 
 @login_required
 def search_customers_mailing_list(request):
@@ -1148,51 +1177,39 @@ def search_customers_mailing_list(request):
     return render(request, 'customers/partials/list_customers_mailing.html', context)  # Ensure this template exists
 
 # --------------------------- CUSTOMER SIGN-UP PROCESS: Creation of new customer ----------------------------
-# define all forms to be used in the multi-step sign-up process - in the order they will be used
-FORM_CLASSES = [
-    CreateCustomerForm,
-    CreateAddressForm,
-    CreatePhoneForm,
-    CreateEmailForm,
-    CreateDocumentForm,
-    CreateNoteForm,
-]
-
-def process_partial_form(form, customer, request):
-    """ Helper Function Determines what instance of the form is present in the signup process for the customer partials view"""
-    
-    instance = form.save(commit=False)
-
-    if isinstance(form, CreateAddressForm):
-        instance.save()
-        customer.addresses.add(instance)
-
-    elif isinstance(form, CreatePhoneForm):
-        instance.save()
-        customer.phones.add(instance)
-
-    elif isinstance(form, CreateEmailForm):
-        instance.save()
-        customer.emails.add(instance)
-
-    elif isinstance(form, CreateDocumentForm):
-        instance.customer = customer
-        instance.author = request.user  # This should ONLY happen in CreateDocumentForm
-        instance.save()
-
-    elif isinstance(form, CreateNoteForm):
-        instance.customer = customer
-        instance.author = request.user  # This should ONLY happen in CreateNoteForm
-        instance.save()
+# the forms of the multi-step sign-up process (FORM_CLASSES) & the staging of the steps in the session live in signup.py
+def finish_signup(request):
+    """
+        Helper function that saves the staged sign-up in one transaction once the last step is done.
+        Returns a redirect to the success page (or the error page if the staged steps can't be saved).
+    """
+    try:
+        customer = commit_signup(request.session, request.user)
+    except SignupError:
+        discard_signup(request.session)
+        return redirect("sign_up_error")
+
+    request.session['customer_id'] = customer.id
+    request.session['signup_step'] = len(FORM_CLASSES)
+    return redirect("create_customer_success")
+
+def possible_duplicates(request, step, form):
+    """
+        Helper function that returns the existing customers that look like the customer of step 1 of the sign-up (same or
+        similar name) - nothing once the user has confirmed the customer is new (not_a_duplicate) or on later steps
+    """
+    if step != 0 or request.POST.get('not_a_duplicate'):
+        return []
+    return find_duplicates(match_keys(form.cleaned_data['first_name'], form.cleaned_data.get('last_name', '')))
 
 @login_required    
 def create_customer_view(request):
     """
         Handles the multi-step customer creation/ sign-up process.
         
-        - Step 0: Create a customer and in the session, store this new customer i.d.
-        - Steps 1+: Add an address, phone #, etc.that is associated with the newly created customer
-        - If all steps are completed, the user is redirected to a successful signup page.
+        - Every step (customer, address, phone #, etc.) is validated & staged in the session - uploads wait in temp storage
+        - Nothing is written to the db until the last step: then the customer & everything related is saved in one
+          transaction (see signup.commit_signup) & the user is redirected to a successful signup page
     """
     # Initialize or reset signup step in the session
     step = request.session.get('signup_step', 0)
@@ -1205,20 +1222,10 @@ def create_customer_view(request):
     FormClass = FORM_CLASSES[step]
     form = FormClass(request.POST or None, request.FILES or None)
 
-    # Handle POST requests
-    if request.method == "POST" and form.is_valid():
-        if step == 0:  # First step: Create the customer
-            customer = form.save(commit=False)
-            customer.creator = request.user
-            customer.save()
-            form.save_m2m()
-            request.session['customer_id'] = customer.id
-        else:  # Subsequent steps: Update related information
-            customer_id = request.session.get('customer_id')
-            if not customer_id:
-                return redirect("sign_up_error")
-            customer = get_object_or_404(Customer, id=customer_id)
-            process_partial_form(form, customer, request)
+    # Handle POST requests - step 1 is shown again with the customers it may duplicate until the user confirms it is new
+    duplicates = possible_duplicates(request, step, form) if request.method == "POST" and form.is_valid() else []
+    if request.method == "POST" and form.is_valid() and not duplicates:
+        stage_step(request.session, step, form, request.FILES)
 
         # Increment the step and save it to the session
         step += 1
@@ -1227,11 +1234,11 @@ def create_customer_view(request):
         if step < len(FORM_CLASSES):
             return redirect("create_customer_view")
 
-        return redirect("create_customer_success")
+        return finish_signup(request)
 
     # Render the create customer page
     template = "customers/create_new_customer.html"
-    context = {"form": form, "step": step + 1, "total_steps": len(FORM_CLASSES)}
+    context = {"form": form, "step": step + 1, "total_steps": len(FORM_CLASSES), "duplicates": duplicates}
     return render(request, template, context)
 
 @login_required
@@ -1240,10 +1247,11 @@ def create_customer_partial_view(request):
         Handles multi-step customer creation using HTMX.
 
         The sign up of a customer, each step is stored in the session (session management).
-        - Step 0: a new customer is created & a creator is assigned ( the user that is authenticated for the current session)
-        - Steps 1-6: Add an address, phone #, etc.that is associated with the newly created customer
+        - Step 1: existing customers with the same or a similar name are listed (possible duplicates) - the user can open
+          them or confirm the new customer & continue
+        - Steps 1-6: the customer, an address, phone #, etc. are validated & staged in the session (uploads in temp storage)
         - Dynamic form handling validates the data
-        - Successful signup - redirect to success page
+        - After the last step everything is saved in one transaction - redirect to success page
         - Errors - redirected to error page
     """
     step = request.session.get("signup_step", 0)
@@ -1257,25 +1265,12 @@ def create_customer_partial_view(request):
     # Extract non-field errors for display
     form_errors = form.non_field_errors()
 
-    if request.method == "POST":
-        if form.is_valid():
-            customer_id = request.session.get("customer_id")
-
-            if step == 0:
-                # Create a new customer
-                customer = form.save(commit=False)
-                customer.creator = request.user
-                customer.save()
-                form.save_m2m()
-                request.session["customer_id"] = customer.id
+    # step 1: the customers the new one may duplicate are shown (blocking keys) until the user confirms it is new
+    duplicates = possible_duplicates(request, step, form) if request.method == "POST" and form.is_valid() else []
 
-            else:
-                # Retrieve existing customer
-                if not customer_id:
-                    return redirect("sign_up_error")
-
-                customer = get_object_or_404(Customer, id=customer_id)
-                process_partial_form(form, customer, request)
+    if request.method == "POST":
+        if form.is_valid() and not duplicates:
+            stage_step(request.session, step, form, request.FILES)
 
             # Move to the next step
             step += 1
@@ -1291,7 +1286,7 @@ def create_customer_partial_view(request):
                     "form_errors": None
                 })
 
-            return redirect("create_customer_success")  # Final step completed
+            return finish_signup(request)  # Final step completed
 
     # Render the partial form for HTMX requests, including validation errors if any
     return render(request, "customers/partials/signup_form.html", {
@@ -1299,6 +1294,7 @@ def create_customer_partial_view(request):
         "step": step + 1,
         "total_steps": len(FORM_CLASSES),
         "form_errors": form_errors,
+        "duplicates": duplicates,
     })
 
 @login_required    
@@ -1312,7 +1308,9 @@ def create_customer_success(request):
     """
     
     # Clear session variables after successful customer signup
-    cust_id = request.session['customer_id']
+    cust_id = request.session.get('customer_id')
+    if not cust_id:
+        return redirect("sign_up_error")
     
     # retrieve a customer if the customer id exists
     customer = get_object_or_404(Customer, id=cust_id)
@@ -1342,26 +1340,14 @@ def cancel_signup(request):
     """
     Cancels an ongoing , multi-step new customer signup process.
 
-    - If a customer record exists in the session, this customer and assoicated data (documents, etc.) are delted
-    - Session variables (`signup_step` and `customer_id`) are cleared, allowing new customer signups
+    - Nothing has been written to the db yet: the staged steps & uploads are simply thrown away
+    - Session variables (`signup_step`, `signup_data` & `customer_id`) are cleared, allowing new customer signups
 
     Returns:
-        - A redirect to the cancellation confirmation page if successful.
-        - A redirect to the home page in case of an error.
+        - A redirect to the cancellation confirmation page.
     """
-    # Retrieve the customer ID from the session
-    customer_id = request.session.get('customer_id')
-
-    if customer_id:
-        try:
-            # Retrieve and delete the customer record
-            customer = get_object_or_404(Customer, id=customer_id)
-            customer.delete()  # Deletes related objects if cascade deletion is set
-        except Exception as e:
-            return redirect('sign_up_error')  # Redirect home in case of error
-
-    # Clear session data to allow a fresh signup process
-    request.session.pop('signup_step', None)
+    # Clear session data (& staged uploads) to allow a fresh signup process
+    discard_signup(request.session)
     request.session.pop('customer_id', None)
 
     # Redirect to a cancellation confirmation page
@@ -1390,9 +1376,9 @@ def create_customer_skip_step(request):
     step += 1
     request.session['signup_step'] = step
 
-    # redirects to success page if step > 6
+    # saves the staged steps & redirects to success page if step > 6
     if step >= len(FORM_CLASSES):
-        return redirect("create_customer_success")
+        return finish_signup(request)
 
     # Get the next form class based on the current step
     FormClass = FORM_CLASSES[step]
@@ -1425,26 +1411,116 @@ def view_newest_customer_profile(request):
 
     return view_full_customer_profile(request, newest_customer.id)
 
+@login_required
+def import_customers_view(request):
+    """
+        View that imports a csv / excel file of customers instead of signing them up one at a time.
+
+        - GET: upload form, the expected columns & the recent imports
+        - POST: the file is copied to the import directory & imported in the background (customers.imports) - the
+          import page polls its progress & links to the report of the rows that could not be imported
+        - rows that are likely duplicates of existing customers are skipped (& reported) unless allow_duplicates is ticked
+    """
+    if request.method == "POST":
+        form = CustomerImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            extension = os.path.splitext(upload.name)[1].lower()
+            staged_name = f"{uuid.uuid4().hex}{extension}"
+
+            # the file is read row by row in the background - copy it out of the request first
+            os.makedirs(import_root(), exist_ok=True)
+            with open(os.path.join(import_root(), staged_name), 'wb') as destination:
+                for chunk in upload.chunks():
+                    destination.write(chunk)
+
+            customer_import = CustomerImport.objects.create(
+                file_name=upload.name,
+                staged_name=staged_name,
+                allow_duplicates=form.cleaned_data['allow_duplicates'],
+                requested_by=request.user,
+            )
+            run_in_background(run_customer_import, customer_import.id)
+            return redirect('customer-import-status', import_id=customer_import.id)
+    else:
+        form = CustomerImportForm()
+
+    context = {
+        'form': form,
+        'import_columns': IMPORT_COLUMNS,
+        'recent_imports': CustomerImport.objects.filter(requested_by=request.user)[:5],
+    }
+    return render(request, 'customers/import_customers.html', context)
+
+@login_required
+def customer_import_status(request, import_id):
+    """
+        Progress of a customer import: the full page, or (HTMX polling) the status partial that replaces itself
+        every 2 seconds until the import is finished
+    """
+    customer_import = get_object_or_404(CustomerImport, id=import_id)
+    template = 'customers/partials/customer_import.html' if request.htmx else 'customers/customer_import.html'
+    return render(request, template, {'customer_import': customer_import})
+
+@login_required
+def download_customer_import_report(request, import_id):
+    """Downloads the csv report of the rows of an import that could not be imported (row number, column & error)"""
+    customer_import = get_object_or_404(CustomerImport, id=import_id)
+    report_path = os.path.join(import_root(), customer_import.report_name)
+
+    if not customer_import.report_name or not os.path.exists(report_path):
+        return redirect('customer-import-status', import_id=customer_import.id)
+
+    file_name = f"{os.path.splitext(customer_import.file_name)[0]}_errors.csv"
+    return FileResponse(open(report_path, 'rb'), as_attachment=True, filename=file_name, content_type='text/csv')
+
 # --------------------------- VIEW PROFILE INFORMATION ---------------------
 @login_required    
 def view_full_customer_profile(request, customer_id):
     """View to view full customer information - uses customer_id to retrieve the correct customer info"""
-    # Retrieve the customer for the given ID
-    customer = get_object_or_404(Customer, id=customer_id)
-
-    # Retrieve associated notes and documents
-    customer_notes = customer.notes.all()
-    customer_documents = customer.documents.all()
+    # Retrieve the customer for the given ID with everything the page shows (contacts, interests, mailing lists...) &
+    # the first page of the associated notes and documents (newest first, with their authors) - in a fixed number of
+    # queries, the rest of the notes and documents is loaded by the "load more" buttons (customer_profile_section)
+    context = load_customer_profile(customer_id)
         
     # Template and context
     template = 'customers/view_customer_profile.html'
-    context = {
-        'customer': customer,
-        'customer_notes': customer_notes,
-        'customer_documents': customer_documents,
-    }
     return render(request, template, context)
 
+@login_required
+@require_safe
+def customer_profile_section(request, customer_id, section):
+    """
+        HTMX "load more": the next page of a customer's notes, documents or all notes page, after the cursor in ?after=
+        (the created_at & id of the last item shown - keyset pagination, so deep pages cost the same as the first).
+
+        - pages are cached until the customer's notes or documents change (their profile_version is in the key)
+        - the ETag has the same version: a browser revalidating a page it has gets a 304
+    """
+    # get the customer or 404 page - unknown sections too
+    customer = get_object_or_404(Customer, id=customer_id)
+    if section not in PROFILE_SECTIONS:
+        raise Http404("No such section of the profile.")
+
+    cursor = request.GET.get('after', '')
+    if cursor and decode_cursor(cursor) is None:
+        return HttpResponseBadRequest("Invalid cursor.")
+
+    etag = f'W/"{customer.pk}-{customer.profile_version}-{section}-{cursor or "first"}-{request.user.pk}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        def render_page():
+            # only rendered (& the page queried) when the page is not in the cache
+            rows, next_cursor = profile_section_page(customer, section, cursor)
+            context = {'customer': customer, 'page': rows, 'next_cursor': next_cursor}
+            return render_to_string(PROFILE_SECTIONS[section][1], context, request)
+
+        response = HttpResponse(cached_section_page(customer, section, cursor, request.user, render_page))
+
+    response.headers['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)  # only cached by the browser & always revalidated
+    return response
+
 @login_required
 def toggle_inactive_status(request, customer_id):
     """Toggles a customer profile account to inactive using the customer_id"""
@@ -1476,6 +1552,38 @@ def toggle_inactive_status(request, customer_id):
     # Return an error for non-POST requests
     return JsonResponse({"error": "Invalid request method"}, status=400)
 
+@login_required
+def merge_customer_view(request, customer_id):
+    """
+        View that merges a duplicate customer into a customer (customers.merges).
+
+        - GET: the form for the ID of the duplicate (?duplicate= fills it in, e.g. from the duplicate report)
+        - POST: the customer & the duplicate side by side, to confirm - once confirmed, the duplicate's contacts, notes,
+          documents, relationships & mailing lists move to the customer, the duplicate is deleted & the user is sent
+          to the customer's profile
+    """
+    # get the customer that is kept or 404 page
+    customer = get_object_or_404(Customer, id=customer_id)
+
+    if request.method == "POST":
+        form = CustomerMergeForm(request.POST, customer=customer)
+        if form.is_valid():
+            # the merge only happens once the user has seen both customers
+            if request.POST.get('confirm'):
+                form.save(user=request.user)
+                return redirect('view_customer_profile', customer_id=customer.id)
+
+            context = {
+                'customer': customer,
+                'duplicate': form.cleaned_data['duplicate'],
+                'form': form,
+            }
+            return render(request, 'customers/merge_customer.html', context)
+    else:
+        form = CustomerMergeForm(initial={'duplicate': request.GET.get('duplicate')}, customer=customer)
+
+    return render(request, 'customers/merge_customer.html', {'customer': customer, 'form': form})
+
 # ----------------------------- ADD NEW CUSTOMER INFO: address, email, phone, note, document or interest ---------------------------
 @login_required
 def add_address(request, customer_id):
@@ -1591,7 +1699,10 @@ def add_document(request, customer_id):
             document = form.save(commit=False)
             document.author = request.user # save the author of the note as the request.user
             document.customer = customer #  sets the customer field of document to reference customer instance
+            # the file waits on local disk & is pushed to storage in the background - the document shows 'processing'
+            spool_upload(document, form.cleaned_data['file'])
             document.save()
+            queue_document_uploads([document.pk])
             # redirect to ful customer profile view            
             return redirect('view_customer_profile', customer_id=customer_id) 
     else:
@@ -1677,10 +1788,14 @@ def create_customer_mailing_list(request):
             
             selected_interests = CustomerInterest.objects.filter(id__in=selected_interest_ids)
 
+            # selected & interest addresses - duplicate addresses (same normalized address) can be merged: one per household
+            list_addresses = Address.objects.filter(Q(id__in=selected_addresses) | Q(id__in=interest_addresses))
+            if request.POST.get("dedupe_addresses"):
+                list_addresses = unique_addresses(list_addresses)
+
             # add all selected user data to the mailing list
             mailing_list.customers.add(*all_customers)  
-            mailing_list.addresses.add(*selected_addresses)  
-            mailing_list.addresses.add(*interest_addresses)  
+            mailing_list.addresses.add(*list_addresses)  
             mailing_list.interests.add(*selected_interests)
             
             # redirect to show all mailing lists
@@ -1709,27 +1824,145 @@ def interest_customer_count(request):
     ).distinct()
     return JsonResponse({'total_customers': customers.count()})
 
+# number of addresses shown at a time on the mailing list details page
+MAILING_LIST_PAGE_SIZE = 50
+
+# most addresses that can be added / removed in one bulk request
+MAX_BULK_ADDRESSES = 1000
+
+def parse_id_list(values, unique=True):
+    """
+        Helper function that returns the ids posted as repeated fields and/or comma separated values ('1,2', '3')
+        as a list of ints in the order sent (without duplicates if unique) - raises ValueError if any id isn't a number
+    """
+    ids = [int(value) for item in values for value in item.split(",") if value.strip()]
+    return list(dict.fromkeys(ids)) if unique else ids
+
+def parse_positive_int(value, default):
+    """Helper function that returns value as a positive int (cursors, page numbers) or the default if it isn't one"""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
+
 @login_required
 def view_mailing_list_details(request, pk):
-    """View that shows the mailing list details of an individual mailing list by primary key supplied"""
-    # Retrieve the mailing list or return a 404 if not found
-    mailing_list = get_object_or_404(CustomerMailingList, pk=pk)
+    """
+        View that shows the mailing list details of an individual mailing list by primary key supplied
 
-    return render(request, "customers/mailing_list_details.html", {"mailing_list": mailing_list})
+        - addresses are paginated with a cursor (?after=<last address id shown>) - pages further in cost the same as the first
+        - a fixed number of queries: the list with its customer / address totals, a page of addresses, their customers & the interests
+        - HTMX requests (Load More) only get the next page of address rows
+        - dynamic lists are refreshed from their rule first if their snapshot is stale (or ?refresh=1)
+    """
+    # Retrieve the mailing list (with its counts) or return a 404 if not found
+    mailing_list = get_object_or_404(CustomerMailingList.objects.with_counts(), pk=pk)
+
+    # the next pages of a dynamic list come from the same snapshot as the first
+    if mailing_list.is_dynamic and not request.htmx:
+        refreshed = refresh_dynamic_list(mailing_list) if request.GET.get('refresh') else refresh_if_stale(mailing_list)
+        if refreshed:
+            mailing_list = CustomerMailingList.objects.with_counts().get(pk=pk)
+
+    # one page of addresses after the cursor + 1 to know if there is a next page, with their customers prefetched
+    after = parse_positive_int(request.GET.get('after'), 0)
+    addresses = list(
+        mailing_list.addresses.filter(id__gt=after)
+        .order_by('id')
+        .prefetch_related('customer_addresses')[:MAILING_LIST_PAGE_SIZE + 1]
+    )
+    has_next = len(addresses) > MAILING_LIST_PAGE_SIZE
+    addresses = addresses[:MAILING_LIST_PAGE_SIZE]
+
+    # number shown next to the first address of the page
+    first_number = parse_positive_int(request.GET.get('n'), 1) or 1
+
+    context = {
+        "mailing_list": mailing_list,
+        "addresses": addresses,
+        "first_number": first_number,
+        "next_cursor": addresses[-1].id if has_next else None,
+        "next_number": first_number + len(addresses),
+    }
+
+    if request.htmx:
+        return render(request, "customers/partials/mailing_list_address_rows.html", context)
+
+    context["interests"] = list(mailing_list.interests.all())
+    return render(request, "customers/mailing_list_details.html", context)
+
+# number of mailing lists shown per page of the index & the orderings it can be sorted by (?sort=)
+MAILING_LIST_INDEX_PAGE_SIZE = 20
+MAILING_LIST_SORTS = {
+    "newest": ("Newest", ("-created_at", "-id")),
+    "oldest": ("Oldest", ("created_at", "id")),
+    "largest": ("Most Addresses", ("-address_total", "-created_at", "-id")),
+    "smallest": ("Fewest Addresses", ("address_total", "-created_at", "-id")),
+}
 
 @login_required
 def list_mailing_lists(request):
-    """view that retreives all mailing lists from the db"""
+    """
+        View that lists the mailing lists, a page at a time.
+
+        - every list comes with its customer, address & mailable address counts & its interest names (with_summary),
+          annotated in the same query - 2 queries per page (page count + page) however many lists there are
+        - ?sort= newest (default), oldest, largest or smallest (by number of addresses)
+    """
+    sort = request.GET.get("sort", "newest")
+    if sort not in MAILING_LIST_SORTS:
+        sort = "newest"
+
+    mailing_lists = CustomerMailingList.objects.with_summary().order_by(*MAILING_LIST_SORTS[sort][1])
+    paginator = Paginator(mailing_lists, MAILING_LIST_INDEX_PAGE_SIZE)
     try:
-        mailing_lists = CustomerMailingList.objects.all()
-    except Exception as e:
-        return HttpResponseServerError("An error occurred while fetching mailing lists.")
+        page = paginator.page(request.GET.get("page", 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
 
     context = {
-        "mailing_lists": mailing_lists
+        "mailing_lists": page,
+        "sort": sort,
+        "sorts": {key: label for key, (label, ordering) in MAILING_LIST_SORTS.items()},
     }
     return render(request, "customers/list_mailing_lists.html", context)
 
+@login_required
+def combine_mailing_lists_view(request):
+    """
+        View that creates a new mailing list from the union, intersection or difference of mailing lists & interests
+        ("Tree Sale buyers not on the Fish Sale list"). The members are combined & copied in the database.
+    """
+    if request.method == "POST":
+        form = CombineMailingListsForm(request.POST)
+        if form.is_valid():
+            mailing_list = form.save()
+            return redirect('view-mailing-list-details', mailing_list.id)
+    else:
+        form = CombineMailingListsForm()
+
+    return render(request, "customers/combine_mailing_lists.html", {"form": form})
+
+@login_required
+def dynamic_mailing_list_view(request, pk=None):
+    """
+        View that creates (or edits, given a primary key) a dynamic mailing list: its members come from a rule
+        (interests, states, zip codes, customer types, date added) evaluated when the list is viewed, exported or printed
+    """
+    mailing_list = get_object_or_404(CustomerMailingList, pk=pk, is_dynamic=True) if pk else None
+
+    if request.method == "POST":
+        form = DynamicMailingListForm(request.POST, instance=mailing_list)
+        if form.is_valid():
+            mailing_list = form.save()
+            return redirect('view-mailing-list-details', mailing_list.id)
+    else:
+        form = DynamicMailingListForm(instance=mailing_list)
+
+    return render(request, "customers/dynamic_mailing_list.html", {"form": form, "mailing_list": mailing_list})
+
 @login_required
 def add_selected_address_list(request):
     """Handles HTMX request to add a selected address to a mailing list and returns an HTML snippet."""
@@ -1775,6 +2008,69 @@ def remove_selected_address_list(request):
     # else return an error
     return JsonResponse({"error": "Invalid request"}, status=400)
 
+@login_required
+def add_selected_addresses_list(request):
+    """
+        HTMX request that adds many selected addresses to a mailing list (being built) at once & returns their rows.
+
+        - POST address_id & customer_id: repeated (or comma separated) in pairs - the n-th address goes with the n-th customer
+        - every pair is checked in one query (the address must belong to the customer) - unknown pairs are a 404
+        - all the rows are rendered in a single partial
+    """
+    if request.method != "POST":
+        return HttpResponse(status=400)
+
+    try:
+        address_ids = parse_id_list(request.POST.getlist("address_id"), unique=False)
+        customer_ids = parse_id_list(request.POST.getlist("customer_id"), unique=False)
+    except ValueError:
+        return HttpResponse("Invalid address or customer parameters", status=400)
+
+    # Ensure there is a customer for every address (& not too many at once)
+    if not address_ids or len(address_ids) != len(customer_ids) or len(address_ids) > MAX_BULK_ADDRESSES:
+        return HttpResponse("Missing address or customer parameters", status=400)
+
+    # one query: the customer / address links of the pairs, with both objects
+    pairs = list(dict.fromkeys(zip(address_ids, customer_ids)))
+    links = Customer.addresses.through.objects.filter(
+        address_id__in=address_ids, customer_id__in=customer_ids
+    ).select_related('address', 'customer')
+    links = {(link.address_id, link.customer_id): link for link in links}
+
+    if any(pair not in links for pair in pairs):
+        return HttpResponse("Address or customer not found", status=404)
+
+    # Render and return all the selected address rows at once
+    return render(
+        request,
+        "customers/partials/selected_addresses.html",
+        {"selections": [links[pair] for pair in pairs]}
+    )
+
+@login_required
+def remove_selected_addresses_list(request):
+    """
+        HTMX request that removes many selected addresses from a mailing list being built (nothing is saved yet).
+        The address ids (repeated or comma separated) are checked in one query.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request"}, status=400)
+
+    try:
+        address_ids = parse_id_list(request.POST.getlist("address_id"))
+    except ValueError:
+        return JsonResponse({"error": "Invalid address ID"}, status=400)
+
+    if not address_ids or len(address_ids) > MAX_BULK_ADDRESSES:
+        return JsonResponse({"error": "Missing address ID"}, status=400)
+
+    # makes sure every address exists
+    if Address.objects.filter(id__in=address_ids).count() != len(address_ids):
+        return JsonResponse({"error": "Address not found"}, status=404)
+
+    # the rows are removed from the UI after the request
+    return HttpResponse(status=204)
+
 # ------------ UPDATES CUSTOMER INFO: customer, address, phone, email, note or document -------------------------------
 @login_required
 def edit_customer(request, customer_id):
@@ -1917,7 +2213,15 @@ def document_edit_view(request, customer_id, document_pk):
     if request.method == "POST":
         form = CreateDocumentForm(request.POST, request.FILES, instance=document, user=request.user) # populate the form with the document data, file to edit and user that is editing the note
         if form.is_valid():
-            form.save()  # This updates both the description and the file
+            document = form.save(commit=False)  # This updates both the description and the file (& records the history)
+            # a new file is pushed to storage in the background, like a new document
+            if 'file' in form.changed_data:
+                spool_upload(document, form.cleaned_data['file'])
+            document.save()
+            if 'file' in form.changed_data:
+                queue_document_uploads([document.pk])
+            elif document.is_stored and not document.preview:
+                queue_document_previews([document.pk])  # the edit cleared the preview
             return redirect('view_customer_profile', customer_id=customer_id) # redirects to updated customer profile
     else:
         form = CreateDocumentForm(instance=document)
@@ -1935,6 +2239,10 @@ def mailing_list_edit_view(request, pk):
     # Retrieve the correct mailing list
     mailing_list = get_object_or_404(CustomerMailingList, pk=pk)
 
+    # dynamic lists are changed through their rule
+    if mailing_list.is_dynamic:
+        return redirect('edit-dynamic-mailing-list', mailing_list.id)
+
     # Get preselected interest IDs from customers in the mailing list
     selected_interest_ids = list(
         mailing_list.customers.values_list("interests__id", flat=True).distinct()
@@ -1990,8 +2298,8 @@ def note_detail_view(request, customer_id, note_pk):
     customer = get_object_or_404(Customer, pk=customer_id)
     note = get_object_or_404(customer.notes, pk=note_pk)
     
-    # get the associated note history
-    history = note.note_history.all().order_by('-edited_at')
+    # get the associated note history: every previous version rebuilt from the compressed diffs (one query)
+    history = note_versions(note)
 
     context = {
         'customer': customer,
@@ -2006,10 +2314,12 @@ def all_notes_view(request, customer_id):
     """Lists all notes for a given customer, given a customer id"""
     # Retrieve the customer by ID
     customer = get_object_or_404(Customer, pk=customer_id)
-    # Retrieve all notes related to the customer
-    notes = customer.notes.all()
+    # Retrieve the first page of the customer's notes - numbered (& with their authors) in a single query, the rest is
+    # loaded by the "load more" button (customer_profile_section)
+    notes, next_cursor = profile_section_page(customer, 'all-notes')
     context = {
-        'notes': notes,       # Paginated notes for the current page
+        'notes': notes,       # Notes of the first page
+        'next_cursor': next_cursor,  # Cursor of the next page (None on the last page)
         'customer': customer,  # The customer object
     }
 
@@ -2023,8 +2333,8 @@ def document_edit_history(request, customer_id, document_pk):
     customer = get_object_or_404(Customer, pk=customer_id)
     document = get_object_or_404(customer.documents, pk=document_pk)
     
-    # get the associated document edit history
-    history = document.edit_history.all().order_by('-edited_at')
+    # get the associated document edit history (with the editors, in the same query)
+    history = document.edit_history.select_related('edited_by').order_by('-edited_at')
     context = {
         'customer': customer,
         'document': document,
@@ -2033,6 +2343,134 @@ def document_edit_history(request, customer_id, document_pk):
     return render(request, 'customers/edit_document_history.html', context)
 
 # ------------------------ DELETE -------------------------------------------
+@login_required
+def document_upload_status(request, customer_id, document_pk):
+    """
+        Upload status of a document pushed to storage in the background (HTMX polling): the partial replaces itself
+        every 2 seconds until the file is stored - then it links to the file
+    """
+    customer = get_object_or_404(Customer, pk=customer_id)
+    document = get_object_or_404(customer.documents, pk=document_pk)
+    return render(request, 'customers/partials/document_file.html', {'document': document})
+
+@login_required
+@require_safe
+def document_download_view(request, customer_id, document_pk):
+    """
+        Downloads the file of a document (logged in users only) under the name the document is shown with.
+
+        - conditional requests: the ETag is the SHA-256 of the content, so a browser revalidates its copy with a 304
+        - Range requests are answered with 206 Partial Content: large pdfs open progressively & downloads resume
+        - settings.DOCUMENT_DOWNLOAD_OFFLOAD hands the transfer to the front-end server (X-Accel-Redirect / X-Sendfile),
+          which also serves the ranges - no python worker is kept busy for the whole transfer
+    """
+    customer = get_object_or_404(Customer, pk=customer_id)
+    document = get_object_or_404(customer.documents.select_related('blob'), pk=document_pk)
+    # a document still being pushed to storage has no file to download yet
+    if not document.is_stored or not document.file:
+        raise Http404("The document's file is not stored yet.")
+
+    # documents stored before uploads were hashed: their id & the time they were stored
+    last_modified = int(document.last_modified.timestamp())
+    etag = f'"{document.content_hash or f"{document.pk}-{last_modified}"}"'
+
+    # 304 Not Modified (the browser's copy is current) or 412 Precondition Failed
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _document_file_response(request, document, etag, last_modified)
+
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)  # only cached by the browser & always revalidated
+    return response
+
+def _document_file_response(request, document, etag, last_modified):
+    """The response sending the file of a document: handed to the front-end server, a range of it or all of it"""
+    offload = settings.DOCUMENT_DOWNLOAD_OFFLOAD
+    if offload == 'x-accel-redirect':
+        response = HttpResponse(content_type=mimetypes.guess_type(document.display_name)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = settings.DOCUMENT_DOWNLOAD_ACCEL_PREFIX + document.file.name
+        response.headers['Content-Disposition'] = content_disposition_header(False, document.display_name)
+        return response
+    if offload == 'x-sendfile':
+        try:
+            path = document.file.path
+        except NotImplementedError:
+            path = None  # not on local disk (cloudinary): streamed below
+        if path:
+            response = HttpResponse(content_type=mimetypes.guess_type(document.display_name)[0] or 'application/octet-stream')
+            response.headers['X-Sendfile'] = path
+            response.headers['Content-Disposition'] = content_disposition_header(False, document.display_name)
+            return response
+
+    file = document.file.storage.open(document.file.name, 'rb')
+    size = document.blob.size if document.blob else file.size
+
+    # If-Range: a range of the file the client already has a part of - the whole file if it changed since
+    if_range = request.headers.get('If-Range')
+    range_header = request.headers.get('Range')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        range_header = None
+
+    try:
+        byte_range = parse_byte_range(range_header, size)
+    except ValueError:
+        file.close()
+        response = HttpResponse(status=416)
+        response.headers['Content-Range'] = f"bytes */{size}"
+        return response
+
+    if byte_range is None:
+        response = FileResponse(file, filename=document.display_name)
+    else:
+        start, end = byte_range
+        response = FileResponse(FileRange(file, start, end), filename=document.display_name, status=206)
+        response.headers['Content-Length'] = end - start + 1
+        response.headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+@login_required
+@require_safe
+def download_documents_zip(request):
+    """
+        Streams a zip archive of documents (e.g. every W-9 for an audit), filtered by any of:
+        ?customer= (a customer's documents), ?file_type= & ?search_document= (the documents a search finds).
+
+        - the archive is compressed as the files are read from storage (in chunks, one file at a time) & sent as it
+          is written - it is never held in memory, whatever the number of documents
+        - only documents whose file is stored are included, in a folder per customer
+    """
+    customer_id = request.GET.get('customer', '')
+    file_type = request.GET.get('file_type', '')
+    search_document = request.GET.get('search_document', '').strip()
+    if not (customer_id or file_type or search_document):
+        return HttpResponseBadRequest("Choose the documents to download: a customer, a file type or a search.")
+
+    documents = CustomerDocument.objects.filter(upload_status='stored').exclude(file="").select_related('customer')
+    archive_name = []
+    if customer_id:
+        customer = get_object_or_404(Customer, pk=customer_id) if customer_id.isdigit() else None
+        if customer is None:
+            return HttpResponseBadRequest("Unknown customer.")
+        documents = documents.filter(customer=customer)
+        archive_name.append(customer.display_name)
+    if file_type:
+        documents = documents.filter(file_type=file_type)
+        archive_name.append(dict(CustomerDocument.FILE_TYPES).get(file_type, file_type))
+    if search_document:
+        documents = documents.filter(document_search_query(search_document))
+        archive_name.append(search_document)
+
+    # read from the db in chunks as the archive is written (a customer's documents next to each other)
+    documents = documents.order_by('customer__last_name', 'customer__first_name', 'customer_id', 'created_at')
+    members = document_zip_members(documents.iterator(chunk_size=500))
+
+    response = StreamingHttpResponse(stream_zip(members, compresslevel=1), content_type='application/zip')
+    file_name = get_valid_filename("_".join(archive_name + ["documents"]))
+    response['Content-Disposition'] = f'attachment; filename="{file_name}.zip"'
+    return response
+
 @login_required
 def document_delete_view(request, customer_id, document_pk):
     """View that deletes a document given a provided customer id and document id"""
@@ -2045,6 +2483,9 @@ def document_delete_view(request, customer_id, document_pk):
     # if it is a post method
     if request.method == "POST":
         document.delete() # delete the document which leads to the cascading delete of document from customer model 
+        # an upload still waiting in the spool is deleted with it (its background job finds nothing to store)
+        if document.spooled_name:
+            spool_storage().delete(document.spooled_name)
         return redirect('view_customer_profile', customer_id=customer_id)
     
     context = {
@@ -2083,15 +2524,14 @@ def delete_customer_from_mailing_list(request, mailing_id, customer_id):
     customer = get_object_or_404(Customer, id=customer_id)
 
     if request.method == "POST":
-        if customer in mailing_list.customers.all():
-            mailing_list.customers.remove(customer) # remove customers from mailing lists
+        # remove customers from mailing lists (a single DELETE - nothing happens if the customer is not on the list)
+        mailing_list.customers.remove(customer)
         #  Detect if the request is from the edit page
         edit_mode = request.POST.get('edit_mode', False)
         
         if request.htmx: # if it is an htmx in edit mode
-            if edit_mode: # if in edit mode, render the partial mailing list dettails page
-                context = { 'mailing_list' : mailing_list}
-                return render(request, 'customers/partials/mailing_list_details.html', context)
+            if edit_mode: # if in edit mode, the customer's row is swapped for this empty response (the rest of the list is untouched)
+                return HttpResponse("")
             
             else: # renders the success mailing list page if not in edit mode -> Will give user options after successfully deleting / removing a customer from the mailing list
                 context = { 'customer_id' : customer_id}
@@ -2201,88 +2641,212 @@ def remove_customer_address_from_mailing_list(request, mailing_list_id, customer
     redirect_url = reverse('view-mailing-list-details', args=[mailing_list_id])
     redirect_url += f"?status={status}&message={message}"
     return redirect(redirect_url)
-# ------------------------ MAILING LIST: Labels & pdf generation -------------------------------------------
+
 @login_required
-def generate_labels_pdf(request, mailing_list_id):
-    """View that generates PDF labels with proper page management"""
+def remove_addresses_from_mailing_list(request, mailing_list_id):
+    """
+        Removes many addresses (POST address_id, repeated or comma separated) from a saved mailing list at once.
+        Customers left without an address on the list are removed with them.
+
+        - the addresses are checked against the list in one query - addresses that aren't on it are a 404
+        - addresses & customers are removed set-wise (see CustomerMailingList.remove_addresses)
+        - HTMX requests get the removed ids back (the rows are taken out of the page), others are redirected
+    """
+    if request.method != "POST":
+        return HttpResponse(status=405)
+
     mailing_list = get_object_or_404(CustomerMailingList, id=mailing_list_id)
 
-    # Get all addresses (only once)
-    addresses = mailing_list.addresses.filter(customer_addresses__isnull=False)
-    total_addresses = addresses.count()
-    
-    # Get starting position
     try:
-        start_position = max(0, int(request.POST.get('start_position', 1)) - 1)
+        address_ids = parse_id_list(request.POST.getlist("address_id"))
     except ValueError:
-        start_position = 0
-
-    # PDF setup
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="{mailing_list.name}_labels.pdf"'
-    
-    # Label sheet configuration (Avery 5160)
-    labels_per_row = 3
-    rows_per_page = 10
-    label_width = 2.625 * inch
-    label_height = 1 * inch
-    margin_x = 0.5 * inch
-    margin_y = 0.5 * inch
-    spacing_x = 0.125 * inch
-    
-    # Initialize PDF
-    pdf = canvas.Canvas(response, pagesize=letter)
-    
-    # Calculate total labels per page
-    labels_per_page = labels_per_row * rows_per_page
-    
-    # Track position counter
-    current_position = 0
-
-    for address in addresses:
-        # Skip until we reach starting position
-        if current_position < start_position:
-            current_position += 1
-            continue
+        return HttpResponse("Invalid address ID", status=400)
 
-        # Calculate position on current page
-        position_on_page = current_position % labels_per_page
+    if not address_ids or len(address_ids) > MAX_BULK_ADDRESSES:
+        return HttpResponse("Missing address ID", status=400)
 
-        # Start a new page if at beginning of a new page, but not first label
-        if position_on_page == 0 and current_position != start_position:
-            pdf.showPage()
+    # the members of dynamic lists come from their rule
+    if mailing_list.is_dynamic:
+        return HttpResponse("Addresses can't be removed from a dynamic mailing list - change its rule instead", status=400)
 
-        # Reset font after showPage (required)
-        pdf.setFont("Helvetica", 10)
+    # every address must be on the list
+    if mailing_list.addresses.filter(id__in=address_ids).count() != len(address_ids):
+        return HttpResponse("Address not found on this mailing list", status=404)
 
-        # Determine row and column
-        row = position_on_page // labels_per_row
-        col = position_on_page % labels_per_row
+    customer_ids = mailing_list.remove_addresses(address_ids)
 
-        # Calculate label coordinates
-        x = margin_x + col * (label_width + spacing_x)
-        y = letter[1] - margin_y - label_height - (row * label_height)
+    if request.htmx:
+        return JsonResponse({"removed_addresses": address_ids, "removed_customers": customer_ids})
 
-        # Get customer info
-        customer = address.customer_addresses.first()
-        address_text = f"{customer.mailing_list_name}\n{address.street}\n{address.city}, {address.state} {address.zip_code}"
-        
-                # Create text object
-        text_object = pdf.beginText()
-        text_object.setTextOrigin(x + 5, y + label_height - 15)
-        for line in address_text.split("\n"):
-            text_object.textLine(line)
-        pdf.drawText(text_object)
-
-        # Move to next label
-        current_position += 1
-
-    # Finalize the PDF
-    pdf.save()
-    return response
+    # Status message
+    message = f"{len(address_ids)} addresses have been removed from the mailing list."
+    redirect_url = reverse('view-mailing-list-details', args=[mailing_list_id])
+    redirect_url += f"?status=success&message={message}"
+    return redirect(redirect_url)
+# ------------------------ MAILING LIST: Labels & pdf generation -------------------------------------------
+def parse_start_position(request):
+    """Helper function that returns the 0-based label slot to start printing on (the form sends the 1-based label number)"""
+    try:
+        return max(0, int(request.POST.get('start_position', 1)) - 1)
+    except ValueError:
+        return 0
+
+def parse_label_template(data):
+    """Helper function that returns the label template picked on the print labels page (the default for unknown templates)"""
+    template = data.get('template', DEFAULT_LABEL_TEMPLATE)
+    return template if template in LABEL_TEMPLATES else DEFAULT_LABEL_TEMPLATE
+
+@login_required
+def generate_labels_pdf(request, mailing_list_id):
+    """
+        View that generates PDF labels for a mailing list with proper page management
+
+        - labels are printed on the label sheet / envelope template picked on the print labels page
+        - duplicate addresses can be merged into one label per household (dedupe)
+        - label rows (address + customer name) come from one ordered, chunked query - no per-label lookups
+        - finished pdfs are cached per mailing list version, template & start position, then streamed back in chunks
+    """
+    mailing_list = get_object_or_404(CustomerMailingList, id=mailing_list_id)
+    refresh_dynamic_list(mailing_list)
+
+    # Get starting position, the label template & whether duplicate addresses are merged (one label per household)
+    start_position = parse_start_position(request)
+    template = parse_label_template(request.POST)
+    dedupe = bool(request.POST.get('dedupe'))
+
+    # Serve the cached pdf - only rendered when the list (or a member address) has changed since the last print
+    pdf_path, _ = cached_labels_pdf(mailing_list, template=template, start_position=start_position, dedupe=dedupe)
+
+    # FileResponse streams the file back in chunks & closes it when done
+    return FileResponse(open(pdf_path, 'rb'), as_attachment=True, filename=f"{mailing_list.name}_labels.pdf", content_type='application/pdf')
 
 @login_required    
 def print_labels_page(request, mailing_list_id):
-    """Gets mailing list that will be used to generate pdf labels"""
+    """
+        Gets mailing list that will be used to generate pdf labels & the grid of the picked label template (?template=)
+        Also reports how many duplicate addresses (same normalized address) a deduped print would merge.
+    """
     mailing_list = get_object_or_404(CustomerMailingList, id=mailing_list_id)
-    return render(request, 'customers/print_labels.html', {'mailing_list': mailing_list})
\ No newline at end of file
+    refresh_if_stale(mailing_list)
+    template = parse_label_template(request.GET)
+    layout = LABEL_TEMPLATES[template]
+    label_count, household_count = mailing_list_dedupe_counts(mailing_list)
+
+    context = {
+        'mailing_list': mailing_list,
+        'label_templates': LABEL_TEMPLATES,
+        'template': template,
+        'layout': layout,
+        'label_rows': range(1, layout.rows + 1),
+        'label_columns': range(1, layout.columns + 1),
+        'label_count': label_count,
+        'household_count': household_count,
+        'duplicate_count': label_count - household_count,
+    }
+    return render(request, 'customers/print_labels.html', context)
+
+@login_required
+def start_label_render_job(request, mailing_list_id):
+    """
+        HTMX view that renders the labels of a (very large) mailing list in the background, so the request returns straight away.
+        Returns the job status partial, which polls until the pdf is ready to download.
+    """
+    mailing_list = get_object_or_404(CustomerMailingList, id=mailing_list_id)
+
+    if request.method != "POST":
+        return HttpResponse(status=400)  # Return bad request for non-POST requests
+
+    refresh_dynamic_list(mailing_list)
+    job = LabelRenderJob.objects.create(
+        mailing_list=mailing_list,
+        template=parse_label_template(request.POST),
+        start_position=parse_start_position(request),
+        dedupe=bool(request.POST.get('dedupe')),
+        requested_by=request.user,
+    )
+    run_in_background(run_label_render_job, job.id)
+
+    job.refresh_from_db()
+    return render(request, 'customers/partials/label_render_job.html', {'job': job})
+
+@login_required
+def label_render_job_status(request, job_id):
+    """HTMX view polled by the print labels page to show the progress of a background label job"""
+    job = get_object_or_404(LabelRenderJob.objects.select_related('mailing_list'), id=job_id)
+    return render(request, 'customers/partials/label_render_job.html', {'job': job})
+
+@login_required
+def download_label_render_job(request, job_id):
+    """Downloads the pdf rendered by a finished background label job"""
+    job = get_object_or_404(LabelRenderJob.objects.select_related('mailing_list'), id=job_id, status='done')
+    pdf_path = os.path.join(label_cache_root(), job.pdf_name)
+
+    # the pdf was evicted from the label cache (or the list changed) - the labels need to be rendered again
+    if not os.path.exists(pdf_path):
+        return redirect('print_labels_page', mailing_list_id=job.mailing_list_id)
+
+    return FileResponse(open(pdf_path, 'rb'), as_attachment=True, filename=f"{job.mailing_list.name}_labels.pdf", content_type='application/pdf')
+
+# ------------------------ EXPORTS: mailing lists & filtered customers as csv / excel files -------------------------------------------
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+def export_response(rows, file_name, export_format):
+    """
+        Helper function that returns a streaming csv or excel (xlsx) download of export rows.
+        The header is sent straight away & rows are written as they come from the db - memory stays flat for any size of export.
+    """
+    if export_format == 'xlsx':
+        content = stream_xlsx(EXPORT_COLUMNS, rows, sheet_name=file_name)
+    else:
+        export_format = 'csv'
+        content = stream_csv(EXPORT_COLUMNS, rows)
+
+    response = StreamingHttpResponse(content, content_type=EXPORT_CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{file_name}.{export_format}"'
+    return response
+
+def filter_export_customers(params):
+    """
+        Helper function that returns the customers matching the home page filters (all optional):
+        search_customer (names), selected_interests (slugs), selected_users (creator ids), start_date & end_date (date added)
+    """
+    customers = Customer.objects.all()
+
+    # customer names: every search term must match a first or last name
+    for term in params.get('search_customer', '').split():
+        customers = customers.filter(Q(first_name__icontains=term) | Q(last_name__icontains=term))
+
+    selected_interests = params.getlist('selected_interests')
+    if selected_interests:
+        customers = customers.filter(interests__slug__in=selected_interests).distinct()
+
+    selected_user_ids = [user_id for user_id in params.getlist('selected_users') if user_id.isdigit()]
+    if selected_user_ids:
+        customers = customers.filter(creator__id__in=selected_user_ids)
+
+    # dates that can't be parsed are ignored (as on the home page)
+    try:
+        if params.get('start_date'):
+            customers = customers.filter(created_at__gte=parse_date(params['start_date']))
+        if params.get('end_date'):
+            customers = customers.filter(created_at__lte=parse_date(params['end_date']) + timedelta(days=1) - timedelta(microseconds=1))
+    except ValueError:
+        pass
+
+    return customers
+
+@login_required
+def export_mailing_list(request, mailing_list_id):
+    """Streams a mailing list (one row per labelled address: name, address, preferred email & primary phone) as ?format=csv or xlsx"""
+    mailing_list = get_object_or_404(CustomerMailingList, id=mailing_list_id)
+    refresh_dynamic_list(mailing_list)
+    return export_response(mailing_list_export_rows(mailing_list), mailing_list.name, request.GET.get('format'))
+
+@login_required
+def export_customers(request):
+    """Streams the customers matching the home page filters (one row per customer) as ?format=csv or xlsx"""
+    customers = filter_export_customers(request.GET)
+    return export_response(customer_export_rows(customers), 'customers', request.GET.get('format'))